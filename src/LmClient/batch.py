@@ -0,0 +1,233 @@
+"""
+@summary: Helpers for performing bulk operations against the Lifemapper web
+             services
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+
+@note: The functions in this module use threads rather than processes.  The
+          work they are intended for is dominated by waiting on the network, so
+          the global interpreter lock is not a bottleneck.
+"""
+from collections import namedtuple
+import Queue
+import sys
+import threading
+import time
+
+DEFAULT_NUM_THREADS = 4
+
+# .............................................................................
+## Result of a single unit of work performed by one of the concurrent helpers.
+#  'item' is the input item, 'result' is the return value of the function
+#  (None on failure) and 'error' is the exception raised (None on success)
+BatchResult = namedtuple('BatchResult', ['index', 'item', 'result', 'error'])
+
+# .............................................................................
+class RateLimiter(object):
+   """
+   @summary: Thread safe limiter that spaces out calls so that no more than
+                the specified number happen per second
+   """
+   # .........................................
+   def __init__(self, maxPerSecond):
+      """
+      @summary: Constructor
+      @param maxPerSecond: The maximum number of calls allowed per second.  If
+                              this is None or less than or equal to zero, calls
+                              are not limited
+      """
+      if maxPerSecond is not None and maxPerSecond > 0:
+         self.interval = 1.0 / maxPerSecond
+      else:
+         self.interval = 0.0
+      self._nextTime = 0.0
+      self._lock = threading.Lock()
+
+   # .........................................
+   def wait(self, amount=1):
+      """
+      @summary: Blocks until the caller is allowed to proceed
+      @param amount: (optional) The number of units being used.  A limiter
+                        created with a maximum number of bytes per second can
+                        be passed the length of each chunk of data to limit
+                        bandwidth
+      """
+      if self.interval <= 0.0:
+         return
+      with self._lock:
+         now = time.time()
+         waitTime = self._nextTime - now
+         self._nextTime = max(now, self._nextTime) + self.interval * amount
+      if waitTime > 0:
+         time.sleep(waitTime)
+
+# .............................................................................
+def iterConcurrently(func, items, numThreads=DEFAULT_NUM_THREADS,
+                     rateLimiter=None):
+   """
+   @summary: Calls func on each item using a pool of worker threads and yields
+                the results as they complete
+   @param func: A function that takes a single item as its argument
+   @param items: An iterable of items to process.  This is consumed lazily so
+                    it can be a generator over a very large number of items
+   @param numThreads: (optional) The maximum number of calls to run at once
+   @param rateLimiter: (optional) A RateLimiter object used to limit how often
+                          func is called
+   @return: A generator of BatchResult named tuples in completion order
+   @note: Exceptions raised by func are captured in the 'error' attribute of
+             the result instead of stopping the other work
+   @note: An exception raised while iterating items is raised by the 
+             generator once the items before it have been processed
+   @note: If the generator is closed or abandoned before it finishes, no more
+             items are read and queued items are dropped.  Calls that have 
+             already started run to completion
+   """
+   numThreads = max(1, int(numThreads))
+   inQueue = Queue.Queue(maxsize=2 * numThreads)
+   outQueue = Queue.Queue()
+   sentinel = object()
+   stop = threading.Event()
+
+   # ...............................
+   def _feed():
+      try:
+         for i, item in enumerate(items):
+            if stop.is_set():
+               break
+            inQueue.put((i, item))
+      except Exception:
+         outQueue.put(_FeedError(sys.exc_info()))
+      finally:
+         for _ in range(numThreads):
+            inQueue.put(sentinel)
+
+   # ...............................
+   def _work():
+      while True:
+         job = inQueue.get()
+         if job is sentinel:
+            outQueue.put(sentinel)
+            return
+         if stop.is_set():
+            continue
+         idx, item = job
+         if rateLimiter is not None:
+            rateLimiter.wait()
+         try:
+            outQueue.put(BatchResult(idx, item, func(item), None))
+         except Exception, e:
+            outQueue.put(BatchResult(idx, item, None, e))
+
+   threads = [threading.Thread(target=_feed)]
+   threads.extend([threading.Thread(target=_work) for _ in range(numThreads)])
+   for t in threads:
+      t.daemon = True
+      t.start()
+
+   feedError = None
+   finished = 0
+   try:
+      while finished < numThreads:
+         res = outQueue.get()
+         if res is sentinel:
+            finished += 1
+         elif isinstance(res, _FeedError):
+            feedError = res.excInfo
+         else:
+            yield res
+   finally:
+      stop.set()
+      # Empty the input queue so a blocked feeder can see the stop flag.  The
+      #    sentinels are only put once the feeder is done, so put back the 
+      #    first one found and leave the rest
+      while True:
+         try:
+            job = inQueue.get_nowait()
+         except Queue.Empty:
+            break
+         if job is sentinel:
+            inQueue.put(job)
+            break
+   if feedError is not None:
+      raise feedError[0], feedError[1], feedError[2]
+
+# .............................................................................
+def runConcurrently(func, items, numThreads=DEFAULT_NUM_THREADS,
+                    rateLimiter=None):
+   """
+   @summary: Calls func on each item using a pool of worker threads and
+                returns all of the results
+   @param func: A function that takes a single item as its argument
+   @param items: An iterable of items to process
+   @param numThreads: (optional) The maximum number of calls to run at once
+   @param rateLimiter: (optional) A RateLimiter object used to limit how often
+                          func is called
+   @return: A list of BatchResult named tuples in the same order as items
+   """
+   results = list(iterConcurrently(func, items, numThreads=numThreads,
+                                   rateLimiter=rateLimiter))
+   results.sort(key=lambda r: r.index)
+   return results
+
+# .............................................................................
+def iterListItems(listFunc, perPage=100, **kwargs):
+   """
+   @summary: Pages through one of the client list functions, yielding each item
+   @param listFunc: A client list function, such as SDMClient.listLayers, that
+                       accepts 'page' and 'perPage' keyword arguments
+   @param perPage: (optional) The number of items to request for each page
+   @param kwargs: (optional) Any other keyword arguments for the list function
+   """
+   page = 0
+   while True:
+      items = listFunc(page=page, perPage=perPage, **kwargs)
+      for item in items:
+         yield item
+      if len(items) < perPage:
+         break
+      page += 1
+
+# .............................................................................
+def formatTime(secs):
+   """
+   @summary: Formats a time in seconds since the epoch as an ISO 8601 UTC
+                string, as accepted by the afterTime and beforeTime arguments
+                of the list and count functions
+   @param secs: The time to format
+   """
+   return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(secs))
+
+# =============================================================================
+# =                             Helper Functions                              =
+# =============================================================================
+# .............................................................................
+class _FeedError(object):
+   """
+   @summary: Carries an exception raised while iterating the items of 
+                iterConcurrently from the feeder thread to the caller
+   """
+   def __init__(self, excInfo):
+      self.excInfo = excInfo
+
@@ -31,4 +31,23 @@ CONTENT_TYPES = {
                 }
 
 OTL_HINT_URL = "https://api.opentreeoflife.org/v3/tnrs/autocomplete_name"
+OTL_MATCH_NAMES_URL = "https://api.opentreeoflife.org/v3/tnrs/match_names"
 OTL_TREE_WEB_URL = "https://api.opentreeoflife.org/v3/tree_of_life/subtree"
+
+# Maps the extension of a local raster file to the GDAL format name used when
+#    uploading it
+RASTER_FORMAT_EXTENSIONS = {
+                            ".asc" : "AAIGrid",
+                            ".tif" : "GTiff",
+                            ".tiff" : "GTiff"
+                           }
+
+# The number of bytes read at a time when a response is streamed to a file
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# The minimum number of bytes requested at a time when reading parts of a 
+#    remote file with HTTP Range requests
+RANGE_BLOCK_SIZE = 256 * 1024
+
+# The number of blocks of a remote file that are kept in memory
+RANGE_CACHE_BLOCKS = 16
@@ -0,0 +1,455 @@
+"""
+@summary: Module containing functions and classes for downloading Lifemapper
+             outputs efficiently
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+
+@note: Example, download the projections of an experiment as tiffs:
+          dm = DownloadManager(cl.sdm, maxBytesPerSecond=5*1024*1024)
+          for prj in cl.sdm.listProjections(expId=123):
+             dm.add('projection', prj.id, 'tiff')
+          results = dm.download('outputs')
+"""
+from collections import namedtuple, OrderedDict
+import os
+import shutil
+import tempfile
+import threading
+from urlparse import urlparse
+
+from LmClient.batch import iterConcurrently, RateLimiter
+from LmClient.constants import (DOWNLOAD_CHUNK_SIZE, RANGE_BLOCK_SIZE, 
+                                 RANGE_CACHE_BLOCKS)
+
+# .............................................................................
+# Maps the resource types that can be downloaded to their SDM service path
+DOWNLOAD_RESOURCES = {
+   'layer' : 'layers',
+   'occurrence' : 'occurrences',
+   'projection' : 'projections'
+}
+
+# Maps download formats to the extension used for default file names
+DOWNLOAD_EXTENSIONS = {
+   'ascii' : '.asc',
+   'csv' : '.csv',
+   'kml' : '.kml',
+   'shapefile' : '.zip',
+   'tiff' : '.tif'
+}
+
+# .............................................................................
+## A file to download
+DownloadRequest = namedtuple('DownloadRequest', ['resourceType', 'objId',
+                                                 'frmt', 'filename'])
+
+## The outcome of a download.  'skipped' is True if the file already existed
+#  with the correct size.  'error' is None on success
+DownloadResult = namedtuple('DownloadResult', ['request', 'filename',
+                                               'numBytes', 'skipped', 'error'])
+
+## Running totals passed to the progress function after each file
+DownloadProgress = namedtuple('DownloadProgress', ['numDone', 'numTotal',
+                                                   'numSkipped', 'numFailed',
+                                                   'bytesDone'])
+
+# .............................................................................
+class DownloadManager(object):
+   """
+   @summary: Downloads SDM layers, occurrence sets and projections
+                concurrently, streaming each to disk
+   """
+   # .........................................
+   def __init__(self, sdmClient, numThreads=8, maxPerHost=4,
+                      maxBytesPerSecond=None, chunkSize=DOWNLOAD_CHUNK_SIZE):
+      """
+      @summary: Constructor
+      @param sdmClient: An SDMClient object
+      @param numThreads: (optional) The maximum number of downloads at once
+      @param maxPerHost: (optional) The maximum number of downloads at once
+                            from any single host
+      @param maxBytesPerSecond: (optional) The total bandwidth allowed for all
+                                   downloads.  If None, it is not limited
+      @param chunkSize: (optional) The number of bytes read at a time
+      """
+      self.sdmClient = sdmClient
+      self.numThreads = numThreads
+      self.maxPerHost = maxPerHost
+      self.chunkSize = chunkSize
+      self.bandwidthLimiter = RateLimiter(maxBytesPerSecond)
+      self.requests = []
+      self._hostSemaphores = {}
+      self._hostLock = threading.Lock()
+
+   # .........................................
+   def add(self, resourceType, objId, frmt, filename=None):
+      """
+      @summary: Adds a file to download
+      @param resourceType: One of 'layer', 'occurrence' or 'projection'
+      @param objId: The id of the object to download
+      @param frmt: The format to download, such as 'tiff' or 'kml'
+      @param filename: (optional) The file name to write to, relative to the
+                          output directory.  If None, it is built from the
+                          resource type, id and format
+      """
+      if not DOWNLOAD_RESOURCES.has_key(resourceType):
+         raise Exception, "Unknown resource type: %s" % resourceType
+      if filename is None:
+         filename = "%s_%s%s" % (resourceType, objId,
+                                 DOWNLOAD_EXTENSIONS.get(frmt, ''))
+      self.requests.append(DownloadRequest(resourceType, objId, frmt,
+                                           filename))
+
+   # .........................................
+   def getUrl(self, request):
+      """
+      @summary: Returns the url for a download request
+      @param request: A DownloadRequest named tuple
+      """
+      return "%s/services/sdm/%s/%s/%s" % (self.sdmClient.cl.server,
+                              DOWNLOAD_RESOURCES[request.resourceType],
+                              request.objId, request.frmt)
+
+   # .........................................
+   def download(self, outDir, progress=None):
+      """
+      @summary: Downloads all of the added files
+      @param outDir: The directory to write the files to.  It is created if it
+                        does not exist
+      @param progress: (optional) A function called with a DownloadProgress
+                          named tuple after each file finishes
+      @return: A list of DownloadResult named tuples, in the order the files
+                  were added
+      @note: A file that already exists is skipped if its size matches the
+                Content-Length reported by the server.  Interrupted downloads
+                are resumed from their partial files
+      """
+      if not os.path.exists(outDir):
+         os.makedirs(outDir)
+
+      numDone = numSkipped = numFailed = bytesDone = 0
+      results = [None] * len(self.requests)
+      for res in iterConcurrently(lambda r: self._download(r, outDir),
+                                  self.requests, numThreads=self.numThreads):
+         fn = os.path.join(outDir, res.item.filename)
+         if res.error is None:
+            numBytes, skipped = res.result
+            results[res.index] = DownloadResult(res.item, fn, numBytes,
+                                                skipped, None)
+            if skipped:
+               numSkipped += 1
+            else:
+               bytesDone += numBytes
+         else:
+            results[res.index] = DownloadResult(res.item, fn, 0, False,
+                                                res.error)
+            numFailed += 1
+         numDone += 1
+         if progress is not None:
+            progress(DownloadProgress(numDone, len(self.requests), numSkipped,
+                                      numFailed, bytesDone))
+      return results
+
+   # .........................................
+   def _download(self, request, outDir):
+      """
+      @summary: Downloads a single file
+      @return: A tuple of (number of bytes, True if skipped)
+      """
+      fn = os.path.join(outDir, request.filename)
+      url = self.getUrl(request)
+      with self._getHostSemaphore(url):
+         numBytes = self.sdmClient.cl.downloadToFile(url, fn, 
+                                         chunkSize=self.chunkSize, 
+                                         onChunk=self.bandwidthLimiter.wait,
+                                         resume=True, skipExisting=True)
+      if numBytes is None:
+         return os.path.getsize(fn), True
+      return numBytes, False
+
+   # .........................................
+   def _getHostSemaphore(self, url):
+      """
+      @summary: Returns the semaphore limiting downloads from the host of a url
+      """
+      host = urlparse(url).netloc
+      with self._hostLock:
+         if not self._hostSemaphores.has_key(host):
+            self._hostSemaphores[host] = threading.BoundedSemaphore(
+                                                               self.maxPerHost)
+         return self._hostSemaphores[host]
+
+# .............................................................................
+class RangeFile(object):
+   """
+   @summary: A read-only, seekable file object for a remote file that reads 
+                only the byte ranges that are asked for, using HTTP Range 
+                requests
+   @note: This lets zipfile read the member list and selected members of a 
+             remote archive without downloading the rest of it
+   @note: The file is read in blocks of blockSize bytes and the most 
+             recently used maxBlocks blocks are kept, so that the many small 
+             reads made by zipfile, which go back and forth between the 
+             member list and the members, do not each become a request.  The
+             missing blocks of a read that are next to each other are 
+             requested together
+   """
+   # .........................................
+   def __init__(self, cl, url, size, blockSize=RANGE_BLOCK_SIZE, 
+                      maxBlocks=RANGE_CACHE_BLOCKS):
+      """
+      @summary: Constructor
+      @param cl: A Lifemapper _Client object to make requests with
+      @param url: The url of the remote file.  The server must support ranges
+      @param size: The size of the remote file in bytes
+      @param blockSize: (optional) The minimum number of bytes to request
+      @param maxBlocks: (optional) The number of blocks to keep in memory
+      """
+      self.cl = cl
+      self.url = url
+      self.size = size
+      self.blockSize = blockSize
+      self.maxBlocks = max(1, maxBlocks)
+      self.pos = 0
+      self.numRequests = 0
+      self._blocks = OrderedDict()
+
+   # .........................................
+   def seek(self, offset, whence=0):
+      """
+      @summary: Moves the read position, as for a regular file
+      """
+      if whence == 1:
+         offset += self.pos
+      elif whence == 2:
+         offset += self.size
+      self.pos = max(0, offset)
+
+   # .........................................
+   def tell(self):
+      """
+      @summary: Returns the read position
+      """
+      return self.pos
+
+   # .........................................
+   def read(self, n=-1):
+      """
+      @summary: Reads up to n bytes, or the rest of the file if n is 
+                   negative, from the read position
+      """
+      if n is None or n < 0:
+         n = self.size - self.pos
+      n = min(n, self.size - self.pos)
+      if n <= 0:
+         return ''
+      first = self.pos // self.blockSize
+      last = (self.pos + n - 1) // self.blockSize
+      blocks = {}
+      missing = []
+      for i in xrange(first, last + 1):
+         block = self._blocks.pop(i, None)
+         if block is None:
+            missing.append(i)
+         else:
+            # Move it to the most recently used end
+            self._blocks[i] = blocks[i] = block
+      
+      runStart = 0
+      for j in xrange(1, len(missing) + 1):
+         if j == len(missing) or missing[j] != missing[j - 1] + 1:
+            self._requestBlocks(missing[runStart], missing[j - 1], blocks)
+            runStart = j
+      
+      start = self.pos - first * self.blockSize
+      data = ''.join([blocks[i] for i in xrange(first, last + 1)])
+      data = data[start:start + n]
+      self.pos += len(data)
+      return data
+
+   # .........................................
+   def close(self):
+      """
+      @summary: Releases the cached blocks
+      """
+      self._blocks.clear()
+
+   # .........................................
+   def _requestBlocks(self, first, last, blocks):
+      """
+      @summary: Requests a run of blocks with one range request and caches 
+                   them, dropping the least recently used blocks if needed
+      @param first: The index of the first block
+      @param last: The index of the last block
+      @param blocks: A dictionary to add each block index and data to
+      """
+      start = first * self.blockSize
+      end = min(self.size, (last + 1) * self.blockSize) - 1
+      ret = self.cl.openRequest(self.url, 
+                              headers={'Range' : "bytes=%d-%d" % (start, end)})
+      try:
+         if ret.getcode() != 206:
+            raise Exception("Server did not return a range for %s" % self.url)
+         data = ret.read()
+      finally:
+         ret.close()
+      self.numRequests += 1
+      if len(data) != end - start + 1:
+         raise Exception("Server returned %s bytes of %s for %s" % (
+                                         len(data), end - start + 1, self.url))
+      for i in xrange(first, last + 1):
+         offset = (i - first) * self.blockSize
+         blocks[i] = data[offset:offset + self.blockSize]
+         self._blocks[i] = blocks[i]
+         if len(self._blocks) > self.maxBlocks:
+            self._blocks.popitem(last=False)
+
+# .............................................................................
+def openRemoteFile(cl, url, blockSize=RANGE_BLOCK_SIZE, 
+                   maxBlocks=RANGE_CACHE_BLOCKS):
+   """
+   @summary: Opens a remote file for random access
+   @param cl: A Lifemapper _Client object to make requests with
+   @param url: The url of the remote file
+   @param blockSize: (optional) The minimum number of bytes to request at a 
+                        time if the server supports ranges
+   @param maxBlocks: (optional) The number of blocks to keep in memory if the
+                        server supports ranges
+   @return: A RangeFile if the server supports ranges.  Otherwise, the file is
+               streamed to an anonymous temporary file, which is returned
+   """
+   ret = cl.openRequest(url, headers={'Range' : 'bytes=0-0'})
+   try:
+      if ret.getcode() == 206:
+         _, size = parseContentRange(ret.info().getheader('Content-Range'))
+         if size is not None:
+            return RangeFile(cl, url, size, blockSize=blockSize, 
+                             maxBlocks=maxBlocks)
+         ret.close()
+         ret = cl.openRequest(url)
+      tmpF = tempfile.TemporaryFile()
+      shutil.copyfileobj(ret, tmpF, DOWNLOAD_CHUNK_SIZE)
+      tmpF.seek(0)
+      return tmpF
+   finally:
+      ret.close()
+
+# =============================================================================
+# =                             Helper Functions                              =
+# =============================================================================
+# .............................................................................
+def copyToFile(inF, filename, chunkSize=DOWNLOAD_CHUNK_SIZE, onChunk=None,
+               mode='wb'):
+   """
+   @summary: Copies a file-like object to a file a chunk at a time
+   @param inF: An open file-like object, such as an HTTP response
+   @param filename: The file location to write to
+   @param chunkSize: (optional) The number of bytes to read at a time
+   @param onChunk: (optional) A function called with the length of each chunk
+                      before it is written
+   @param mode: (optional) The mode to open the file with.  Use 'ab' to append
+   @return: The number of bytes written
+   """
+   numBytes = 0
+   with open(filename, mode) as outF:
+      while True:
+         chunk = inF.read(chunkSize)
+         if not chunk:
+            break
+         if onChunk is not None:
+            onChunk(len(chunk))
+         outF.write(chunk)
+         numBytes += len(chunk)
+   return numBytes
+
+# .............................................................................
+def makeTempPath(fn):
+   """
+   @summary: Returns a new, empty temporary file in the directory of fn, so 
+                that it can be renamed to fn
+   """
+   fd, tmpFn = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fn)), 
+                                suffix='.tmp')
+   os.close(fd)
+   return tmpFn
+
+# .............................................................................
+def removeFile(fn):
+   """
+   @summary: Removes a file if it exists
+   """
+   try:
+      os.remove(fn)
+   except OSError:
+      pass
+
+# .............................................................................
+def writeFileAtomic(fn, content):
+   """
+   @summary: Writes a file by writing a temporary file and renaming it, so 
+                that a partially written file is never seen.  The directory
+                is created if it does not exist
+   @param fn: The file to write
+   @param content: The string to write
+   """
+   dirName = os.path.dirname(os.path.abspath(fn))
+   if not os.path.exists(dirName):
+      try:
+         os.makedirs(dirName)
+      except OSError:
+         # Created by another thread
+         if not os.path.isdir(dirName):
+            raise
+   tmpFn = makeTempPath(fn)
+   try:
+      with open(tmpFn, 'wb') as outF:
+         outF.write(content)
+      os.rename(tmpFn, fn)
+   except:
+      removeFile(tmpFn)
+      raise
+
+# .............................................................................
+def parseContentRange(contentRange):
+   """
+   @summary: Parses the value of an HTTP Content-Range header
+   @param contentRange: A header value such as 'bytes 100-199/1000', or 
+                           'bytes */1000' as sent with a 416 response
+   @return: A tuple of (first byte position, total size).  The total size is 
+               None if the server does not report it.  The first byte 
+               position is None for 'bytes */1000'
+   """
+   try:
+      unit, rng = contentRange.strip().split(' ', 1)
+      byteRange, total = rng.split('/')
+      if byteRange.strip() == '*':
+         start = None
+      else:
+         start = int(byteRange.split('-')[0])
+   except Exception:
+      raise Exception("Could not parse Content-Range: %s" % contentRange)
+   if total.strip() == '*':
+      return start, None
+   return start, int(total)
@@ -0,0 +1,464 @@
+"""
+@summary: Module containing tools for combining many SDM projections, such
+             as ensemble statistics and species richness maps
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+
+@note: Requires NumPy and the GDAL Python bindings
+@note: Example, mean and agreement of all Maxent projections of a scenario:
+          prjIds = [p.id for p in cl.sdm.listProjections(scenarioId=32,
+                                             algorithmCode='ATT_MAXENT')]
+          stack = ProjectionStack.build(cl.sdm, prjIds, 'maxent.stack')
+          stats = stack.computeStatistics(['mean', 'agreement'],
+                                          threshold=50)
+          stack.writeGeoTiff(stats['mean'], 'mean.tif')
+"""
+from collections import namedtuple
+from itertools import takewhile
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+from osgeo import gdal, osr
+
+from LmClient.batch import DEFAULT_NUM_THREADS, iterConcurrently
+
+# The default number of cells processed at a time.  Each pass holds a block of
+#    this many cells by the number of projections, as float32
+DEFAULT_CHUNK_CELLS = 65536
+
+# The default number of raster rows read at a time when building a richness 
+#    map
+DEFAULT_WINDOW_ROWS = 256
+
+# The statistics that can be computed by ProjectionStack.computeStatistics
+STACK_STATISTICS = ['mean', 'std', 'var', 'min', 'max', 'count', 'agreement']
+
+# .............................................................................
+## The result of buildRichnessMap.  'richness' is a (rows x columns) int32 
+#  array of the number of projections present in each cell.  'failures' is a 
+#  dictionary of projection id to the exception for skipped projections
+RichnessMap = namedtuple('RichnessMap', ['richness', 'geoTransform', 
+                                         'projection', 'numProjections',
+                                         'failures'])
+
+# .............................................................................
+class ProjectionStack(object):
+   """
+   @summary: A stack of projections that share a grid, stored as a memory
+                mapped (projections x cells) float32 array on disk
+   @note: Each projection is a contiguous run of the file, so a projection is
+             written sequentially while the stack is built.  A chunk of cells
+             is read as one run per projection and returned transposed, as a
+             (cells x projections) block.  No data cells are stored as NaN
+   @note: A JSON file next to the stack file records the projection ids and
+             the grid, so a stack can be reopened with ProjectionStack.open
+   """
+   # .........................................
+   def __init__(self, stackFile, metadata, mode='r'):
+      """
+      @summary: Constructor.  Use build or open to get a stack
+      @param stackFile: The file holding the array
+      @param metadata: The stack metadata dictionary
+      @param mode: (optional) The memory map mode
+      """
+      self.stackFile = stackFile
+      self.prjIds = metadata['prjIds']
+      self.numRows = metadata['numRows']
+      self.numCols = metadata['numCols']
+      self.geoTransform = metadata['geoTransform']
+      self.projection = metadata['projection']
+      self.numCells = self.numRows * self.numCols
+      self.data = np.memmap(stackFile, dtype=np.float32, mode=mode,
+                            shape=(len(self.prjIds), self.numCells))
+
+   # .........................................
+   @classmethod
+   def build(cls, sdmClient, prjIds, stackFile, tmpDir=None,
+                  numThreads=DEFAULT_NUM_THREADS, chunkCells=DEFAULT_CHUNK_CELLS):
+      """
+      @summary: Downloads projections into a new stack file
+      @param sdmClient: An SDMClient object
+      @param prjIds: A list of the ids of the projections to stack.  They must
+                        all have the same grid
+      @param stackFile: The file to write the stack to
+      @param tmpDir: (optional) A directory for the downloaded tiffs.  Each
+                        tiff is removed once it has been copied to the stack
+      @param numThreads: (optional) The maximum number of projections to
+                            download at the same time
+      @param chunkCells: (optional) The approximate number of cells read from
+                            a projection and copied at a time
+      @rtype: ProjectionStack
+      @note: Each projection is read in windows of whole rows, so memory use 
+                is one window, not one projection
+      """
+      prjIds = list(prjIds)
+      workDir = tempfile.mkdtemp(prefix='lmStack', dir=tmpDir)
+      # Set on failure so that no more downloads are started
+      cancelled = threading.Event()
+
+      # ...............................
+      def _download(prjId):
+         if cancelled.is_set():
+            raise Exception("Stack build cancelled")
+         fn = os.path.join(workDir, "%s.tif" % prjId)
+         sdmClient.getProjectionTiff(prjId, filename=fn)
+         return fn
+
+      stack = None
+      try:
+         for res in iterConcurrently(_download, 
+                        takewhile(lambda _: not cancelled.is_set(), prjIds), 
+                        numThreads=numThreads):
+            if res.error is not None:
+               raise Exception("Could not download projection %s: %s" % (
+                                                         res.item, res.error))
+            try:
+               ds = gdal.Open(res.result)
+               if ds is None:
+                  raise Exception("Could not open projection %s" % res.item)
+               shape = (ds.RasterYSize, ds.RasterXSize)
+               geoTransform = list(ds.GetGeoTransform())
+               projection = ds.GetProjection()
+               if stack is None:
+                  metadata = {
+                     'prjIds' : prjIds,
+                     'numRows' : shape[0],
+                     'numCols' : shape[1],
+                     'geoTransform' : geoTransform,
+                     'projection' : projection
+                  }
+                  stack = cls(stackFile, metadata, mode='w+')
+                  with open(_metadataFileName(stackFile), 'w') as outF:
+                     json.dump(metadata, outF)
+               else:
+                  _checkGrid(res.item, shape, geoTransform, projection,
+                             (stack.numRows, stack.numCols), 
+                             stack.geoTransform, stack.projection)
+               
+               windowRows = max(1, chunkCells // stack.numCols)
+               for row, window in _iterRasterWindows(ds, windowRows):
+                  start = row * stack.numCols
+                  stack.data[res.index, start:start + window.size] = \
+                                                               window.ravel()
+            finally:
+               ds = None
+               os.remove(res.result)
+         if stack is None:
+            raise Exception("No projections to stack")
+         stack.data.flush()
+      except:
+         cancelled.set()
+         # Don't leave a partial stack that open would accept
+         stack = None
+         for fn in [stackFile, _metadataFileName(stackFile)]:
+            if os.path.exists(fn):
+               os.remove(fn)
+         raise
+      finally:
+         shutil.rmtree(workDir, ignore_errors=True)
+
+      return cls.open(stackFile)
+
+   # .........................................
+   @classmethod
+   def open(cls, stackFile):
+      """
+      @summary: Opens an existing stack file read-only
+      @param stackFile: The stack file written by build
+      @rtype: ProjectionStack
+      """
+      with open(_metadataFileName(stackFile)) as inF:
+         metadata = json.load(inF)
+      return cls(stackFile, metadata, mode='r')
+
+   # .........................................
+   def iterChunks(self, chunkCells=DEFAULT_CHUNK_CELLS, columns=None):
+      """
+      @summary: Yields blocks of cells from the stack
+      @param chunkCells: (optional) The number of cells in each block
+      @param columns: (optional) A list of the projection ids to include.  If
+                         None, all projections are included
+      @return: A generator of (first cell index, block) tuples where block is
+                  a (cells x projections) float32 array
+      """
+      colIdxs = None
+      if columns is not None:
+         colIdxs = [self.prjIds.index(prjId) for prjId in columns]
+      for start in xrange(0, self.numCells, chunkCells):
+         if colIdxs is None:
+            block = self.data[:, start:start + chunkCells]
+         else:
+            block = self.data[colIdxs, start:start + chunkCells]
+         yield start, np.ascontiguousarray(block.T)
+
+   # .........................................
+   def computeStatistics(self, stats=['mean', 'std'], threshold=None,
+                               columns=None, chunkCells=DEFAULT_CHUNK_CELLS):
+      """
+      @summary: Computes per-cell statistics across the projections
+      @param stats: (optional) A list of statistics to compute from
+                       STACK_STATISTICS.  'count' is the number of projections
+                       with data and 'agreement' is the fraction of them at or
+                       above the threshold
+      @param threshold: (optional) The threshold for 'agreement'
+      @param columns: (optional) A list of projection ids to include, such as
+                         the projections of one algorithm
+      @param chunkCells: (optional) The number of cells processed at a time
+      @return: A dictionary of statistic name to a (rows x columns) float32
+                  array, with NaN where no projection has data
+      @note: Only one output grid per statistic and one block of cells are
+                held in memory
+      """
+      for stat in stats:
+         if stat not in STACK_STATISTICS:
+            raise Exception("Unknown statistic: %s" % stat)
+      if 'agreement' in stats and threshold is None:
+         raise Exception("A threshold is required for agreement")
+
+      outputs = dict([(stat, np.empty(self.numCells, dtype=np.float32)) \
+                                                            for stat in stats])
+      for start, block in self.iterChunks(chunkCells=chunkCells,
+                                          columns=columns):
+         end = start + block.shape[0]
+         valid = ~np.isnan(block)
+         count = valid.sum(axis=1).astype(np.float32)
+         noData = count == 0
+         with np.errstate(invalid='ignore', divide='ignore'):
+            total = np.where(valid, block, 0.0).sum(axis=1)
+            mean = total / count
+            for stat in stats:
+               if stat == 'mean':
+                  val = mean
+               elif stat in ('var', 'std'):
+                  diff = np.where(valid, block - mean[:, np.newaxis], 0.0)
+                  val = (diff * diff).sum(axis=1) / count
+                  if stat == 'std':
+                     val = np.sqrt(val)
+               elif stat == 'min':
+                  val = np.where(valid, block, np.inf).min(axis=1)
+               elif stat == 'max':
+                  val = np.where(valid, block, -np.inf).max(axis=1)
+               elif stat == 'count':
+                  val = count
+               elif stat == 'agreement':
+                  val = (valid & (block >= threshold)).sum(axis=1) / count
+               val = np.asarray(val, dtype=np.float32)
+               if stat != 'count':
+                  val[noData] = np.nan
+               outputs[stat][start:end] = val
+
+      return dict([(stat, arr.reshape(self.numRows, self.numCols)) \
+                                          for stat, arr in outputs.iteritems()])
+
+   # .........................................
+   def writeGeoTiff(self, array, filename, noDataValue=-9999.0):
+      """
+      @summary: Writes a grid with the same shape as the stack to a GeoTIFF
+      @param array: A (rows x columns) array, such as one returned by
+                       computeStatistics
+      @param filename: The file location to write to
+      @param noDataValue: (optional) The value written for NaN cells
+      """
+      writeGeoTiff(array, filename, self.geoTransform, self.projection,
+                   noDataValue=noDataValue)
+
+# .............................................................................
+def buildRichnessMap(sdmClient, prjIds, threshold, outFilename=None,
+                     tmpDir=None, numThreads=DEFAULT_NUM_THREADS, maxInFlight=None,
+                     windowRows=DEFAULT_WINDOW_ROWS):
+   """
+   @summary: Builds a species richness map by summing thresholded projections
+   @param sdmClient: An SDMClient object
+   @param prjIds: An iterable of the ids of the projections to sum, one per
+                     species.  They must all have the same grid.  This is 
+                     consumed lazily, so it can be a generator over the 
+                     results of SDMClient.listProjections
+   @param threshold: Cells with a value at or above this are counted as present
+   @param outFilename: (optional) If provided, the richness map is also
+                          written to this GeoTIFF
+   @param tmpDir: (optional) A directory for the downloaded tiffs
+   @param numThreads: (optional) The maximum number of projections to
+                         download at the same time
+   @param maxInFlight: (optional) The maximum number of downloaded tiffs 
+                          waiting to be summed.  Defaults to twice numThreads
+   @param windowRows: (optional) The number of rows of each projection read 
+                         at a time
+   @rtype: RichnessMap
+   @note: Memory use is one int32 output grid plus one window of rows.  Disk
+             use is at most maxInFlight projections
+   @note: A projection that can't be downloaded or has a different grid is
+             recorded in 'failures' and skipped
+   """
+   if maxInFlight is None:
+      maxInFlight = 2 * numThreads
+   slots = threading.BoundedSemaphore(maxInFlight)
+   workDir = tempfile.mkdtemp(prefix='lmRichness', dir=tmpDir)
+
+   # ...............................
+   def _download(prjId):
+      slots.acquire()
+      try:
+         fn = os.path.join(workDir, "%s.tif" % prjId)
+         sdmClient.getProjectionTiff(prjId, filename=fn)
+         return fn
+      except:
+         slots.release()
+         raise
+
+   richness = geoTransform = projection = None
+   numUsed = 0
+   failures = {}
+   try:
+      for res in iterConcurrently(_download, prjIds, numThreads=numThreads):
+         if res.error is not None:
+            failures[res.item] = res.error
+            continue
+         try:
+            ds = gdal.Open(res.result)
+            if ds is None:
+               raise Exception("Could not open projection %s" % res.item)
+            band = ds.GetRasterBand(1)
+            shape = (ds.RasterYSize, ds.RasterXSize)
+            if richness is None:
+               richness = np.zeros(shape, dtype=np.int32)
+               geoTransform = list(ds.GetGeoTransform())
+               projection = ds.GetProjection()
+            else:
+               _checkGrid(res.item, shape, list(ds.GetGeoTransform()), 
+                          ds.GetProjection(), richness.shape, geoTransform, 
+                          projection)
+            noDataValue = band.GetNoDataValue()
+            for row in xrange(0, shape[0], windowRows):
+               numRows = min(windowRows, shape[0] - row)
+               window = band.ReadAsArray(0, row, shape[1], numRows)
+               present = window >= threshold
+               if noDataValue is not None:
+                  present &= window != noDataValue
+               richness[row:row + numRows] += present
+            numUsed += 1
+         except Exception, e:
+            failures[res.item] = e
+         finally:
+            band = ds = None
+            os.remove(res.result)
+            slots.release()
+   finally:
+      shutil.rmtree(workDir, ignore_errors=True)
+
+   if richness is None:
+      raise Exception("No projections could be summed")
+   if outFilename is not None:
+      writeGeoTiff(richness, outFilename, geoTransform, projection, 
+                   noDataValue=-1)
+   return RichnessMap(richness, geoTransform, projection, numUsed, failures)
+
+# .............................................................................
+def writeGeoTiff(array, filename, geoTransform, projection,
+                 noDataValue=-9999.0):
+   """
+   @summary: Writes a two dimensional array to a single band GeoTIFF
+   @param array: A (rows x columns) array
+   @param filename: The file location to write to
+   @param geoTransform: The GDAL geotransform of the grid
+   @param projection: The WKT projection of the grid
+   @param noDataValue: (optional) The value written for NaN cells
+   """
+   numRows, numCols = array.shape
+   if np.issubdtype(array.dtype, np.floating):
+      gdalType = gdal.GDT_Float32
+      array = np.where(np.isnan(array), noDataValue, array)
+   else:
+      gdalType = gdal.GDT_Int32
+   ds = gdal.GetDriverByName('GTiff').Create(filename, numCols, numRows, 1,
+                                             gdalType)
+   ds.SetGeoTransform(geoTransform)
+   ds.SetProjection(projection)
+   band = ds.GetRasterBand(1)
+   band.SetNoDataValue(noDataValue)
+   band.WriteArray(array)
+   band.FlushCache()
+   ds = None
+
+# =============================================================================
+# =                             Helper Functions                              =
+# =============================================================================
+# .............................................................................
+def _checkGrid(prjId, shape, geoTransform, projection, expectedShape, 
+               expectedGeoTransform, expectedProjection):
+   """
+   @summary: Raises an exception if a projection's grid differs from the grid
+                of the projections before it
+   @param prjId: The id of the projection, used for the error message
+   @note: Geotransforms are compared with a tolerance of a millionth of a 
+             cell, and projections are compared as spatial references so that
+             equivalent WKT strings match
+   """
+   if tuple(shape) != tuple(expectedShape):
+      raise Exception("Projection %s is %s, not %s like the others" % (
+                                             prjId, tuple(shape), 
+                                             tuple(expectedShape)))
+   cellSize = max(abs(expectedGeoTransform[1]), abs(expectedGeoTransform[5]))
+   if not np.allclose(geoTransform, expectedGeoTransform, rtol=0.0, 
+                      atol=cellSize * 1e-6):
+      raise Exception("Projection %s has geotransform %s, not %s like the others" % (
+                                 prjId, geoTransform, expectedGeoTransform))
+   if projection != expectedProjection:
+      sameSrs = False
+      if projection and expectedProjection:
+         sameSrs = osr.SpatialReference(wkt=projection).IsSame(
+                              osr.SpatialReference(wkt=expectedProjection))
+      if not sameSrs:
+         raise Exception("Projection %s has a different spatial reference than the others" \
+                                                                      % prjId)
+
+# .............................................................................
+def _metadataFileName(stackFile):
+   """
+   @summary: Returns the name of the metadata file for a stack file
+   """
+   return "%s.json" % stackFile
+
+# .............................................................................
+def _iterRasterWindows(ds, windowRows):
+   """
+   @summary: Reads the first band of a raster a window of rows at a time, as
+                float32 with NaN for no data
+   @param ds: An open GDAL dataset
+   @param windowRows: The number of rows in each window
+   @return: A generator of (first row, (rows x columns) array) tuples
+   """
+   band = ds.GetRasterBand(1)
+   noDataValue = band.GetNoDataValue()
+   for row in xrange(0, ds.RasterYSize, windowRows):
+      numRows = min(windowRows, ds.RasterYSize - row)
+      window = band.ReadAsArray(0, row, ds.RasterXSize, 
+                                numRows).astype(np.float32)
+      if noDataValue is not None:
+         window[window == noDataValue] = np.nan
+      yield row, window
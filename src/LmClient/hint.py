@@ -0,0 +1,540 @@
+"""
+@summary: Module containing the results of the species and archive hint
+             services and client side caches and indexes for them
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+
+@note: The hint service matches the query against the start of each word of
+          the species name, so the hits for a longer query are a subset of the
+          hits for any of its prefixes.  HintCache relies on this to answer
+          longer queries locally
+"""
+from collections import namedtuple, OrderedDict
+import json
+import threading
+import time
+from xml.etree.cElementTree import iterparse
+
+from LmCommon.common.lmXml import deserialize
+
+# The minimum number of characters accepted by the hint service
+MIN_HINT_LENGTH = 3
+
+# The default number of seconds that cached hint results are used for
+DEFAULT_HINT_TTL = 300
+
+# The default maximum number of queries kept in a hint cache
+DEFAULT_MAX_HINT_ENTRIES = 1000
+
+# The attributes of an archive hit that may hold its occurrence set id, in the
+#    order they are tried
+OCC_SET_ID_ATTRIBUTES = ['occurrenceSetId', 'occurrenceId', 'occSetId',
+                         'occurrenceSet']
+
+# .............................................................................
+## An occurrence set returned by the hint service.  These attributes are 
+#  pulled from the response of the Lucene query and may change over time
+SearchHit = namedtuple('SearchHit', ['name', 'id', 'numPoints', 'downloadUrl',
+                                     'binomial', 'numModels'])
+
+# .............................................................................
+class HintCache(object):
+   """
+   @summary: Caches the results of hint queries so that repeated queries, and
+                queries that extend a previous query, are answered without a
+                request
+   @note: A cached result can only answer a longer query if it is complete,
+             that is, it was not cut off by maxReturned
+   @note: The cache may be shared by several threads
+   """
+   # .........................................
+   def __init__(self, ttl=DEFAULT_HINT_TTL, maxEntries=DEFAULT_MAX_HINT_ENTRIES):
+      """
+      @summary: Constructor
+      @param ttl: (optional) The number of seconds a result is used for
+      @param maxEntries: (optional) The maximum number of queries to keep.  The
+                            least recently used are removed first
+      """
+      self.ttl = ttl
+      self.maxEntries = maxEntries
+      self.numHits = 0
+      self.numMisses = 0
+      self._lock = threading.Lock()
+      # (service root, normalized query) -> (time added, hits, complete)
+      self._entries = OrderedDict()
+
+   # .........................................
+   def get(self, serviceRoot, query, maxReturned=None):
+      """
+      @summary: Returns the cached hits for a query, or None if the query must
+                   be sent to the service
+      @param serviceRoot: The web server root of the hint service
+      @param query: The query string
+      @param maxReturned: (optional) The maximum number of hits wanted
+      @return: A list of SearchHit named tuples, or None
+      """
+      query = normalizeHintQuery(query)
+      now = time.time()
+      with self._lock:
+         # Try the query itself, then each shorter prefix
+         for end in xrange(len(query), MIN_HINT_LENGTH - 1, -1):
+            prefix = query[:end]
+            entry = self._getEntry((serviceRoot, prefix), now)
+            if entry is None:
+               continue
+            _, hits, complete = entry
+            if end == len(query):
+               # The same query.  A truncated result is enough if it has as
+               #    many hits as are wanted
+               if complete or (maxReturned is not None and \
+                                                   len(hits) >= maxReturned):
+                  self.numHits += 1
+                  return hits[:maxReturned]
+            elif complete:
+               self.numHits += 1
+               return [h for h in hits if matchesHint(h, query)][:maxReturned]
+         self.numMisses += 1
+         return None
+
+   # .........................................
+   def put(self, serviceRoot, query, hits, maxReturned=None):
+      """
+      @summary: Stores the hits returned by the service for a query
+      @param serviceRoot: The web server root of the hint service
+      @param query: The query string
+      @param hits: The list of SearchHit named tuples returned
+      @param maxReturned: (optional) The maxReturned value of the request
+      """
+      complete = maxReturned is None or len(hits) < maxReturned
+      key = (serviceRoot, normalizeHintQuery(query))
+      with self._lock:
+         self._entries.pop(key, None)
+         self._entries[key] = (time.time(), list(hits), complete)
+         while len(self._entries) > self.maxEntries:
+            self._entries.popitem(last=False)
+
+   # .........................................
+   def clear(self):
+      """
+      @summary: Removes all cached results
+      """
+      with self._lock:
+         self._entries.clear()
+
+   # .........................................
+   def _getEntry(self, key, now):
+      """
+      @summary: Returns an unexpired entry and marks it as recently used, or
+                   None.  Expired entries are removed.  The lock must be held
+      """
+      entry = self._entries.pop(key, None)
+      if entry is None or now - entry[0] > self.ttl:
+         return None
+      self._entries[key] = entry
+      return entry
+
+# .............................................................................
+class AsyncHinter(object):
+   """
+   @summary: Runs hint queries in the background for a type-ahead search box.
+                Input is debounced and only the results of the latest query
+                are delivered
+   @note: Cached results are delivered right away.  Otherwise a request is
+             made once no new query has been entered for 'delay' seconds.  A
+             request that is superseded while in flight is closed without
+             reading or parsing its response.  Superseded results are never
+             delivered, even if they arrive after the latest results
+   @note: Example:
+             hinter = AsyncHinter(cl.sdm, lambda q, hits: showHits(hits))
+             for text in ['aca', 'acac', 'acaci']:
+                hinter.query(text)
+             ...
+             hinter.close()
+   """
+   # .........................................
+   def __init__(self, sdmClient, onResults, onError=None, delay=0.2,
+                      maxReturned=None, serviceRoot=None):
+      """
+      @summary: Constructor
+      @param sdmClient: An SDMClient object.  Its hintCache is used
+      @param onResults: A function called with (query, list of SearchHit) for
+                           the latest query.  It is called from a background
+                           thread
+      @param onError: (optional) A function called with (query, exception) if
+                         the request for the latest query fails
+      @param delay: (optional) The number of seconds without new input before
+                       a request is made
+      @param maxReturned: (optional) The maximum number of hits per query
+      @param serviceRoot: (optional) The web server root for the hint service.
+                             Defaults to the instance that the client is
+                             connected to
+      """
+      self.sdmClient = sdmClient
+      self.onResults = onResults
+      self.onError = onError
+      self.delay = delay
+      self.maxReturned = maxReturned
+      if serviceRoot is None:
+         serviceRoot = sdmClient.cl.server
+      self.serviceRoot = serviceRoot
+      self._cond = threading.Condition()
+      self._deliverLock = threading.Lock()
+      self._generation = 0
+      self._pending = None
+      self._lastInput = 0
+      self._closed = False
+      self._worker = threading.Thread(target=self._run)
+      self._worker.daemon = True
+      self._worker.start()
+
+   # .........................................
+   def query(self, text):
+      """
+      @summary: Sets the latest query.  It returns immediately; the results
+                   are passed to onResults
+      @param text: The text of the search box.  Queries shorter than 
+                      MIN_HINT_LENGTH are delivered an empty list
+      """
+      with self._cond:
+         self._generation += 1
+         self._pending = (self._generation, text)
+         self._lastInput = time.time()
+         self._cond.notify()
+
+   # .........................................
+   def close(self):
+      """
+      @summary: Stops the background thread.  Requests in flight are not
+                   delivered
+      """
+      with self._cond:
+         self._closed = True
+         self._generation += 1
+         self._cond.notify()
+
+   # .........................................
+   def _isLatest(self, generation):
+      """
+      @summary: Returns True if no query has been entered since generation
+      """
+      return generation == self._generation and not self._closed
+
+   # .........................................
+   def _run(self):
+      """
+      @summary: Waits for queries, answers them from the cache or starts a 
+                   request for them once the input has settled
+      """
+      cache = self.sdmClient.hintCache
+      while True:
+         with self._cond:
+            while self._pending is None and not self._closed:
+               self._cond.wait()
+            if self._closed:
+               return
+            generation, text = self._pending
+
+            if len(text) < MIN_HINT_LENGTH:
+               self._pending = None
+               hits = []
+            else:
+               hits = cache.get(self.serviceRoot, text, self.maxReturned)
+               if hits is None:
+                  remaining = self._lastInput + self.delay - time.time()
+                  if remaining > 0:
+                     # Wait for the input to settle, then look again since a
+                     #    new query may have been entered
+                     self._cond.wait(remaining)
+                     continue
+               self._pending = None
+
+         if hits is not None:
+            self._deliver(generation, text, hits)
+         else:
+            thrd = threading.Thread(target=self._request,
+                                    args=(generation, text))
+            thrd.daemon = True
+            thrd.start()
+
+   # .........................................
+   def _request(self, generation, text):
+      """
+      @summary: Requests the hits for a query and delivers them if the query
+                   is still the latest
+      """
+      try:
+         ret = self.sdmClient.cl.openRequest(
+                                      getHintUrl(self.serviceRoot, text),
+                                      parameters=getHintParameters(
+                                                            self.maxReturned))
+         try:
+            if not self._isLatest(generation):
+               return
+            content = ret.read()
+         finally:
+            ret.close()
+         if not self._isLatest(generation):
+            return
+         hits = parseHints(content)
+         self.sdmClient.hintCache.put(self.serviceRoot, text, hits,
+                                      self.maxReturned)
+      except Exception, e:
+         if self.onError is not None:
+            with self._deliverLock:
+               if self._isLatest(generation):
+                  self.onError(text, e)
+         return
+      self._deliver(generation, text, hits[:self.maxReturned])
+
+   # .........................................
+   def _deliver(self, generation, text, hits):
+      """
+      @summary: Passes hits to onResults if their query is still the latest
+      """
+      with self._deliverLock:
+         if self._isLatest(generation):
+            self.onResults(text, hits)
+
+# .............................................................................
+class ArchiveIndex(object):
+   """
+   @summary: Groups archive hits by occurrence set so that the models and
+                projections of a species can be looked up without another
+                request
+   @note: Example:
+             idx = ArchiveIndex()
+             for hit in cl.sdm.iterSearchArchive('Acacia', index=idx):
+                pass
+             for occId in idx.occurrenceSetIds():
+                print occId, idx.getValues(occId, 'projectionId')
+   """
+   # .........................................
+   def __init__(self):
+      """
+      @summary: Constructor
+      """
+      self._groups = OrderedDict()
+      self.numHits = 0
+
+   # .........................................
+   def add(self, hit):
+      """
+      @summary: Adds an archive hit to the index
+      @param hit: An object returned by SDMClient.iterSearchArchive
+      """
+      self._groups.setdefault(getArchiveOccurrenceSetId(hit), []).append(hit)
+      self.numHits += 1
+
+   # .........................................
+   def occurrenceSetIds(self):
+      """
+      @summary: Returns the occurrence set ids in the index, in the order they
+                   were first seen
+      """
+      return self._groups.keys()
+
+   # .........................................
+   def getHits(self, occSetId):
+      """
+      @summary: Returns the list of hits for an occurrence set
+      """
+      return list(self._groups.get(_toInt(occSetId), []))
+
+   # .........................................
+   def getValues(self, occSetId, attribute):
+      """
+      @summary: Returns the distinct values of an attribute, such as 
+                   'projectionId', over the hits for an occurrence set, in the
+                   order they were first seen.  Hits without the attribute are
+                   skipped
+      """
+      values = []
+      for hit in self._groups.get(_toInt(occSetId), []):
+         val = getattr(hit, attribute, None)
+         if val is not None and val not in values:
+            values.append(val)
+      return values
+
+   # .........................................
+   def __len__(self):
+      return len(self._groups)
+
+# .............................................................................
+def getArchiveOccurrenceSetId(hit):
+   """
+   @summary: Returns the occurrence set id of an archive hit, as an integer if
+                possible, or None if it does not have one
+   """
+   for attr in OCC_SET_ID_ATTRIBUTES:
+      val = getattr(hit, attr, None)
+      if val is not None:
+         return _toInt(val)
+   return None
+
+# .............................................................................
+def iterArchiveHits(inF):
+   """
+   @summary: Parses the XML document returned by the archive hint service one
+                hit at a time
+   @param inF: An open file-like object, such as an HTTP response
+   @return: A generator of hit objects, the same as the items of the 'hits'
+               attribute of the objectified document
+   @note: Each hit is removed from the parsed tree once it has been yielded, 
+             so memory use does not grow with the number of hits
+   """
+   hitsElement = None
+   depth = 0
+   hitsDepth = None
+   for event, elem in iterparse(inF, events=('start', 'end')):
+      if event == 'start':
+         depth += 1
+         if hitsElement is None and _localName(elem.tag) == 'hits':
+            hitsElement = elem
+            hitsDepth = depth
+      else:
+         if hitsDepth is not None and depth == hitsDepth + 1:
+            yield deserialize(elem)
+            hitsElement.remove(elem)
+         elif elem is hitsElement:
+            hitsDepth = None
+         depth -= 1
+
+# .............................................................................
+def getHintUrl(serviceRoot, query):
+   """
+   @summary: Returns the url of the species hint service for a query
+   """
+   return "%s/hint/species/%s" % (serviceRoot, query)
+
+# .............................................................................
+def getHintParameters(maxReturned=None):
+   """
+   @summary: Returns the query parameters of a species hint request
+   """
+   return [("maxReturned", maxReturned), ("format", "json")]
+
+# .............................................................................
+def normalizeHintQuery(query):
+   """
+   @summary: Returns a query in the form used as a cache key; lower case, with
+                runs of white space replaced by single spaces
+   """
+   return ' '.join(query.lower().split())
+
+# .............................................................................
+def normalizeTaxonName(name):
+   """
+   @summary: Returns a taxon name in a standard form for lookups; underscores
+                and runs of white space become single spaces, the genus is
+                capitalized and the rest is lower case
+   @param name: A taxon name, such as 'acacia_Dealbata ' or a tree tip label
+   """
+   name = ' '.join(name.replace('_', ' ').split())
+   return name[:1].upper() + name[1:].lower()
+
+# .............................................................................
+def taxonNameMatches(hit, name, match='binomial'):
+   """
+   @summary: Returns True if a hit is a match for a normalized taxon name
+   @param hit: A SearchHit named tuple
+   @param name: A name returned by normalizeTaxonName
+   @param match: (optional) How names are compared.  One of:
+                    'exact' - the hit name must equal the name
+                    'binomial' - the genus and species of the hit must equal
+                                 those of the name, so authors and 
+                                 subspecies are ignored
+                    'prefix' - any hit returned by the hint service matches
+   """
+   if match == 'prefix':
+      return True
+   hitNames = [normalizeTaxonName(n) for n in (hit.name, hit.binomial) if n]
+   if match == 'exact':
+      return name in hitNames
+   elif match == 'binomial':
+      binomial = name.split()[:2]
+      return any([n.split()[:2] == binomial for n in hitNames])
+   raise Exception, "Unknown name match type: %s" % match
+
+# .............................................................................
+def matchesHint(hit, query):
+   """
+   @summary: Returns True if the hint service would return a hit for a query
+   @param hit: A SearchHit named tuple
+   @param query: A normalized query string
+   @note: A hit matches if the query is a prefix of its name, or of the name
+             starting at any later word
+   """
+   for name in (hit.name, hit.binomial):
+      if not name:
+         continue
+      name = normalizeHintQuery(name)
+      if name.startswith(query) or (' %s' % query) in name:
+         return True
+   return False
+
+# .............................................................................
+def parseHints(content):
+   """
+   @summary: Parses the JSON document returned by the hint service
+   @param content: The JSON string returned by the service
+   @return: A list of SearchHit named tuples
+   """
+   jObj = json.loads(content)
+   
+   try:
+      # Old json format
+      jsonItems = jObj.get('columns')[0]
+   except:
+      # New json format
+      jsonItems = jObj.get('hits')
+   
+   return [SearchHit(name=item.get('name'),
+                     id=int(item.get('occurrenceSet')),
+                     numPoints=int(item.get('numPoints')),
+                     downloadUrl=item.get('downloadUrl'),
+                     binomial=item.get('binomial'),
+                     numModels=int(item.get('numModels'))) \
+                                                      for item in jsonItems]
+
+# =============================================================================
+# =                             Helper Functions                              =
+# =============================================================================
+# .............................................................................
+def _localName(tag):
+   """
+   @summary: Returns an XML tag without its namespace
+   """
+   return tag.rsplit('}', 1)[-1]
+
+# .............................................................................
+def _toInt(val):
+   """
+   @summary: Returns a value as an integer if it can be converted, so that ids
+                read from XML compare equal to ids given as numbers
+   """
+   try:
+      return int(val)
+   except (TypeError, ValueError):
+      return val
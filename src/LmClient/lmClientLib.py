@@ -45,6 +45,7 @@ import cookielib
 import glob
 import os
 import StringIO
+import tempfile
 from types import ListType
 import urllib
 import urllib2
@@ -53,6 +54,9 @@ import warnings
 import zipfile
 
 
+from LmClient.constants import DOWNLOAD_CHUNK_SIZE
+from LmClient.downloads import (copyToFile, makeTempPath, parseContentRange,
+                                 removeFile)
 from LmClient.openTree import OTLClient
 from LmClient.rad import RADClient
 from LmClient.sdm import SDMClient
@@ -222,7 +226,9 @@ class _Client(object):
    def autoUnzipShapefile(self, cnt, filePath, overwrite=False):
       """
       @summary: Attempt to unzip a zipped shapefile.
-      @param cnt: The zipped shapefile content
+      @param cnt: The zipped shapefile, as its content or an open file-like
+                     object such as an HTTP response.  Use 
+                     autoUnzipShapefileFromPath for a zip file on disk
       @param filePath: If a directory is specified, unzip the shapefile there.  
                           If a .zip path is specified, write out the zipfile 
                           as-is.  If a .shp path is specified, write out the 
@@ -230,40 +236,81 @@ class _Client(object):
       @param overwrite: (optional) Boolean indicating if the files should be 
                            overwritten if present
       @note: If specifying a directory as the filePath, it should exist
-      """
-      if os.path.isdir(filePath):
-         with zipfile.ZipFile(StringIO.StringIO(cnt), 'r', allowZip64=True) as zf:
-            # Check to see if files exist
-            nameList = zf.namelist()
-            if not overwrite:
-               for name in nameList:
-                  if os.path.exists(os.path.join(filePath, name)):
-                     raise Exception( 
-                        "File %s, already exists and overwrite is: %s" % (
-                                    os.path.join(filePath, name), overwrite))
-            zf.extractall(filePath)
+      @note: Every output file is checked before anything is written.  Files
+                are copied in chunks to temporary files and renamed once all 
+                of them have been written, so the archive members are never
+                held in memory and existing files are only replaced if the
+                whole shapefile is extracted
+      """
+      base, ext = os.path.splitext(filePath)
+      if not os.path.isdir(filePath) and ext not in ('.zip', '.shp'):
+         raise Exception, "Do not know how to handle file path: %s" % filePath
+
+      tmpFn = None
+      if hasattr(cnt, 'read'):
+         inF = cnt
       else:
-         base, ext = os.path.splitext(filePath)
-         if ext == '.zip':
-            with open(filePath, 'wb') as outF:
-               outF.write(cnt)
-         elif ext == '.shp':
-            # Check to see if filePath exists
-            # Able to write if path doesn't exist or overwrite is true
-            if not os.path.exists(filePath) or overwrite:
-               with zipfile.ZipFile(StringIO.StringIO(cnt), 'r', allowZip64=True) as zf:
-                  for name in zf.namelist():
-                     fCnt = zf.read(name)
-                     fBase, fExt = os.path.splitext(name)
-                     with open(os.path.join(filePath, '%s%s' % (base, fExt)), 'wb') as outF:
-                        outF.write(fCnt)
-                     
+         inF = StringIO.StringIO(cnt)
+      try:
+         if ext == '.zip' and not os.path.isdir(filePath):
+            _checkOverwrite([filePath], overwrite)
+            tmpFn = makeTempPath(filePath)
+            copyToFile(inF, tmpFn)
+            os.rename(tmpFn, filePath)
+            tmpFn = None
+            return
+
+         if not _isSeekable(inF):
+            # zipfile needs random access, so spool the stream to disk
+            fd, tmpFn = tempfile.mkstemp(suffix='.zip')
+            os.close(fd)
+            copyToFile(inF, tmpFn)
+            inF = open(tmpFn, 'rb')
+         
+         with zipfile.ZipFile(inF, 'r', allowZip64=True) as zf:
+            members = [name for name in zf.namelist() \
+                                                   if not name.endswith('/')]
+            if os.path.isdir(filePath):
+               outFns = [_memberPath(filePath, name) for name in members]
             else:
-               raise Exception, "%s already exists and overwrite is: %s" % (
-                                                           filePath, overwrite)
-         else:
-            raise Exception, "Do not know how to handle file path: %s" % filePath
-   
+               outFns = ["%s%s" % (base, os.path.splitext(name)[1]) \
+                                                          for name in members]
+            _checkOverwrite(outFns, overwrite)
+            
+            tmpFns = []
+            try:
+               for name, outFn in zip(members, outFns):
+                  outDir = os.path.dirname(outFn)
+                  if outDir and not os.path.exists(outDir):
+                     os.makedirs(outDir)
+                  tmpFns.append(makeTempPath(outFn))
+                  with zf.open(name) as memberF:
+                     copyToFile(memberF, tmpFns[-1])
+               for memberTmpFn, outFn in zip(tmpFns, outFns):
+                  os.rename(memberTmpFn, outFn)
+               tmpFns = []
+            finally:
+               for memberTmpFn in tmpFns:
+                  removeFile(memberTmpFn)
+      finally:
+         if inF is not cnt:
+            inF.close()
+         if tmpFn is not None:
+            removeFile(tmpFn)
+
+   # .........................................
+   def autoUnzipShapefileFromPath(self, zipFn, filePath, overwrite=False):
+      """
+      @summary: Attempt to unzip a zipped shapefile file.  See
+                   autoUnzipShapefile
+      @param zipFn: The path of the zipped shapefile
+      @param filePath: A directory, .zip or .shp path to write to
+      @param overwrite: (optional) Boolean indicating if the files should be
+                           overwritten if present
+      """
+      with open(zipFn, 'rb') as inF:
+         self.autoUnzipShapefile(inF, filePath, overwrite=overwrite)
+
    # .........................................
    def getAutozipShapefileStream(self, fn):
       """
@@ -334,19 +381,55 @@ class _Client(object):
       @param url: The url endpoint to make the request to
       @param method: (optional) The HTTP method to use for the request
       @param parameters: (optional) List of url parameters
-      @param body: (optional) The payload of the request
+      @param body: (optional) The payload of the request.  This may be a string
+                      or an open file object, which will be streamed to the
+                      server rather than read into memory
       @param headers: (optional) Dictionary of HTTP headers
       @param objectify: (optional) Should the response be turned into an object
       @return: Response from the server
       """
+      ret = self.openRequest(url, method=method, parameters=parameters, 
+                             body=body, headers=headers)
+      try:
+         resp = ret.read()
+      finally:
+         ret.close()
+      if objectify:
+         return self.objectify(resp)
+      else:
+         return resp
+
+   # .........................................
+   def openRequest(self, url, method="GET", parameters=[], body=None, 
+                         headers={}):
+      """
+      @summary: Performs an HTTP request without reading the response
+      @param url: The url endpoint to make the request to
+      @param method: (optional) The HTTP method to use for the request
+      @param parameters: (optional) List of url parameters
+      @param body: (optional) The payload of the request.  See makeRequest
+      @param headers: (optional) Dictionary of HTTP headers
+      @return: An open, file-like response object.  Its 'info' method returns
+                  the response headers.  The caller must close it
+      """
       url = url.replace(" ", "%20").replace(",", "%2C")
       parameters = removeNonesFromTupleList(parameters)
       urlparams = urllib.urlencode(parameters)
-      
+
       if body is None and len(parameters) > 0 and method.lower() == "post":
          body = urlparams
       else:
          url = "%s?%s" % (url, urlparams)
+
+      if hasattr(body, 'read'):
+         # urllib2 needs the length up front, it can't take len() of a file
+         size = _remainingSize(body)
+         if size is None:
+            # Neither a file nor seekable, so it can only be sent from memory
+            body = body.read()
+         else:
+            headers = dict(headers)
+            headers['Content-Length'] = str(size)
       req = urllib2.Request(url, data=body, headers=headers)
       req.add_header('User-Agent', self.UA_STRING)
       req.get_method = lambda: method.upper()
@@ -357,12 +440,105 @@ class _Client(object):
          raise e
       except Exception, e:
          raise Exception( 'Error returning from request to %s (%s)' % (url, toUnicode(e)))
-      else:
-         resp = ''.join(ret.readlines())
-         if objectify:
-            return self.objectify(resp)
+      return ret
+
+   # .........................................
+   def downloadToFile(self, url, filename, parameters=[], 
+                            chunkSize=DOWNLOAD_CHUNK_SIZE, onChunk=None,
+                            resume=True, skipExisting=False):
+      """
+      @summary: Performs a GET request and streams the response to a file, so
+                   that the response is never held in memory
+      @param url: The url endpoint to make the request to
+      @param filename: The file location to write the response to
+      @param parameters: (optional) List of url parameters
+      @param chunkSize: (optional) The number of bytes to read at a time
+      @param onChunk: (optional) A function called with the length of each 
+                         chunk before it is written
+      @param resume: (optional) If True and a partial download of the file 
+                        exists, request only the rest of the file
+      @param skipExisting: (optional) If True, do not download the file if it
+                              already exists with the size reported by the 
+                              server
+      @return: The number of bytes received, or None if the download was 
+                  skipped
+      @note: The response is written to filename + '.part', which is renamed
+                when the download is complete.  If the download fails, the 
+                partial file is kept so that it can be resumed.  Resuming uses
+                an HTTP Range request.  If the server does not support ranges,
+                the whole file is downloaded again
+      @note: The ETag, or Last-Modified time, of the response is kept in 
+                filename + '.part.validator' and sent as If-Range when 
+                resuming, so that the rest of a remote file that has changed
+                is not appended to the start of the old one
+      @raise Exception: Raised if fewer bytes are received than expected
+      """
+      partFn = "%s.part" % filename
+      validatorFn = "%s.validator" % partFn
+      offset = 0
+      headers = {}
+      if resume and os.path.exists(partFn):
+         offset = os.path.getsize(partFn)
+         if offset > 0:
+            headers['Range'] = "bytes=%d-" % offset
+            if os.path.exists(validatorFn):
+               with open(validatorFn) as inF:
+                  headers['If-Range'] = inF.read().strip()
+      
+      try:
+         ret = self.openRequest(url, method="GET", parameters=parameters, 
+                                headers=headers)
+      except urllib2.HTTPError, e:
+         if e.code == 416 and offset > 0:
+            contentRange = e.info().getheader('Content-Range')
+            if contentRange is not None and \
+                  parseContentRange(contentRange)[1] == offset:
+               # The partial file is already complete
+               self._finishDownload(partFn, filename)
+               return 0
+            # The partial file does not fit the remote file, start again
+            self._removePartial(partFn)
+            return self.downloadToFile(url, filename, parameters=parameters,
+                                       chunkSize=chunkSize, onChunk=onChunk,
+                                       resume=False, skipExisting=skipExisting)
+         raise e
+      
+      try:
+         info = ret.info()
+         if ret.getcode() == 206:
+            start, expectedSize = parseContentRange(
+                                             info.getheader('Content-Range'))
+            if start != offset:
+               raise Exception("Server returned range starting at %s, not %s" % (
+                                                                start, offset))
+            mode = 'ab'
          else:
-            return resp
+            contentLength = info.getheader('Content-Length')
+            expectedSize = int(contentLength) if contentLength else None
+            if skipExisting and expectedSize is not None and \
+                  os.path.exists(filename) and \
+                  os.path.getsize(filename) == expectedSize:
+               return None
+            mode = 'wb'
+            validator = info.getheader('ETag')
+            if validator is None or validator.startswith('W/'):
+               # If-Range only accepts strong ETags
+               validator = info.getheader('Last-Modified')
+            if validator is not None:
+               with open(validatorFn, 'w') as outF:
+                  outF.write(validator)
+            elif os.path.exists(validatorFn):
+               os.remove(validatorFn)
+         numBytes = copyToFile(ret, partFn, chunkSize=chunkSize, 
+                               onChunk=onChunk, mode=mode)
+      finally:
+         ret.close()
+      
+      if expectedSize is not None and os.path.getsize(partFn) != expectedSize:
+         raise Exception("Incomplete download of %s, %s of %s bytes received" % (
+                                url, os.path.getsize(partFn), expectedSize))
+      self._finishDownload(partFn, filename)
+      return numBytes
 
    # .........................................
    def objectify(self, xmlString):
@@ -374,6 +550,26 @@ class _Client(object):
       """
       return deserialize(fromstring(xmlString))   
 
+   # .........................................
+   def _finishDownload(self, partFn, filename):
+      """
+      @summary: Renames a complete partial download to its file name
+      """
+      if os.path.exists(filename):
+         os.remove(filename)
+      os.rename(partFn, filename)
+      self._removePartial(partFn)
+
+   # .........................................
+   def _removePartial(self, partFn):
+      """
+      @summary: Removes a partial download and its validator file, if they 
+                   exist
+      """
+      for fn in [partFn, "%s.validator" % partFn]:
+         if os.path.exists(fn):
+            os.remove(fn)
+
    # .........................................
    def _getInstances(self):
       """
@@ -460,3 +656,57 @@ def stringifyError(err):
       return err.hdrs['Error-Message']
    except:
       return toUnicode(err)
+
+# .............................................................................
+def _checkOverwrite(fns, overwrite):
+   """
+   @summary: Raises an exception if any of the files exists and overwrite is 
+                False
+   """
+   if not overwrite:
+      for fn in fns:
+         if os.path.exists(fn):
+            raise Exception( 
+               "File %s, already exists and overwrite is: %s" % (fn, overwrite))
+
+# .............................................................................
+def _remainingSize(f):
+   """
+   @summary: Returns the number of bytes left to read from a file-like object,
+                or None if it can't be known without reading it
+   """
+   try:
+      return os.fstat(f.fileno()).st_size - f.tell()
+   except (AttributeError, ValueError, IOError, OSError):
+      # Not a real file, such as a StringIO
+      pass
+   try:
+      pos = f.tell()
+      f.seek(0, os.SEEK_END)
+      end = f.tell()
+      f.seek(pos)
+      return end - pos
+   except (AttributeError, ValueError, IOError, OSError):
+      return None
+
+# .............................................................................
+def _isSeekable(f):
+   """
+   @summary: Returns True if a file-like object supports random access
+   """
+   try:
+      f.seek(f.tell())
+      return True
+   except Exception:
+      return False
+
+# .............................................................................
+def _memberPath(outDir, name):
+   """
+   @summary: Returns the output path of a zip member, making sure that it is
+                inside of the output directory
+   """
+   fn = os.path.normpath(os.path.join(outDir, name))
+   if not fn.startswith(os.path.join(os.path.normpath(outDir), '')):
+      raise Exception, "Zip member %s is outside of %s" % (name, outDir)
+   return fn
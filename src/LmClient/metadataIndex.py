@@ -0,0 +1,384 @@
+"""
+@summary: Module containing a local SQLite index of Lifemapper object metadata
+             for fast, offline queries
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+
+@note: The resource type names match those used by LmClient.sync, so an index
+          can be kept up to date by passing it to ArchiveSync
+@note: Example, find completed Maxent projections for a scenario:
+          idx = MetadataIndex('metadata.db')
+          idx.addMany('sdmProjections',
+                      cl.sdm.listProjections(perPage=1000, fullObjects=True))
+          prjs = idx.query('sdmProjections', scenarioId=32, status=300,
+                           algorithmCode='ATT_MAXENT',
+                           afterTime='2016-06-01T00:00:00Z')
+@note: Lifemapper stores modification times as Modified Julian Days.  Query
+          times may be given as ISO 8601 strings, datetimes or numbers and are
+          converted to the type of the stored times
+"""
+import calendar
+from datetime import date, datetime
+import sqlite3
+import time
+
+from LmCommon.common.lmXml import deserialize, fromstring
+
+# .............................................................................
+# Columns common to every resource type.  Each column maps to a list of
+#    attribute paths that are tried in order when reading an object
+COMMON_COLUMNS = [
+   ('title', ['title', 'name', 'displayName']),
+   ('epsgCode', ['epsgcode', 'epsgCode']),
+   ('status', ['status', 'model.status']),
+   ('modTime', ['modTime', 'statusModTime', 'modificationTime'])
+]
+
+# .............................................................................
+## The indexed resource types.  Each maps to a tuple of (the attribute of the
+#  deserialized XML document holding the object, additional columns)
+INDEX_RESOURCES = {
+   'sdmExperiments' : ('experiment', [
+         ('algorithmCode', ['algorithmCode', 'algorithm.code',
+                            'model.algorithmCode', 'model.algorithm.code']),
+         ('occurrenceSetId', ['occurrenceSetId', 'occurrenceSet.id',
+                              'model.occurrenceSetId']),
+         ('scenarioId', ['modelScenarioId', 'modelScenario.id',
+                         'model.scenarioId', 'model.scenario.id'])]),
+   'sdmProjections' : ('projection', [
+         ('algorithmCode', ['algorithmCode', 'algorithm.code']),
+         ('occurrenceSetId', ['occurrenceSetId', 'occurrenceSet.id']),
+         ('experimentId', ['experimentId', 'modelId', 'model.id']),
+         ('scenarioId', ['scenarioId', 'projectionScenarioId',
+                         'scenario.id'])]),
+   'sdmOccurrenceSets' : ('occurrence', [
+         ('numPoints', ['numPoints', 'queryCount'])]),
+   'sdmLayers' : ('layer', [
+         ('typeCode', ['typeCode', 'envLayerType']),
+         ('scenarioId', ['scenarioId'])]),
+   'sdmScenarios' : ('scenario', [
+         ('code', ['code', 'scenarioCode'])])
+}
+
+# Columns that get a database index if a resource type has them
+INDEXED_COLUMNS = ['scenarioId', 'algorithmCode', 'status', 'epsgCode',
+                   'modTime', 'occurrenceSetId', 'experimentId']
+
+# The Modified Julian Day of the Unix epoch, 1970-01-01
+MJD_EPOCH = 40587
+
+# Stored numeric times smaller than this are Modified Julian Days, larger 
+#    ones are seconds since the epoch
+MAX_MJD = 1000000
+
+# The formats of time strings that are converted for numeric modTimes
+TIME_FORMATS = ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M', 
+                '%Y-%m-%d']
+
+# .............................................................................
+class MetadataIndex(object):
+   """
+   @summary: Stores the metadata of Lifemapper objects in an indexed SQLite
+                database so that they can be queried without contacting the
+                web services
+   @note: Objects can be added from list items, full objects or XML
+             documents.  Attributes missing from an object are stored as NULL
+   @note: Like any SQLite connection, an index should only be used from the
+             thread that created it
+   """
+   # .........................................
+   def __init__(self, dbFile=':memory:'):
+      """
+      @summary: Constructor
+      @param dbFile: (optional) The SQLite database file to use.  It is
+                        created if it does not exist.  If not provided, the
+                        index is kept in memory
+      """
+      self.conn = sqlite3.connect(dbFile)
+      self.conn.row_factory = sqlite3.Row
+      self._createTables()
+
+   # .........................................
+   def _createTables(self):
+      """
+      @summary: Creates the tables and indexes if they do not exist
+      """
+      with self.conn:
+         for resourceType in INDEX_RESOURCES.keys():
+            cols = ', '.join(self._columnNames(resourceType))
+            self.conn.execute(
+                  "CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY, %s)" \
+                                                        % (resourceType, cols))
+            for col in self._columnNames(resourceType):
+               if col in INDEXED_COLUMNS:
+                  self.conn.execute(
+                        "CREATE INDEX IF NOT EXISTS idx_%s_%s ON %s (%s)" % (
+                                       resourceType, col, resourceType, col))
+
+   # .........................................
+   def _columns(self, resourceType):
+      """
+      @summary: Returns the list of (column, attribute paths) tuples for a
+                   resource type
+      """
+      try:
+         return COMMON_COLUMNS + INDEX_RESOURCES[resourceType][1]
+      except KeyError:
+         raise Exception, "Unknown resource type: %s" % resourceType
+
+   # .........................................
+   def _columnNames(self, resourceType):
+      """
+      @summary: Returns the names of the columns, other than id, for a
+                   resource type
+      """
+      return [col for col, _ in self._columns(resourceType)]
+
+   # .........................................
+   def supports(self, resourceType):
+      """
+      @summary: Returns True if the resource type can be indexed
+      """
+      return INDEX_RESOURCES.has_key(resourceType)
+
+   # .........................................
+   def add(self, resourceType, obj):
+      """
+      @summary: Adds or replaces the metadata of an object
+      @param resourceType: One of the keys of INDEX_RESOURCES
+      @param obj: A list item or full object returned by the client
+      """
+      self.addMany(resourceType, [obj])
+
+   # .........................................
+   def addMany(self, resourceType, objs):
+      """
+      @summary: Adds or replaces the metadata of many objects in a single
+                   transaction
+      @param resourceType: One of the keys of INDEX_RESOURCES
+      @param objs: An iterable of list items or full objects
+      """
+      columns = self._columns(resourceType)
+      sql = "INSERT OR REPLACE INTO %s (id, %s) VALUES (?%s)" % (resourceType,
+                                    ', '.join([col for col, _ in columns]),
+                                    ', ?' * len(columns))
+      with self.conn:
+         self.conn.executemany(sql,
+               ([int(obj.id)] + [_getAttribute(obj, paths) \
+                                             for _, paths in columns] \
+                                                            for obj in objs))
+
+   # .........................................
+   def addXml(self, resourceType, xmlStrings):
+      """
+      @summary: Adds or replaces the metadata of objects from the XML
+                   documents returned by the web services
+      @param resourceType: One of the keys of INDEX_RESOURCES
+      @param xmlStrings: An XML document of a single object, or an iterable 
+                            of them to add in a single transaction
+      """
+      if isinstance(xmlStrings, basestring):
+         xmlStrings = [xmlStrings]
+      rootAttr = INDEX_RESOURCES[resourceType][0]
+      self.addMany(resourceType, 
+                   (getattr(obj, rootAttr, obj) for obj in \
+                          (deserialize(fromstring(xml)) for xml in xmlStrings)))
+
+   # .........................................
+   def remove(self, resourceType, objId):
+      """
+      @summary: Removes an object from the index
+      """
+      self._columns(resourceType)
+      with self.conn:
+         self.conn.execute("DELETE FROM %s WHERE id = ?" % resourceType,
+                           (int(objId),))
+
+   # .........................................
+   def query(self, resourceType, afterTime=None, beforeTime=None,
+                   orderBy=None, limit=None, **filters):
+      """
+      @summary: Returns the indexed objects that match all of the filters
+      @param resourceType: One of the keys of INDEX_RESOURCES
+      @param afterTime: (optional) Return only objects modified after this
+                           time.  An ISO 8601 string, such as 
+                           '2016-06-01T00:00:00Z', a datetime or date, or a 
+                           number in the format of the stored modTime
+      @param beforeTime: (optional) Return only objects modified before this
+                            time, as for afterTime
+      @note: Times are converted to the type of the stored modTime, so that
+                a string is not compared to numbers.  SQLite orders every 
+                number before every string
+      @param orderBy: (optional) A column name to sort by
+      @param limit: (optional) The maximum number of rows to return
+      @param filters: (optional) Column name and value pairs.  A list or tuple
+                         value matches any of its items
+      @return: A list of sqlite3.Row objects, which can be accessed like
+                  dictionaries
+      """
+      where, params = self._whereClause(resourceType, afterTime, beforeTime,
+                                        filters)
+      sql = "SELECT * FROM %s%s" % (resourceType, where)
+      if orderBy is not None:
+         self._checkColumn(resourceType, orderBy)
+         sql += " ORDER BY %s" % orderBy
+      if limit is not None:
+         sql += " LIMIT %d" % int(limit)
+      return self.conn.execute(sql, params).fetchall()
+
+   # .........................................
+   def count(self, resourceType, afterTime=None, beforeTime=None, **filters):
+      """
+      @summary: Returns the number of indexed objects that match all of the
+                   filters
+      @note: See query for parameter documentation
+      """
+      where, params = self._whereClause(resourceType, afterTime, beforeTime,
+                                        filters)
+      return self.conn.execute("SELECT COUNT(*) FROM %s%s" % (resourceType,
+                                                      where), params).fetchone()[0]
+
+   # .........................................
+   def close(self):
+      """
+      @summary: Closes the database connection
+      """
+      self.conn.close()
+
+   # .........................................
+   def _checkColumn(self, resourceType, col):
+      """
+      @summary: Raises an exception if col is not a column of the resource
+                   type.  Column names are put directly in SQL statements so
+                   they must be checked
+      """
+      if col != 'id' and col not in self._columnNames(resourceType):
+         raise Exception, "Unknown column for %s: %s" % (resourceType, col)
+
+   # .........................................
+   def _whereClause(self, resourceType, afterTime, beforeTime, filters):
+      """
+      @summary: Builds a SQL WHERE clause and its parameters
+      """
+      clauses = []
+      params = []
+      for col, val in filters.iteritems():
+         self._checkColumn(resourceType, col)
+         if isinstance(val, (list, tuple, set)):
+            val = list(val)
+            clauses.append("%s IN (%s)" % (col, ', '.join(['?'] * len(val))))
+            params.extend(val)
+         else:
+            clauses.append("%s = ?" % col)
+            params.append(val)
+      if afterTime is not None or beforeTime is not None:
+         row = self.conn.execute(
+               "SELECT modTime FROM %s WHERE modTime IS NOT NULL LIMIT 1" % \
+                                                      resourceType).fetchone()
+         stored = row[0] if row is not None else None
+         if afterTime is not None:
+            clauses.append("modTime > ?")
+            params.append(_convertTime(afterTime, stored))
+         if beforeTime is not None:
+            clauses.append("modTime < ?")
+            params.append(_convertTime(beforeTime, stored))
+      if len(clauses) == 0:
+         return "", params
+      return " WHERE %s" % ' AND '.join(clauses), params
+
+# =============================================================================
+# =                             Helper Functions                              =
+# =============================================================================
+# .............................................................................
+def _convertTime(val, stored):
+   """
+   @summary: Converts a query time to the type of a stored modTime
+   @param val: An ISO 8601 string, datetime, date or number
+   @param stored: A stored modTime value, or None if there are none
+   """
+   if isinstance(val, datetime):
+      secs = calendar.timegm(val.utctimetuple())
+   elif isinstance(val, date):
+      secs = calendar.timegm(val.timetuple())
+   elif isinstance(val, basestring):
+      if stored is None or isinstance(stored, basestring):
+         return val
+      try:
+         return float(val)
+      except ValueError:
+         secs = _parseTime(val)
+   elif stored is None or not isinstance(stored, basestring):
+      return val
+   else:
+      # A number compared to stored strings, the number is in seconds
+      return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(val))
+   
+   if isinstance(stored, basestring):
+      return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(secs))
+   if stored is not None and stored < MAX_MJD:
+      return MJD_EPOCH + secs / 86400.0
+   return secs
+
+# .............................................................................
+def _parseTime(val):
+   """
+   @summary: Returns the seconds since the epoch of an ISO 8601 UTC time 
+                string
+   """
+   text = val.strip().rstrip('Z')
+   for fmt in TIME_FORMATS:
+      try:
+         return calendar.timegm(time.strptime(text, fmt))
+      except ValueError:
+         pass
+   raise Exception, "Unknown time format: %s" % val
+
+# .............................................................................
+def _getAttribute(obj, paths):
+   """
+   @summary: Returns the value of the first attribute path that exists on the
+                object, or None
+   @param obj: The object to read
+   @param paths: A list of dotted attribute paths, such as 'model.status'
+   @note: Numeric strings are converted to numbers so that they compare
+             correctly in queries
+   """
+   for path in paths:
+      val = obj
+      try:
+         for attr in path.split('.'):
+            val = getattr(val, attr)
+      except Exception:
+         continue
+      if val is None or isinstance(val, (int, long, float)):
+         return val
+      val = unicode(val)
+      for castFunc in (int, float):
+         try:
+            return castFunc(val)
+         except ValueError:
+            pass
+      return val
+   return None
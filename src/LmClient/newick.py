@@ -0,0 +1,577 @@
+"""
+@summary: Module containing an iterative Newick parser and a compact, array
+             based tree for large phylogenies
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+
+@note: Requires NumPy
+@note: Nodes are numbered in preorder, so the parent of a node always has a
+          smaller index and the nodes of a clade are a contiguous range of
+          indices starting at its root.  The traversal helpers rely on this
+@note: Example, count the tips below each node of an Open Tree subtree:
+          tree = parseNewick(open('subtree.tre'))
+          tipCounts = tree.tipCounts()
+"""
+from array import array
+from itertools import chain
+import json
+import re
+
+import numpy as np
+
+# The number of characters read at a time from a file
+NEWICK_CHUNK_SIZE = 1024 * 1024
+
+# The value of parent and labelId for the root, and for unlabeled nodes
+NO_NODE = -1
+
+# The Newick punctuation characters
+NEWICK_PUNCT = frozenset('(),:;')
+
+# The attribute names of a node in the Lifemapper JSON tree format
+JTREE_CHILDREN = 'children'
+JTREE_LENGTH = 'length'
+JTREE_MATRIX_INDEX = 'mx'
+JTREE_NAME = 'name'
+JTREE_PATH_ID = 'pathId'
+
+# Matches one Newick token; white space and comments are skipped
+NEWICK_TOKEN_RE = re.compile(
+   r"\s*(?:\[[^\]]*\]\s*)*(?:('(?:[^']|'')*')|([(),:;])|([^\s(),:;\[\]']+))")
+
+# .............................................................................
+class CompactTree(object):
+   """
+   @summary: A tree stored as parallel arrays of node attributes instead of
+                an object per node
+   @note: Attributes:
+             parent - A NumPy int32 array of the parent index of each node,
+                         NO_NODE for the root
+             branchLength - A NumPy float64 array of the length of the branch
+                               above each node, NaN if missing
+             labelId - A NumPy int32 array of the index of each node's label
+                          in labels, NO_NODE for unlabeled nodes
+             labels - A list of the label strings
+   """
+   # .........................................
+   def __init__(self, parent, branchLength, labelId, labels):
+      """
+      @summary: Constructor
+      @param parent: The parent index of each node.  Nodes must be in 
+                        preorder
+      @param branchLength: The branch length of each node
+      @param labelId: The label index of each node
+      @param labels: The list of labels
+      """
+      self.parent = np.asarray(parent, dtype=np.int32)
+      self.branchLength = np.asarray(branchLength, dtype=np.float64)
+      self.labelId = np.asarray(labelId, dtype=np.int32)
+      self.labels = labels
+      self._depths = None
+      self._labelIndex = None
+
+   # .........................................
+   def __len__(self):
+      return len(self.parent)
+
+   # .........................................
+   def getLabel(self, node):
+      """
+      @summary: Returns the label of a node, or None
+      """
+      labelId = self.labelId[node]
+      if labelId == NO_NODE:
+         return None
+      return self.labels[labelId]
+
+   # .........................................
+   def isTip(self):
+      """
+      @summary: Returns a boolean array that is True for the tips
+      """
+      tips = np.ones(len(self.parent), dtype=bool)
+      tips[self.parent[self.parent != NO_NODE]] = False
+      return tips
+
+   # .........................................
+   def tipIndices(self):
+      """
+      @summary: Returns the indices of the tips, in preorder
+      """
+      return np.nonzero(self.isTip())[0]
+
+   # .........................................
+   def findLabels(self, labels):
+      """
+      @summary: Returns the node for each of several labels
+      @param labels: An iterable of label strings
+      @return: A NumPy int32 array of node indices, NO_NODE for labels that
+                  are not in the tree
+      """
+      if self._labelIndex is None:
+         # Only the labels of this tree's nodes are indexed, since a subtree 
+         #    shares the label list of its tree.  Nodes are added in reverse
+         #    preorder so that, if labels repeat, the first node is used
+         labeled = np.nonzero(self.labelId != NO_NODE)[0][::-1]
+         self._labelIndex = dict((self.labels[i], node) for i, node in \
+                                    zip(self.labelId[labeled].tolist(), 
+                                        labeled.tolist()))
+      return np.array([self._labelIndex.get(label, NO_NODE) \
+                                          for label in labels], dtype=np.int32)
+
+   # .........................................
+   def depths(self):
+      """
+      @summary: Returns the number of branches between each node and the root
+      """
+      if self._depths is None:
+         self._depths = _sumToRoot(self.parent, 
+                           (self.parent != NO_NODE).astype(np.int64))
+      return self._depths
+
+   # .........................................
+   def distancesFromRoot(self):
+      """
+      @summary: Returns the sum of the branch lengths between each node and
+                   the root.  Missing branch lengths count as zero
+      """
+      lengths = np.where(np.isnan(self.branchLength), 0.0, self.branchLength)
+      lengths[self.parent == NO_NODE] = 0.0
+      return _sumToRoot(self.parent, lengths)
+
+   # .........................................
+   def cladeSizes(self):
+      """
+      @summary: Returns the number of nodes in the clade of each node, 
+                   including itself.  The clade of node i is the nodes 
+                   i to i + cladeSizes()[i] - 1
+      """
+      return self._sumToParents(np.ones(len(self.parent), dtype=np.int64))
+
+   # .........................................
+   def tipCounts(self):
+      """
+      @summary: Returns the number of tips in the clade of each node
+      """
+      return self._sumToParents(self.isTip().astype(np.int64))
+
+   # .........................................
+   def children(self):
+      """
+      @summary: Returns the children of every node in compressed form
+      @return: A tuple of (offsets, childIndices).  The children of node i
+                  are childIndices[offsets[i]:offsets[i + 1]], in preorder
+      """
+      hasParent = np.nonzero(self.parent != NO_NODE)[0]
+      order = hasParent[np.argsort(self.parent[hasParent], kind='mergesort')]
+      counts = np.bincount(self.parent[hasParent], 
+                           minlength=len(self.parent))
+      offsets = np.zeros(len(self.parent) + 1, dtype=np.int64)
+      np.cumsum(counts, out=offsets[1:])
+      return offsets, order.astype(np.int32)
+
+   # .........................................
+   def subtree(self, nodes):
+      """
+      @summary: Returns the tree formed by a subset of the nodes
+      @param nodes: A boolean mask or array of node indices to keep.  The
+                       parent of each kept node must also be kept, except for 
+                       the new root
+      @rtype: CompactTree
+      """
+      keep = np.zeros(len(self.parent), dtype=bool)
+      keep[nodes] = True
+      newIndex = np.cumsum(keep) - 1
+      kept = np.nonzero(keep)[0]
+      parent = self.parent[kept]
+      hasParent = parent != NO_NODE
+      hasParent[hasParent] = keep[parent[hasParent]]
+      newParent = np.full(len(kept), NO_NODE, dtype=np.int32)
+      newParent[hasParent] = newIndex[parent[hasParent]]
+      if np.count_nonzero(newParent == NO_NODE) > 1:
+         raise Exception("Subtree nodes are not connected")
+      return CompactTree(newParent, self.branchLength[kept], 
+                         self.labelId[kept], self.labels)
+
+   # .........................................
+   def prune(self, tips, collapse=True):
+      """
+      @summary: Returns the tree connecting a subset of the tips
+      @param tips: An array of the node indices of the tips to keep
+      @param collapse: (optional) If True, nodes left with a single child are
+                          removed and their branch length is added to the 
+                          child's, so the result is a proper tree
+      @rtype: CompactTree
+      @note: A requested node may be an ancestor of another requested node,
+                such as a labeled clade and one of its tips.  It is kept, 
+                with its label, even if it is left with a single child
+      @note: The kept nodes are marked one depth level at a time, so the work
+                is proportional to the size of the result and the depth of 
+                the tree, not the size of the tree
+      """
+      keep = np.zeros(len(self.parent), dtype=bool)
+      frontier = np.unique(np.asarray(tips, dtype=np.int64))
+      if len(frontier) == 0:
+         raise Exception("No tips to keep")
+      keep[frontier] = True
+      requested = keep.copy()
+      while len(frontier) > 0:
+         frontier = self.parent[frontier]
+         frontier = np.unique(frontier[frontier != NO_NODE])
+         frontier = frontier[~keep[frontier]]
+         keep[frontier] = True
+      tree = self.subtree(keep)
+      if collapse:
+         tree = tree._collapseUnary(requested[keep])
+      return tree
+
+   # .........................................
+   def _collapseUnary(self, protected=None):
+      """
+      @summary: Returns the tree without the nodes that have exactly one child
+      @param protected: (optional) A boolean mask of nodes to keep even if 
+                           they have one child
+      """
+      numNodes = len(self.parent)
+      hasParent = self.parent != NO_NODE
+      numChildren = np.bincount(self.parent[hasParent], minlength=numNodes)
+      unary = numChildren == 1
+      if protected is not None:
+         unary &= ~protected
+      if not unary.any():
+         return self
+      
+      parent = self.parent.astype(np.int64)
+      lengths = self.branchLength.copy()
+      # Move each node's parent up past unary nodes, adding their lengths
+      active = np.nonzero(hasParent)[0]
+      active = active[unary[parent[active]]]
+      while len(active) > 0:
+         up = parent[active]
+         lengths[active] = _addLengths(lengths[active], self.branchLength[up])
+         parent[active] = self.parent[up]
+         active = active[parent[active] != NO_NODE]
+         active = active[unary[parent[active]]]
+      
+      kept = np.nonzero(~unary)[0]
+      newIndex = np.cumsum(~unary) - 1
+      newParent = np.where(parent[kept] == NO_NODE, NO_NODE, 
+                           newIndex[np.maximum(parent[kept], 0)])
+      return CompactTree(newParent, lengths[kept], self.labelId[kept], 
+                         self.labels)
+
+   # .........................................
+   def _sumToParents(self, values):
+      """
+      @summary: Returns, for each node, the sum of values over its clade
+      @note: Nodes are processed one depth level at a time, from the deepest,
+                so the work per level is vectorized
+      """
+      totals = values.copy()
+      depths = self.depths()
+      order = np.argsort(depths, kind='mergesort')
+      bounds = np.searchsorted(depths[order], np.arange(depths.max() + 2))
+      for level in xrange(depths.max(), 0, -1):
+         nodes = order[bounds[level]:bounds[level + 1]]
+         np.add.at(totals, self.parent[nodes], totals[nodes])
+      return totals
+
+# .............................................................................
+def iterJTree(tree, matrixIndices=None, bufferSize=1000):
+   """
+   @summary: Serializes a tree in the Lifemapper JSON tree (jTree) format, a
+                piece at a time
+   @param tree: A CompactTree
+   @param matrixIndices: (optional) An array with the PAM column index of each
+                            node, or NO_NODE.  Tips with an index are written 
+                            with an 'mx' attribute
+   @param bufferSize: (optional) The number of nodes in each piece
+   @return: A generator of strings that together make the JSON document
+   @note: Each node is written as {"pathId": <preorder index>, "name": <label>,
+             "length": <branch length>, "mx": <column>, "children": [...]}.
+             Missing names, lengths and columns are omitted
+   @note: The nodes are written in preorder, directly from the arrays, so no
+             nested objects are built and the whole document is never held in
+             memory
+   """
+   depths = tree.depths()
+   pieces = []
+   current = -1
+   for node in xrange(len(tree)):
+      depth = depths[node]
+      if depth <= current:
+         pieces.append(']}' * (current - depth + 1))
+         pieces.append(',')
+      current = depth
+      pieces.append('{"%s": %d' % (JTREE_PATH_ID, node))
+      label = tree.getLabel(node)
+      if label is not None:
+         pieces.append(', "%s": %s' % (JTREE_NAME, json.dumps(label)))
+      length = tree.branchLength[node]
+      if not np.isnan(length):
+         pieces.append(', "%s": %r' % (JTREE_LENGTH, float(length)))
+      if matrixIndices is not None and matrixIndices[node] != NO_NODE:
+         pieces.append(', "%s": %d' % (JTREE_MATRIX_INDEX, 
+                                       matrixIndices[node]))
+      pieces.append(', "%s": [' % JTREE_CHILDREN)
+      if (node + 1) % bufferSize == 0:
+         yield ''.join(pieces)
+         pieces = []
+   pieces.append(']}' * (current + 1))
+   yield ''.join(pieces)
+
+# .............................................................................
+def writeJTree(tree, outF, matrixIndices=None):
+   """
+   @summary: Writes a tree in the Lifemapper JSON tree format.  See iterJTree
+   @param tree: A CompactTree
+   @param outF: A file-like object to write to
+   @param matrixIndices: (optional) The PAM column index of each node
+   """
+   for piece in iterJTree(tree, matrixIndices=matrixIndices):
+      outF.write(piece)
+
+# .............................................................................
+def iterNewickTokens(source, chunkSize=NEWICK_CHUNK_SIZE):
+   """
+   @summary: Splits Newick text into tokens without reading it all at once
+   @param source: A Newick string, or a file-like object to read it from
+   @param chunkSize: (optional) The number of characters to read at a time
+   @return: A generator of (kind, value) tuples, where kind is 'label' for
+               labels and numbers, or 'punct' for one of '(),:;'.  Quoted
+               labels are unquoted
+   """
+   for tokens in _iterTokenLists(source, chunkSize):
+      for token in tokens:
+         if token in NEWICK_PUNCT:
+            yield 'punct', token
+         else:
+            yield 'label', _labelText(token)
+
+# .............................................................................
+def parseNewick(source, chunkSize=NEWICK_CHUNK_SIZE):
+   """
+   @summary: Parses a Newick tree into a CompactTree without recursion
+   @param source: A Newick string, or a file-like object to read it from
+   @param chunkSize: (optional) The number of characters to read at a time
+                        from a file
+   @rtype: CompactTree
+   @note: Only the first tree is read if there are several
+   @note: Labels are kept as written, except that quoted labels are unquoted
+   """
+   parent = array('i')
+   branchLength = array('d')
+   labelId = array('i')
+   labels = []
+   nan = float('nan')
+   stack = []
+   # The node that a following label or branch length belongs to
+   last = None
+   expectLength = False
+
+   for value in chain.from_iterable(_iterTokenLists(source, chunkSize)):
+      if value not in NEWICK_PUNCT:
+         if expectLength:
+            try:
+               branchLength[last] = float(value)
+            except (TypeError, ValueError):
+               raise Exception("Invalid branch length: %s" % value)
+            expectLength = False
+         else:
+            if last is None:
+               last = len(parent)
+               parent.append(stack[-1] if stack else NO_NODE)
+               branchLength.append(nan)
+               labelId.append(NO_NODE)
+            elif labelId[last] != NO_NODE:
+               raise Exception("Unexpected label: %s" % value)
+            labelId[last] = len(labels)
+            labels.append(_labelText(value))
+         continue
+
+      if value in ',):' and last is None:
+         # An empty tip, as in '(,A)' or '(:1,:2)'
+         last = len(parent)
+         parent.append(stack[-1] if stack else NO_NODE)
+         branchLength.append(nan)
+         labelId.append(NO_NODE)
+      if value == '(':
+         if last is not None:
+            raise Exception("Unexpected '(' after node %s" % last)
+         stack.append(len(parent))
+         parent.append(stack[-2] if len(stack) > 1 else NO_NODE)
+         branchLength.append(nan)
+         labelId.append(NO_NODE)
+      elif value == ',':
+         if not stack:
+            raise Exception("Unexpected ',' outside of parentheses")
+         last = None
+      elif value == ')':
+         if not stack:
+            raise Exception("Unbalanced ')' in Newick")
+         last = stack.pop()
+      elif value == ':':
+         expectLength = True
+      elif value == ';':
+         break
+   if stack:
+      raise Exception("Unbalanced '(' in Newick")
+   if len(parent) == 0:
+      raise Exception("Newick tree is empty")
+
+   return CompactTree(_toNumpy(parent), _toNumpy(branchLength), 
+                      _toNumpy(labelId), labels)
+
+# =============================================================================
+# =                             Helper Functions                              =
+# =============================================================================
+# .............................................................................
+def _sumToRoot(parent, values):
+   """
+   @summary: Returns, for each node, the sum of values over the node and its
+                ancestors
+   @note: Uses pointer jumping, so the number of vectorized steps grows with
+             the logarithm of the depth of the tree rather than the depth
+   """
+   totals = np.array(values)
+   ancestor = parent.astype(np.int64)
+   # totals[i] holds the sum from i up to, but not including, ancestor[i]
+   active = np.nonzero(ancestor != NO_NODE)[0]
+   while len(active) > 0:
+      anc = ancestor[active]
+      totals[active] = totals[active] + totals[anc]
+      ancestor[active] = ancestor[anc]
+      active = active[ancestor[active] != NO_NODE]
+   return totals
+
+# .............................................................................
+def _iterTokenLists(source, chunkSize):
+   """
+   @summary: Reads Newick text a chunk at a time and yields the list of tokens
+                in each chunk.  Tokens are strings; a string in NEWICK_PUNCT
+                is punctuation and anything else is a label
+   @note: Stretches of text without quotes or comments, which is nearly all of
+             a typical tree, are split with string methods.  Only quoted
+             labels and comments are matched a token at a time
+   """
+   if isinstance(source, basestring):
+      buf = source
+      eof = True
+   else:
+      buf = ''
+      eof = False
+   pos = 0
+   while True:
+      if not eof:
+         chunk = source.read(chunkSize)
+         eof = len(chunk) == 0
+         buf = buf[pos:] + chunk
+         pos = 0
+      tokens = []
+      pos = _tokenize(buf, pos, eof, tokens)
+      yield tokens
+      if eof:
+         if buf[pos:].strip() != '':
+            raise Exception("Invalid Newick near: %s" % buf[pos:pos + 50])
+         return
+
+# .............................................................................
+def _tokenize(buf, pos, eof, tokens):
+   """
+   @summary: Appends the tokens in buf, from pos, to tokens
+   @param eof: True if buf holds the end of the text.  Otherwise a token that
+                  may continue in the next chunk is left unread
+   @return: The position of the first character not read
+   """
+   end = len(buf)
+   while pos < end:
+      special = min([i for i in (buf.find("'", pos), buf.find('[', pos)) \
+                                                            if i != -1] or [end])
+      if special > pos:
+         stop = special
+         if special == end and not eof:
+            # The last label may continue in the next chunk
+            stop = max([buf.rfind(c, pos, end) for c in '(),:;']) + 1
+            if stop <= pos:
+               return pos
+         text = buf[pos:stop]
+         for c in NEWICK_PUNCT:
+            text = text.replace(c, ' %s ' % c)
+         tokens.extend(text.split())
+         pos = stop
+         if stop < special:
+            return pos
+      else:
+         m = NEWICK_TOKEN_RE.match(buf, pos)
+         # A quoted label may continue with an escaped quote, so a character
+         #    other than a quote must follow it
+         if m is None or (not eof and (m.end() >= end - 1 or \
+                                                   buf[m.end()] == "'")):
+            return pos
+         pos = m.end()
+         quoted, punct, unquoted = m.groups()
+         if quoted is not None:
+            label = quoted[1:-1].replace("''", "'")
+            if label in NEWICK_PUNCT:
+               label = _QuotedLabel(label)
+            tokens.append(label)
+         else:
+            tokens.append(punct or unquoted)
+   return pos
+
+# .............................................................................
+class _QuotedLabel(object):
+   """
+   @summary: Holds a quoted label that is a punctuation character, so that it
+                is not mistaken for punctuation in a token list
+   """
+   def __init__(self, text):
+      self.text = text
+
+# .............................................................................
+def _labelText(token):
+   """
+   @summary: Returns the text of a label token
+   """
+   if isinstance(token, _QuotedLabel):
+      return token.text
+   return token
+
+# .............................................................................
+def _addLengths(a, b):
+   """
+   @summary: Adds two arrays of branch lengths.  A missing (NaN) length counts
+                as zero unless both are missing
+   """
+   return np.where(np.isnan(a), b, np.where(np.isnan(b), a, a + b))
+
+# .............................................................................
+def _toNumpy(arr):
+   """
+   @summary: Copies an array.array into a NumPy array without converting each
+                item to a Python object
+   """
+   return np.frombuffer(arr, dtype='%s%d' % (arr.typecode == 'd' and 'f' or 'i',
+                                             arr.itemsize)).copy()
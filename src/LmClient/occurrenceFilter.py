@@ -0,0 +1,170 @@
+"""
+@summary: Module containing functions for cleaning and spatially thinning
+             occurrence points before they are uploaded to Lifemapper
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+
+@note: Requires NumPy
+@note: Example, clean a file and post the result:
+          cleanOccurrenceCsv('points.csv', 'clean.csv', gridSize=0.1)
+          sdmClient.postOccurrenceSet('My species', 'csv', 'clean.csv')
+"""
+from collections import namedtuple
+import csv
+
+import numpy as np
+
+# .............................................................................
+## Counts of points removed by each stage of cleaning
+CleaningSummary = namedtuple('CleaningSummary', ['numRead', 'numInvalid',
+                                                 'numDuplicate', 'numThinned',
+                                                 'numWritten'])
+
+# .............................................................................
+def cleanPoints(lats, lons, gridSize=None):
+   """
+   @summary: Determines which points to keep after removing invalid points,
+                exact duplicates and, optionally, all but one point in each
+                grid cell
+   @param lats: A NumPy array of latitudes.  Unparseable values should be NaN
+   @param lons: A NumPy array of longitudes.  Unparseable values should be NaN
+   @param gridSize: (optional) If provided, keep only the first point in each
+                       grid cell of this size, in decimal degrees
+   @return: A tuple of (boolean mask of points to keep, CleaningSummary)
+   @note: Where points are removed as duplicates or by thinning, the first
+             point in input order is the one kept
+   """
+   lats = np.asarray(lats, dtype=np.float64)
+   lons = np.asarray(lons, dtype=np.float64)
+   numRead = lats.shape[0]
+
+   # NaN fails every comparison so it is dropped here too
+   valid = (lats >= -90.0) & (lats <= 90.0) & (lons >= -180.0) & \
+               (lons <= 180.0) & ~((lats == 0.0) & (lons == 0.0))
+   idxs = np.flatnonzero(valid)
+   numInvalid = numRead - idxs.shape[0]
+
+   # np.unique returns the index of the first occurrence of each key
+   _, firstIdxs = np.unique(lons[idxs] + 1j * lats[idxs], return_index=True)
+   numDuplicate = idxs.shape[0] - firstIdxs.shape[0]
+   idxs = idxs[np.sort(firstIdxs)]
+
+   numThinned = 0
+   if gridSize is not None:
+      numCols = int(np.ceil(360.0 / gridSize)) + 1
+      cols = np.floor((lons[idxs] + 180.0) / gridSize).astype(np.int64)
+      rows = np.floor((lats[idxs] + 90.0) / gridSize).astype(np.int64)
+      _, firstIdxs = np.unique(rows * numCols + cols, return_index=True)
+      numThinned = idxs.shape[0] - firstIdxs.shape[0]
+      idxs = idxs[np.sort(firstIdxs)]
+
+   keep = np.zeros(numRead, dtype=np.bool_)
+   keep[idxs] = True
+   return keep, CleaningSummary(numRead, numInvalid, numDuplicate, numThinned,
+                                idxs.shape[0])
+
+# .............................................................................
+def cleanOccurrenceCsv(inFileName, outFileName, latField="latitude",
+                       lonField="longitude", gridSize=None, fields=None):
+   """
+   @summary: Writes a cleaned copy of an occurrence CSV file
+   @param inFileName: The CSV file to clean.  The first row must be a header
+   @param outFileName: The file location to write the cleaned CSV to
+   @param latField: (optional) The header of the latitude column
+   @param lonField: (optional) The header of the longitude column
+   @param gridSize: (optional) If provided, thin the points to one per grid
+                       cell of this size, in decimal degrees
+   @param fields: (optional) A list of column headers to write.  Use this to
+                     write a more compact file.  All columns are written if
+                     this is None
+   @rtype: CleaningSummary
+   @note: The file is read twice, once to get the coordinates and once to
+             write out the rows that are kept, so only the coordinate columns
+             are held in memory
+   @note: Rows too short to have coordinates are counted as invalid.  Kept 
+             rows that are missing later columns are written with empty values
+   """
+   with open(inFileName, 'rb') as inF:
+      reader = csv.reader(inF)
+      try:
+         header = reader.next()
+      except StopIteration:
+         raise Exception, "%s is empty, a header row is required" % inFileName
+      latIdx = header.index(latField)
+      lonIdx = header.index(lonField)
+      maxIdx = max(latIdx, lonIdx)
+      latVals = []
+      lonVals = []
+      for row in reader:
+         if len(row) > maxIdx:
+            latVals.append(row[latIdx])
+            lonVals.append(row[lonIdx])
+         else:
+            latVals.append('')
+            lonVals.append('')
+
+   keep, summary = cleanPoints(_toFloatArray(latVals), _toFloatArray(lonVals),
+                               gridSize=gridSize)
+   del latVals, lonVals
+
+   if fields is None:
+      fieldIdxs = range(len(header))
+   else:
+      fieldIdxs = [header.index(f) for f in fields]
+
+   with open(inFileName, 'rb') as inF:
+      with open(outFileName, 'wb') as outF:
+         reader = csv.reader(inF)
+         writer = csv.writer(outF)
+         writer.writerow([header[i] for i in fieldIdxs])
+         reader.next()
+         for i, row in enumerate(reader):
+            if keep[i]:
+               # Kept rows have coordinates but may be missing later columns
+               writer.writerow([row[j] if j < len(row) else '' \
+                                                         for j in fieldIdxs])
+   return summary
+
+# =============================================================================
+# =                             Helper Functions                              =
+# =============================================================================
+# .............................................................................
+def _toFloatArray(vals):
+   """
+   @summary: Converts a list of strings to a float array, using NaN for any
+                value that can't be parsed
+   @param vals: A list of strings
+   """
+   try:
+      return np.array(vals, dtype=np.float64)
+   except ValueError:
+      # Fall back to converting one at a time if any values are bad
+      arr = np.empty(len(vals), dtype=np.float64)
+      for i, v in enumerate(vals):
+         try:
+            arr[i] = float(v)
+         except ValueError:
+            arr[i] = np.nan
+      return arr
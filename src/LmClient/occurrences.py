@@ -0,0 +1,107 @@
+"""
+@summary: Module containing functions for preparing local occurrence data
+             files before they are uploaded to Lifemapper
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+"""
+import csv
+import os
+import re
+
+# Number of rows held in memory before spooled rows are flushed to disk
+DEFAULT_MAX_BUFFERED_ROWS = 100000
+
+# .............................................................................
+def splitOccurrenceCsv(csvFileName, outDir, groupField="canonicalName",
+                       maxBufferedRows=DEFAULT_MAX_BUFFERED_ROWS):
+   """
+   @summary: Splits a CSV file of occurrence points for many taxa into one CSV
+                file per taxon
+   @param csvFileName: The CSV file to split.  The first row must be a header
+   @param outDir: The directory to write the output files to.  It must exist
+   @param groupField: (optional) The header of the column used to group rows
+   @param maxBufferedRows: (optional) The maximum number of rows held in
+                              memory before they are appended to the output
+                              files
+   @return: A dictionary of group value to output file name
+   @note: The input is read once and does not need to be sorted.  Memory use
+             is bounded by maxBufferedRows, regardless of the size of the
+             input or the number of groups, because output files are only
+             opened when buffered rows are flushed
+   """
+   fileNames = {}
+   buffers = {}
+   numBuffered = 0
+
+   with open(csvFileName, 'rb') as inF:
+      reader = csv.reader(inF)
+      try:
+         header = reader.next()
+      except StopIteration:
+         raise Exception, "%s is empty, a header row is required" % csvFileName
+      try:
+         groupIdx = header.index(groupField)
+      except ValueError:
+         raise Exception, "Column %s not found in %s" % (groupField,
+                                                         csvFileName)
+
+      for row in reader:
+         if len(row) <= groupIdx:
+            continue # Skip blank or truncated rows
+         name = row[groupIdx].strip()
+         if not buffers.has_key(name):
+            buffers[name] = []
+         buffers[name].append(row)
+         numBuffered += 1
+         if numBuffered >= maxBufferedRows:
+            _flushBuffers(buffers, fileNames, header, outDir)
+            numBuffered = 0
+   _flushBuffers(buffers, fileNames, header, outDir)
+   return fileNames
+
+# =============================================================================
+# =                             Helper Functions                              =
+# =============================================================================
+# .............................................................................
+def _flushBuffers(buffers, fileNames, header, outDir):
+   """
+   @summary: Appends buffered rows to the output file for each group and
+                empties the buffers
+   @param buffers: Dictionary of group value to a list of buffered rows
+   @param fileNames: Dictionary of group value to output file name.  New
+                        groups are added to it
+   @param header: The header row to write at the start of each new file
+   @param outDir: The directory to write new files to
+   """
+   for name, rows in buffers.iteritems():
+      if not fileNames.has_key(name):
+         safeName = re.sub(r'[^\w.-]+', '_', name)[:100]
+         fn = os.path.join(outDir, "%s_%d.csv" % (safeName, len(fileNames)))
+         fileNames[name] = fn
+         with open(fn, 'wb') as outF:
+            csv.writer(outF).writerow(header)
+      with open(fileNames[name], 'ab') as outF:
+         csv.writer(outF).writerows(rows)
+   buffers.clear()
@@ -0,0 +1,298 @@
+"""
+@summary: Module containing functions for requesting Lifemapper data through
+             the OGC (WCS and WMS) interface of each object
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+
+@note: Mosaicking tiles and returning arrays require NumPy and the GDAL
+          Python bindings.  They are imported only when needed, so single
+          window downloads work without them
+"""
+import math
+import os
+import shutil
+import tempfile
+import urlparse
+
+from LmClient.batch import DEFAULT_NUM_THREADS, iterConcurrently
+
+# The maximum width or height, in pixels, of a single WCS request.  Larger
+#    windows are split into tiles of this size
+DEFAULT_TILE_PIXELS = 2048
+
+# The width and height of a map tile in pixels
+TILE_SIZE = 256
+
+# Half the width of the web mercator (EPSG:3857) world, in meters
+WEB_MERCATOR_EXTENT = 20037508.342789244
+
+# The byte strings that start a TIFF file
+TIFF_MAGIC = ('II*\x00', 'MM\x00*')
+
+# .............................................................................
+def getOgcBaseUrl(obj):
+   """
+   @summary: Returns the OGC service url of a Lifemapper object, without query
+                parameters
+   @param obj: A full Lifemapper object, such as a projection
+   """
+   return "%s/ogc" % obj.metadataUrl
+
+# .............................................................................
+def getCoverageParameters(layerName, bbox, width, height, epsgCode=4326,
+                          frmt='GTiff'):
+   """
+   @summary: Returns the query parameters for a WCS 1.0.0 GetCoverage request
+   @param layerName: The name of the coverage, the 'mapLayername' of an object
+   @param bbox: The (minX, minY, maxX, maxY) window to request
+   @param width: The width of the response in pixels
+   @param height: The height of the response in pixels
+   @param epsgCode: (optional) The EPSG code of the bbox and the response
+   @param frmt: (optional) The format of the response
+   @return: A list of (name, value) tuples
+   """
+   return [('service', 'WCS'),
+           ('version', '1.0.0'),
+           ('request', 'GetCoverage'),
+           ('coverage', layerName),
+           ('crs', 'EPSG:%s' % epsgCode),
+           ('bbox', ','.join([repr(float(v)) for v in bbox])),
+           ('width', int(width)),
+           ('height', int(height)),
+           ('format', frmt)]
+
+# .............................................................................
+def getCoverage(cl, obj, bbox, filename=None, resolution=None, epsgCode=None,
+                tilePixels=DEFAULT_TILE_PIXELS, numThreads=DEFAULT_NUM_THREADS):
+   """
+   @summary: Downloads a window of a raster object as a GeoTIFF through its
+                WCS interface
+   @param cl: A Lifemapper _Client object to make requests with
+   @param obj: A full Lifemapper raster object, such as a projection
+   @param bbox: The (minX, minY, maxX, maxY) window to download
+   @param filename: (optional) The GeoTIFF file to write.  If None, the
+                       window is returned as a NumPy array
+   @param resolution: (optional) The cell size of the output.  Defaults to
+                         the resolution of the object
+   @param epsgCode: (optional) The EPSG code of the bbox.  Defaults to that
+                       of the object
+   @param tilePixels: (optional) The maximum width or height of one request.
+                         Larger windows are requested as tiles, concurrently,
+                         and mosaicked
+   @param numThreads: (optional) The maximum number of tiles to request at
+                         the same time
+   @return: filename, or a NumPy array if filename is None
+   @note: The output grid starts at the top left corner of the bbox.  The
+             bbox is extended to a whole number of cells if needed
+   """
+   if resolution is None:
+      try:
+         resolution = float(obj.resolution)
+      except Exception:
+         raise Exception("A resolution is required for object %s" % obj.id)
+   if epsgCode is None:
+      epsgCode = getattr(obj, 'epsgcode', 4326)
+   minX, minY, maxX, maxY = [float(v) for v in bbox]
+   # Round up so the grid covers the bbox.  The small tolerance keeps a bbox
+   #    that is a whole number of cells, give or take floating point error,
+   #    from gaining a cell
+   numCols = max(1, int(math.ceil((maxX - minX) / resolution - 1e-6)))
+   numRows = max(1, int(math.ceil((maxY - minY) / resolution - 1e-6)))
+
+   # ...............................
+   def _tileBBox(col, row, width, height):
+      return (minX + col * resolution, maxY - (row + height) * resolution,
+              minX + (col + width) * resolution, maxY - row * resolution)
+
+   workDir = tempfile.mkdtemp(prefix='lmWcs')
+   try:
+      tiles = []
+      for row in xrange(0, numRows, tilePixels):
+         for col in xrange(0, numCols, tilePixels):
+            width = min(tilePixels, numCols - col)
+            height = min(tilePixels, numRows - row)
+            tiles.append((col, row, width, height,
+                          os.path.join(workDir, "tile_%d_%d.tif" % (col, row))))
+
+      # ...............................
+      def _download(tile):
+         col, row, width, height, tileFn = tile
+         params = getCoverageParameters(obj.mapLayername,
+                                        _tileBBox(col, row, width, height),
+                                        width, height, epsgCode=epsgCode)
+         cl.downloadToFile(getOgcBaseUrl(obj), tileFn, parameters=params,
+                           resume=False)
+         _checkTiff(tileFn)
+         return tileFn
+
+      for res in iterConcurrently(_download, tiles, numThreads=numThreads):
+         if res.error is not None:
+            raise Exception("Could not download tile %s of %s: %s" % (
+                                          res.item[:4], obj.id, res.error))
+
+      if len(tiles) == 1:
+         mosaicFn = tiles[0][4]
+      else:
+         mosaicFn = os.path.join(workDir, 'mosaic.tif')
+         _mosaicTiles(tiles, mosaicFn, numCols, numRows,
+                      (minX, resolution, 0.0, maxY, 0.0, -resolution))
+
+      if filename is None:
+         from osgeo import gdal
+         ds = gdal.Open(mosaicFn)
+         arr = ds.GetRasterBand(1).ReadAsArray()
+         ds = None
+         return arr
+      shutil.move(mosaicFn, filename)
+      return filename
+   finally:
+      shutil.rmtree(workDir, ignore_errors=True)
+
+# .............................................................................
+def getMapParameters(layers, bbox, width=TILE_SIZE, height=TILE_SIZE,
+                     srs='EPSG:3857', frmt='image/png', transparent=True,
+                     styles=''):
+   """
+   @summary: Returns the query parameters for a WMS 1.1.1 GetMap request
+   @param layers: The layer names, as in the 'layers' parameter of the 
+                     endpoint returned by SDMClient.getOgcEndpoint
+   @param bbox: The (minX, minY, maxX, maxY) extent of the map
+   @param width: (optional) The width of the map in pixels
+   @param height: (optional) The height of the map in pixels
+   @param srs: (optional) The spatial reference system of the bbox and map
+   @param frmt: (optional) The image format of the map
+   @param transparent: (optional) Should areas without data be transparent
+   @param styles: (optional) The styles parameter
+   @return: A list of (name, value) tuples
+   """
+   return [('service', 'WMS'),
+           ('version', '1.1.1'),
+           ('request', 'GetMap'),
+           ('layers', layers),
+           ('styles', styles),
+           ('srs', srs),
+           ('bbox', ','.join([repr(float(v)) for v in bbox])),
+           ('width', int(width)),
+           ('height', int(height)),
+           ('format', frmt),
+           ('transparent', str(bool(transparent)).upper())]
+
+# .............................................................................
+def tileBBox(z, x, y, srs='EPSG:3857'):
+   """
+   @summary: Returns the extent of an XYZ map tile
+   @param z: The zoom level
+   @param x: The tile column, counted from the west
+   @param y: The tile row, counted from the north
+   @param srs: (optional) 'EPSG:3857' for the usual web mercator tiles, or 
+                  'EPSG:4326' for geodetic tiles, which have two tiles at 
+                  zoom level 0
+   @return: A (minX, minY, maxX, maxY) tuple in the units of srs
+   """
+   if srs == 'EPSG:3857':
+      tileSpan = 2.0 * WEB_MERCATOR_EXTENT / (2 ** z)
+      minX = -WEB_MERCATOR_EXTENT + x * tileSpan
+      maxY = WEB_MERCATOR_EXTENT - y * tileSpan
+   elif srs == 'EPSG:4326':
+      tileSpan = 180.0 / (2 ** z)
+      minX = -180.0 + x * tileSpan
+      maxY = 90.0 - y * tileSpan
+   else:
+      raise Exception("Unsupported tile srs: %s" % srs)
+   return (minX, maxY - tileSpan, minX + tileSpan, maxY)
+
+# .............................................................................
+def numTiles(z, srs='EPSG:3857'):
+   """
+   @summary: Returns the number of (columns, rows) of tiles at a zoom level
+   @param z: The zoom level
+   @param srs: (optional) See tileBBox
+   """
+   if srs == 'EPSG:4326':
+      return 2 ** (z + 1), 2 ** z
+   return 2 ** z, 2 ** z
+
+# .............................................................................
+def parseOgcEndpoint(endpoint):
+   """
+   @summary: Splits an endpoint returned by SDMClient.getOgcEndpoint into the
+                service url and the layer names
+   @param endpoint: An OGC endpoint url with a 'layers' query parameter
+   @return: A tuple of (service url, layer names)
+   """
+   base, _, query = endpoint.partition('?')
+   for name, value in urlparse.parse_qsl(query):
+      if name.lower() == 'layers':
+         return base, value
+   raise Exception("No layers parameter in OGC endpoint: %s" % endpoint)
+
+# =============================================================================
+# =                             Helper Functions                              =
+# =============================================================================
+# .............................................................................
+def _checkTiff(fn):
+   """
+   @summary: Raises an exception if a downloaded file is not a TIFF.  OGC
+                services report errors as XML documents, often with a
+                successful HTTP status
+   @param fn: The downloaded file
+   """
+   with open(fn, 'rb') as inF:
+      start = inF.read(4)
+      if start not in TIFF_MAGIC:
+         raise Exception("OGC service returned an error: %s" % (
+                                                   start + inF.read(1000)))
+
+# .............................................................................
+def _mosaicTiles(tiles, outFn, numCols, numRows, geoTransform):
+   """
+   @summary: Writes tiles into a single GeoTIFF
+   @param tiles: A list of (column, row, width, height, file name) tuples
+   @param outFn: The GeoTIFF file to write
+   @param numCols: The width of the mosaic
+   @param numRows: The height of the mosaic
+   @param geoTransform: The GDAL geotransform of the mosaic
+   @note: Only one tile is held in memory at a time
+   """
+   from osgeo import gdal
+
+   firstDs = gdal.Open(tiles[0][4])
+   firstBand = firstDs.GetRasterBand(1)
+   outDs = gdal.GetDriverByName('GTiff').Create(outFn, numCols, numRows, 1,
+                                                firstBand.DataType)
+   outDs.SetGeoTransform(geoTransform)
+   outDs.SetProjection(firstDs.GetProjection())
+   outBand = outDs.GetRasterBand(1)
+   noDataValue = firstBand.GetNoDataValue()
+   if noDataValue is not None:
+      outBand.SetNoDataValue(noDataValue)
+   firstBand = firstDs = None
+
+   for col, row, _, _, tileFn in tiles:
+      ds = gdal.Open(tileFn)
+      outBand.WriteArray(ds.GetRasterBand(1).ReadAsArray(), col, row)
+      ds = None
+   outBand.FlushCache()
+   outBand = outDs = None
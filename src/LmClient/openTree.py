@@ -26,8 +26,46 @@
           Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
           02110-1301, USA.
 
+@note: Example, resolve the species of an experiment to OTT ids, keeping the
+          results for the next run:
+          cache = OTLNameCache('otlNames.json')
+          resolved, unresolved, failures = cl.otl.resolveNames(names, 
+                                                              cache=cache)
 """
-from LmClient.constants import OTL_HINT_URL, OTL_TREE_WEB_URL
+from collections import namedtuple
+import json
+import os
+import re
+import threading
+
+from LmClient.batch import DEFAULT_NUM_THREADS, iterConcurrently, RateLimiter
+from LmClient.constants import (DOWNLOAD_CHUNK_SIZE, OTL_HINT_URL, 
+                                 OTL_MATCH_NAMES_URL, OTL_TREE_WEB_URL)
+from LmClient.downloads import writeFileAtomic
+from LmClient.hint import normalizeTaxonName
+
+# The default maximum number of requests per second made to Open Tree
+DEFAULT_OTL_REQUESTS_PER_SECOND = 10
+
+# The default number of names sent in each request to the name matching 
+#    service.  The service accepts up to 10000
+DEFAULT_OTL_NAMES_PER_REQUEST = 1000
+
+# The Open Tree ranks of taxa that are not higher taxa
+OTL_SPECIES_RANKS = frozenset(['species', 'subspecies', 'variety', 
+                               'varietas', 'forma', 'form'])
+
+# Matches the disambiguation that Open Tree adds to homonyms, such as 
+#    'Morus (genus in Opisthokonta)'
+HOMONYM_SUFFIX_RE = re.compile(r'\s*\([^)]*\)$')
+
+# Matches the id that Open Tree adds to the end of tree labels
+OTT_ID_SUFFIX_RE = re.compile(r'_ott\d+$')
+
+# .............................................................................
+## A taxon returned by the Open Tree of Life name service
+OTLMatch = namedtuple('OTLMatch', ['ottId', 'uniqueName', 'isHigher',
+                                   'isSuppressed'])
 
 # .............................................................................
 class OTLClient(object):
@@ -50,13 +88,117 @@ class OTLClient(object):
       @param taxaName: The name of the taxa to search for
       """
       url = OTL_HINT_URL
-      jsonBody = '{"name":"%s","context_name":"All life"}' % (taxaName)
+      jsonBody = json.dumps({"name" : taxaName, "context_name" : "All life"})
       res = self.cl.makeRequest(url, 
                                 method="POST", 
                                 body=jsonBody, 
                                 headers={"Content-Type": "application/json"})
       return res
       
+   # .........................................
+   def matchNames(self, names, approximate=False):
+      """
+      @summary: Calls the Open Tree of Life name matching service with a list
+                   of taxon names
+      @param names: A list of taxon names
+      @param approximate: (optional) If True, the service also returns fuzzy
+                             matches
+      @return: The JSON response.  See parseOTLMatchNames
+      """
+      jsonBody = json.dumps({"names" : list(names), 
+                             "context_name" : "All life",
+                             "do_approximate_matching" : approximate})
+      return self.cl.makeRequest(OTL_MATCH_NAMES_URL, 
+                                 method="POST", 
+                                 body=jsonBody, 
+                                 headers={"Content-Type": "application/json"})
+
+   # .........................................
+   def resolveNames(self, names, cache=None, exact=True, 
+                          numThreads=DEFAULT_NUM_THREADS,
+                          maxPerSecond=DEFAULT_OTL_REQUESTS_PER_SECOND,
+                          namesPerRequest=DEFAULT_OTL_NAMES_PER_REQUEST):
+      """
+      @summary: Finds the Open Tree taxa for many names
+      @param names: An iterable of taxon names
+      @param cache: (optional) An OTLNameCache.  Names in it are not 
+                       requested, and the names that are requested are added
+                       to it and saved
+      @param exact: (optional) If True, only taxa whose name equals the name 
+                       asked for are returned.  Otherwise approximate matching
+                       is used and every taxon matched by the service is 
+                       returned
+      @param numThreads: (optional) The maximum number of requests at once
+      @param maxPerSecond: (optional) The maximum number of requests per 
+                              second.  If None, requests are not limited
+      @param namesPerRequest: (optional) The number of names sent to the name
+                                 matching service in each request
+      @return: A tuple of (dictionary of name to a list of OTLMatch named 
+                  tuples, list of names without a match, dictionary of name to
+                  the exception raised for names whose request failed)
+      @note: Names are normalized and duplicates are requested once.  The
+                results are keyed by the names as given
+      @note: Names are requested in the order given, namesPerRequest at a
+                time.  If a request fails, every name in it is a failure
+      """
+      byNormalized = {}
+      normNames = []
+      for name in names:
+         normName = normalizeTaxonName(name)
+         if not byNormalized.has_key(normName):
+            byNormalized[normName] = []
+            normNames.append(normName)
+         byNormalized[normName].append(name)
+      toRequest = []
+      matches = {}
+      for normName in normNames:
+         cached = cache.get(normName) if cache is not None else None
+         if cached is None:
+            toRequest.append(normName)
+         else:
+            matches[normName] = cached
+      
+      # .......................
+      def _matchBatch(batch):
+         found = {}
+         for name, nameMatches in parseOTLMatchNames(
+                 self.matchNames(batch, approximate=not exact)).iteritems():
+            found.setdefault(normalizeTaxonName(name), []).extend(nameMatches)
+         return [found.get(_cacheKey(n), []) for n in batch]
+      
+      batches = [toRequest[i:i + namesPerRequest] \
+                           for i in xrange(0, len(toRequest), namesPerRequest)]
+      failures = {}
+      try:
+         for res in iterConcurrently(_matchBatch, batches, 
+                                     numThreads=numThreads, 
+                                     rateLimiter=RateLimiter(maxPerSecond)):
+            for i, normName in enumerate(res.item):
+               if res.error is None:
+                  matches[normName] = res.result[i]
+                  if cache is not None:
+                     cache.put(normName, res.result[i])
+               else:
+                  for name in byNormalized[normName]:
+                     failures[name] = res.error
+      finally:
+         if cache is not None and len(toRequest) > 0:
+            cache.save()
+      
+      resolved = {}
+      unresolved = []
+      for normName, found in matches.iteritems():
+         if exact:
+            key = _cacheKey(normName)
+            found = [m for m in found if normalizeTaxonName(
+                        HOMONYM_SUFFIX_RE.sub('', m.uniqueName)) == key]
+         for name in byNormalized[normName]:
+            if len(found) > 0:
+               resolved[name] = found
+            else:
+               unresolved.append(name)
+      return resolved, unresolved, failures
+      
    # .........................................
    def getOTLTreeWeb(self, otlTID):
       """
@@ -65,9 +207,264 @@ class OTLClient(object):
       @param otlTID: Open Tree of Life tree idopen tree tree id
       """
       url = OTL_TREE_WEB_URL
-      jsonBody = '{"ott_id":"%s"}' % (otlTID)
       res = self.cl.makeRequest(url, 
                                 method="POST", 
-                                body=jsonBody, 
+                                body=_getTreeBody(otlTID), 
                                 headers={"Content-Type": "application/json"})
       return res
+
+   # .........................................
+   def getOTLTree(self, otlTID):
+      """
+      @summary: Calls the Open Tree of Life tree service with an OTL tree id
+                   and returns the tree as a CompactTree
+      @param otlTID: Open Tree of Life tree id
+      @rtype: LmClient.newick.CompactTree
+      @note: The response is parsed as it is read, so neither it nor the 
+                Newick string is held in memory.  Labels are UTF-8 byte 
+                strings
+      @note: Requires NumPy
+      """
+      from LmClient.newick import parseNewick
+      
+      ret = self.cl.openRequest(OTL_TREE_WEB_URL, 
+                                method="POST", 
+                                body=_getTreeBody(otlTID), 
+                                headers={"Content-Type": "application/json"})
+      try:
+         return parseNewick(_NewickResponseReader(ret))
+      finally:
+         ret.close()
+
+# .............................................................................
+class OTLNameCache(object):
+   """
+   @summary: A JSON file of the Open Tree taxa found for each name, so that
+                names are only requested once
+   @note: Names without any match are cached too.  Remove the file, or use
+             clear, to request everything again
+   """
+   # .........................................
+   def __init__(self, cacheFile):
+      """
+      @summary: Constructor
+      @param cacheFile: The JSON file to keep the cache in.  It is read if it
+                           exists
+      """
+      self.cacheFile = cacheFile
+      self._lock = threading.Lock()
+      self._entries = {}
+      if os.path.exists(cacheFile):
+         with open(cacheFile) as inF:
+            self._entries = json.load(inF)
+
+   # .........................................
+   def get(self, name):
+      """
+      @summary: Returns the list of OTLMatch named tuples for a normalized
+                   name, or None if it is not cached
+      @note: Byte string names are taken to be UTF-8 and match the same 
+                unicode name
+      """
+      with self._lock:
+         entry = self._entries.get(_cacheKey(name))
+      if entry is None:
+         return None
+      return [OTLMatch(*m) for m in entry]
+
+   # .........................................
+   def put(self, name, matches):
+      """
+      @summary: Stores the matches for a normalized name.  Call save to write
+                   them to the cache file
+      """
+      with self._lock:
+         self._entries[_cacheKey(name)] = [list(m) for m in matches]
+
+   # .........................................
+   def clear(self):
+      """
+      @summary: Removes every cached name
+      """
+      with self._lock:
+         self._entries = {}
+
+   # .........................................
+   def save(self):
+      """
+      @summary: Writes the cache file.  A temporary file is written and 
+                   renamed so the cache is never left partially written
+      """
+      with self._lock:
+         content = json.dumps(self._entries)
+      writeFileAtomic(self.cacheFile, content)
+
+   # .........................................
+   def __len__(self):
+      return len(self._entries)
+
+# .............................................................................
+def otlLabelName(label):
+   """
+   @summary: Returns the taxon name of an Open Tree tip label, such as 
+                'Acacia_dealbata_ott123', normalized with normalizeTaxonName.
+                Returns None for labels without a name
+   """
+   if label is None:
+      return None
+   return normalizeTaxonName(OTT_ID_SUFFIX_RE.sub('', label))
+
+# .............................................................................
+def parseOTLHint(content):
+   """
+   @summary: Parses the JSON returned by the Open Tree name service
+   @param content: The response of OTLClient.getOTLHint
+   @return: A list of OTLMatch named tuples
+   """
+   return [OTLMatch(ottId=int(item['ott_id']), 
+                    uniqueName=item.get('unique_name'),
+                    isHigher=item.get('is_higher', False),
+                    isSuppressed=item.get('is_suppressed', False)) \
+                                             for item in json.loads(content)]
+
+# .............................................................................
+def parseOTLMatchNames(content):
+   """
+   @summary: Parses the JSON returned by the Open Tree name matching service
+   @param content: The response of OTLClient.matchNames
+   @return: A dictionary of each name asked for, as unicode, to a list of 
+               OTLMatch named tuples.  Names without a match are not included
+   """
+   found = {}
+   for result in json.loads(content).get('results', []):
+      for match in result.get('matches', []):
+         name = result.get('name', match.get('search_string'))
+         taxon = match['taxon']
+         found.setdefault(name, []).append(OTLMatch(
+                  ottId=int(taxon['ott_id']),
+                  uniqueName=taxon.get('unique_name'),
+                  isHigher=taxon.get('rank') not in OTL_SPECIES_RANKS,
+                  isSuppressed=taxon.get('is_suppressed', False)))
+   return found
+
+# =============================================================================
+# =                             Helper Functions                              =
+# =============================================================================
+# .............................................................................
+def _cacheKey(name):
+   """
+   @summary: Returns a name as unicode, the type of the names read from JSON
+   """
+   if isinstance(name, str):
+      return name.decode('utf-8')
+   return name
+
+# .............................................................................
+def _getTreeBody(otlTID):
+   """
+   @summary: Returns the JSON request body for the tree service
+   """
+   return json.dumps({"ott_id" : "%s" % otlTID})
+
+# .............................................................................
+class _NewickResponseReader(object):
+   """
+   @summary: A file-like object that reads the Newick string of a tree 
+                service response.  If the response is a JSON object, the 
+                value of its 'newick' member is read and unescaped a chunk at 
+                a time.  Otherwise, the response is read as it is
+   @note: Only read(n) is supported, as used by LmClient.newick.parseNewick
+   """
+   # .........................................
+   def __init__(self, inF, key='newick', chunkSize=DOWNLOAD_CHUNK_SIZE):
+      self.inF = inF
+      self.chunkSize = chunkSize
+      self._buf = ''
+      self._done = False
+      self._isJson = False
+      
+      while self._buf.strip() == '':
+         chunk = inF.read(chunkSize)
+         if not chunk:
+            return
+         self._buf += chunk
+      if not self._buf.lstrip().startswith('{'):
+         return
+      
+      # Skip to the opening quote of the value
+      self._isJson = True
+      keyPattern = re.compile(r'"%s"\s*:\s*"' % re.escape(key))
+      while True:
+         match = keyPattern.search(self._buf)
+         if match is not None:
+            self._buf = self._buf[match.end():]
+            return
+         chunk = inF.read(chunkSize)
+         if not chunk:
+            raise Exception("No '%s' in Open Tree response" % key)
+         # Keep enough of the end to match a key split across chunks
+         self._buf = self._buf[-(len(key) + 100):] + chunk
+
+   # .........................................
+   def read(self, n=-1):
+      """
+      @summary: Returns up to n more characters of the Newick string, or an 
+                   empty string at the end
+      """
+      if not self._isJson:
+         data = self._buf + self.inF.read(max(n, self.chunkSize))
+         self._buf = ''
+         return data
+      if self._done:
+         return ''
+      
+      while True:
+         end = self._findClosingQuote()
+         if end >= 0:
+            raw = self._buf[:end]
+            self._buf = ''
+            self._done = True
+            return _unescapeJson(raw)
+         # Do not split an escape sequence
+         cut = self._buf.rfind('\\', max(0, len(self._buf) - 6))
+         if cut < 0 or self._isEscaped(cut):
+            cut = len(self._buf)
+         if cut > 0:
+            raw = self._buf[:cut]
+            self._buf = self._buf[cut:]
+            return _unescapeJson(raw)
+         chunk = self.inF.read(max(n, self.chunkSize))
+         if not chunk:
+            raise Exception("Unterminated Newick string in Open Tree response")
+         self._buf += chunk
+
+   # .........................................
+   def _findClosingQuote(self):
+      """
+      @summary: Returns the position of the first unescaped quote in the 
+                   buffer, or -1
+      """
+      pos = self._buf.find('"')
+      while pos >= 0 and self._isEscaped(pos):
+         pos = self._buf.find('"', pos + 1)
+      return pos
+
+   # .........................................
+   def _isEscaped(self, pos):
+      """
+      @summary: Returns True if the character at pos follows an odd number of
+                   backslashes
+      """
+      numSlashes = 0
+      while pos - numSlashes > 0 and self._buf[pos - numSlashes - 1] == '\\':
+         numSlashes += 1
+      return numSlashes % 2 == 1
+
+# .............................................................................
+def _unescapeJson(raw):
+   """
+   @summary: Returns the UTF-8 text of part of a JSON string
+   """
+   if '\\' not in raw:
+      return raw
+   return json.loads('"%s"' % raw).encode('utf-8')
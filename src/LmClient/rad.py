@@ -36,12 +36,28 @@
                 SS is the two-digit second (example 15)
             Example for June 7, 2009 9:23:15 AM - 2009-06-07T09:23:15Z
 """
+from collections import namedtuple
 import json
+import tempfile
 from types import ListType
 
 from LmClient.constants import CONTENT_TYPES
+from LmClient.hint import normalizeTaxonName
+from LmClient.openTree import otlLabelName, OTLClient
+from LmClient.rasterHeader import formatBBox, preflightRaster
+from LmClient.requestBodies import (addAncLayerBody, addBucketBody, 
+                                    addBucketByShapegridIdBody, addPALayerBody,
+                                    addTreeBody, intersectBody, 
+                                    radExperimentBody, randomizeBody,
+                                    writeAddTreeBody)
 from LmCommon.common.unicode import toUnicode
 
+# .............................................................................
+## The result of RADClient.addOTLTreeForExperiment.  'unmatched' lists the
+#  species that are not in the tree
+TreeAttachment = namedtuple('TreeAttachment', ['success', 'numTips', 
+                                               'unmatched'])
+
 # .............................................................................
 class RADClient(object):
    """
@@ -140,22 +156,8 @@ class RADClient(object):
                        experiment
       @param description: (optional) A description of the submitted experiment
       """
-      postXml = """\
-      <lmRad:request xmlns:lmRad="http://lifemapper.org"
-                        xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
-                        xsi:schemaLocation="http://lifemapper.org 
-                                               /schemas/radServiceRequest.xsd">
-            <lmRad:experiment>
-               <lmRad:name>%s</lmRad:name>
-               <lmRad:epsgCode>%s</lmRad:epsgCode>
-%s
-%s
-            </lmRad:experiment>
-         </lmRad:request>""" % (name, epsgCode,
-               "               <lmRad:description>%s</lmRad:description>" % \
-                           description if description is not None else "", 
-               "               <lmRad:email>%s</lmRad:email>" % \
-                           email if email is not None else "")
+      postXml = radExperimentBody(name, epsgCode, email=email, 
+                                  description=description)
       url = "%s/services/rad/experiments/" % self.cl.server
       obj = self.cl.makeRequest(url, 
                                 method="POST", 
@@ -280,44 +282,8 @@ class RADClient(object):
       @param bbox: The bounding box for the new bucket
       @param cutout: (optional) WKT representing the area to cut out
       """
-      postXml = """\
-<?xml version="1.0" encoding="UTF-8"?>
-<wps:Execute version="1.0.0" service="WPS" 
-             xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" 
-             xmlns="http://www.opengis.net/wps/1.0.0" 
-             xmlns:wfs="http://www.opengis.net/wfs" 
-             xmlns:wps="http://www.opengis.net/wps/1.0.0" 
-             xmlns:ows="http://www.opengis.net/ows/1.1" 
-             xmlns:xlink="http://www.w3.org/1999/xlink" 
-             xmlns:lmRad="http://lifemapper.org"
-             xsi:schemaLocation="http://www.opengis.net/wps/1.0.0 http://schemas.opengis.net/wps/1.0.0/wpsAll.xsd">
-  <ows:Identifier>addbucket</ows:Identifier>
-  <wps:DataInputs>
-      <wps:Input>
-         <ows:Identifier>bucket</ows:Identifier>
-         <wps:Data>
-            <wps:ComplexData>
-               <lmRad:shapegrid>
-                  <lmRad:name>%s</lmRad:name>
-                  <lmRad:cellShape>%s</lmRad:cellShape>
-                  <lmRad:cellSize>%s</lmRad:cellSize>
-                  <lmRad:mapUnits>%s</lmRad:mapUnits>
-                  <lmRad:epsgCode>%s</lmRad:epsgCode>
-                  <lmRad:bounds>%s</lmRad:bounds>
-%s
-               </lmRad:shapegrid>
-            </wps:ComplexData>
-         </wps:Data>
-      </wps:Input>
-  </wps:DataInputs>
-  <wps:ResponseForm>
-    <wps:RawDataOutput mimeType="application/gml-3.1.1">
-      <ows:Identifier>result</ows:Identifier>
-    </wps:RawDataOutput>
-  </wps:ResponseForm>
-</wps:Execute>
-""" % (shpName, cellShape, cellSize, mapUnits, epsgCode, bbox, 
-   "                 <lmRad:cutout>%s</lmRad:cutout>" % cutout if cutout is not None else "")
+      postXml = addBucketBody(shpName, cellShape, cellSize, mapUnits, epsgCode, 
+                              bbox, cutout=cutout)
       
       url = "%s/services/rad/experiments/%s/addbucket" % (self.cl.server, expId)
       obj = self.cl.makeRequest(url, 
@@ -338,35 +304,7 @@ class RADClient(object):
       @param expId: The id of the experiment to add a bucket to
       @param shpId: The id of the shapegrid to use for this bucket
       """
-      postXml = """\
-<?xml version="1.0" encoding="UTF-8"?>
-<wps:Execute version="1.0.0" service="WPS" 
-             xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" 
-             xmlns="http://www.opengis.net/wps/1.0.0" 
-             xmlns:wfs="http://www.opengis.net/wfs" 
-             xmlns:wps="http://www.opengis.net/wps/1.0.0" 
-             xmlns:ows="http://www.opengis.net/ows/1.1" 
-             xmlns:xlink="http://www.w3.org/1999/xlink" 
-             xmlns:lmRad="http://lifemapper.org"
-             xsi:schemaLocation="http://www.opengis.net/wps/1.0.0 http://schemas.opengis.net/wps/1.0.0/wpsAll.xsd">
-  <ows:Identifier>addbucket</ows:Identifier>
-  <wps:DataInputs>
-      <wps:Input>
-         <ows:Identifier>bucket</ows:Identifier>
-         <wps:Data>
-            <wps:ComplexData>
-               <lmRad:shapegridId>%s</lmRad:shapegridId>
-            </wps:ComplexData>
-         </wps:Data>
-      </wps:Input>
-  </wps:DataInputs>
-  <wps:ResponseForm>
-    <wps:RawDataOutput mimeType="application/gml-3.1.1">
-      <ows:Identifier>result</ows:Identifier>
-    </wps:RawDataOutput>
-  </wps:ResponseForm>
-</wps:Execute>
-""" % shpId
+      postXml = addBucketByShapegridIdBody(shpId)
       
       url = "%s/services/rad/experiments/%s/addbucket" % (self.cl.server, expId)
       obj = self.cl.makeRequest(url, 
@@ -388,27 +326,7 @@ class RADClient(object):
       @param expId: The id of the experiment to perform intersections for
       @param bucketId: The id of the bucket to intersect.
       """
-      postXml = """\
-<?xml version="1.0" encoding="UTF-8"?>
-<wps:Execute version="1.0.0" service="WPS" 
-             xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" 
-             xmlns="http://www.opengis.net/wps/1.0.0" 
-             xmlns:wfs="http://www.opengis.net/wfs" 
-             xmlns:wps="http://www.opengis.net/wps/1.0.0" 
-             xmlns:ows="http://www.opengis.net/ows/1.1" 
-             xmlns:xlink="http://www.w3.org/1999/xlink" 
-             xmlns:lmRad="http://lifemapper.org"
-             xsi:schemaLocation="http://www.opengis.net/wps/1.0.0 http://schemas.opengis.net/wps/1.0.0/wpsAll.xsd">
-  <ows:Identifier>intersect</ows:Identifier>
-  <wps:DataInputs>
-  </wps:DataInputs>
-  <wps:ResponseForm>
-    <wps:RawDataOutput mimeType="application/gml-3.1.1">
-      <ows:Identifier>result</ows:Identifier>
-    </wps:RawDataOutput>
-  </wps:ResponseForm>
-</wps:Execute>
-""" 
+      postXml = intersectBody()
       
       url = "%s/services/rad/experiments/%s/%sintersect" % (self.cl.server, expId, 
                "buckets/%s/" % bucketId if bucketId is not None else "")
@@ -432,39 +350,7 @@ class RADClient(object):
       @param method: (optional) The randomization method to use (swap | splotch | grady)
       @param numSwaps: (optional) The number of successful swaps to perform
       """
-      postXml = """\
-<?xml version="1.0" encoding="UTF-8"?>
-<wps:Execute version="1.0.0" service="WPS" 
-             xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" 
-             xmlns="http://www.opengis.net/wps/1.0.0" 
-             xmlns:wfs="http://www.opengis.net/wfs" 
-             xmlns:wps="http://www.opengis.net/wps/1.0.0" 
-             xmlns:ows="http://www.opengis.net/ows/1.1" 
-             xmlns:xlink="http://www.w3.org/1999/xlink" 
-             xmlns:lmRad="http://lifemapper.org"
-             xsi:schemaLocation="http://www.opengis.net/wps/1.0.0 http://schemas.opengis.net/wps/1.0.0/wpsAll.xsd">
-  <ows:Identifier>randomize</ows:Identifier>
-  <wps:DataInputs>
-      <wps:Input>
-         <ows:Identifier>randomizeMethod</ows:Identifier>
-         <wps:Data>
-            <wps:LiteralData>%s</wps:LiteralData>
-         </wps:Data>
-      </wps:Input>
-      <wps:Input>
-         <ows:Identifier>numSwaps</ows:Identifier>
-         <wps:Data>
-            <wps:LiteralData>%s</wps:LiteralData>
-         </wps:Data>
-      </wps:Input>
-  </wps:DataInputs>
-  <wps:ResponseForm>
-    <wps:RawDataOutput mimeType="application/gml-3.1.1">
-      <ows:Identifier>result</ows:Identifier>
-    </wps:RawDataOutput>
-  </wps:ResponseForm>
-</wps:Execute>
-""" % (method, numSwaps)
+      postXml = randomizeBody(method, numSwaps)
    
       url = "%s/services/rad/experiments/%s/buckets/%s/randomize" % (
                                                                   self.cl.server, 
@@ -516,45 +402,9 @@ class RADClient(object):
       @param minPercent: (optional) The minimum percentage for presence
       @note: This service is still experimental and may not work as expected
       """
-      postXml = """\
-<?xml version="1.0" encoding="UTF-8"?>
-<wps:Execute version="1.0.0" service="WPS" 
-             xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" 
-             xmlns="http://www.opengis.net/wps/1.0.0" 
-             xmlns:wfs="http://www.opengis.net/wfs" 
-             xmlns:wps="http://www.opengis.net/wps/1.0.0" 
-             xmlns:ows="http://www.opengis.net/ows/1.1" 
-             xmlns:xlink="http://www.w3.org/1999/xlink" 
-             xmlns:lmRad="http://lifemapper.org"
-             xsi:schemaLocation="http://www.opengis.net/wps/1.0.0 http://schemas.opengis.net/wps/1.0.0/wpsAll.xsd">
-  <ows:Identifier>addanclayer</ows:Identifier>
-  <wps:DataInputs>
-      <wps:Input>
-         <ows:Identifier>ancLayer</ows:Identifier>
-         <wps:Data>
-            <wps:ComplexData>
-               <lmRad:layerId>%s</lmRad:layerId>
-               <lmRad:parameters>
-%s%s%s
-               </lmRad:parameters>
-            </wps:ComplexData>
-         </wps:Data>
-      </wps:Input>
-  </wps:DataInputs>
-  <wps:ResponseForm>
-    <wps:RawDataOutput mimeType="application/gml-3.1.1">
-      <ows:Identifier>result</ows:Identifier>
-    </wps:RawDataOutput>
-  </wps:ResponseForm>
-</wps:Execute>
-""" % (lyrId,
-       "                  <lmRad:attrValue>%s</lmRad:attrValue>\n" 
-          % attrValue if attrValue is not None else "",
-       "                  <lmRad:calculateMethod>%s</lmRad:calculateMethod>\n" 
-          % calculateMethod if calculateMethod is not None else "",
-       "                  <lmRad:minPercent>%s</lmRad:minPercent>\n" 
-          % minPercent if minPercent is not None else "",
-      )
+      postXml = addAncLayerBody(lyrId, attrValue=attrValue, 
+                                calculateMethod=calculateMethod, 
+                                minPercent=minPercent)
       
       url = "%s/services/rad/experiments/%s/addanclayer" % (self.cl.server, expId)
       obj = self.cl.makeRequest(url, 
@@ -683,55 +533,12 @@ class RADClient(object):
       @param maxAbsence: (optional) The maximum value indicating absence
       @param percentAbsence: (optional) The portion required to indicate absence
       """
-      postXml = """\
-<?xml version="1.0" encoding="UTF-8"?>
-<wps:Execute version="1.0.0" service="WPS" 
-             xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" 
-             xmlns="http://www.opengis.net/wps/1.0.0" 
-             xmlns:wfs="http://www.opengis.net/wfs" 
-             xmlns:wps="http://www.opengis.net/wps/1.0.0" 
-             xmlns:ows="http://www.opengis.net/ows/1.1" 
-             xmlns:xlink="http://www.w3.org/1999/xlink" 
-             xmlns:lmRad="http://lifemapper.org"
-             xsi:schemaLocation="http://www.opengis.net/wps/1.0.0 http://schemas.opengis.net/wps/1.0.0/wpsAll.xsd">
-  <ows:Identifier>addpalayer</ows:Identifier>
-  <wps:DataInputs>
-      <wps:Input>
-         <ows:Identifier>paLayer</ows:Identifier>
-         <wps:Data>
-            <wps:ComplexData>
-               <lmRad:layerId>%s</lmRad:layerId>
-               <lmRad:parameters>
-%s%s%s%s%s%s%s%s
-               </lmRad:parameters>
-            </wps:ComplexData>
-         </wps:Data>
-      </wps:Input>
-  </wps:DataInputs>
-  <wps:ResponseForm>
-    <wps:RawDataOutput mimeType="application/gml-3.1.1">
-      <ows:Identifier>result</ows:Identifier>
-    </wps:RawDataOutput>
-  </wps:ResponseForm>
-</wps:Execute>
-""" % (lyrId,
-       "                  <lmRad:attrPresence>%s</lmRad:attrPresence>\n" 
-          % attrPresence if attrPresence is not None else "",
-       "                  <lmRad:minPresence>%s</lmRad:minPresence>\n" 
-          % minPresence if minPresence is not None else "",
-       "                  <lmRad:maxPresence>%s</lmRad:maxPresence>\n" 
-          % maxPresence if maxPresence is not None else "",
-       "                  <lmRad:percentPresence>%s</lmRad:percentPresence>\n" 
-          % percentPresence if percentPresence is not None else "",
-       "                  <lmRad:attrAbsence>%s</lmRad:attrAbsence>\n" 
-          % attrAbsence if attrAbsence is not None else "",
-       "                  <lmRad:minAbsence>%s</lmRad:minAbsence>\n" 
-          % minAbsence if minAbsence is not None else "",
-       "                  <lmRad:maxAbsence>%s</lmRad:maxAbsence>\n" 
-          % maxAbsence if maxAbsence is not None else "",
-       "                  <lmRad:percentAbsence>%s</lmRad:percentAbsence>\n" 
-          % percentAbsence if percentAbsence is not None else "",
-      )
+      postXml = addPALayerBody(lyrId, attrPresence=attrPresence, 
+                               minPresence=minPresence, maxPresence=maxPresence,
+                               percentPresence=percentPresence, 
+                               attrAbsence=attrAbsence, minAbsence=minAbsence, 
+                               maxAbsence=maxAbsence, 
+                               percentAbsence=percentAbsence)
       
       url = "%s/services/rad/experiments/%s/addpalayer" % (self.cl.server, expId)
       obj = self.cl.makeRequest(url, 
@@ -875,41 +682,128 @@ class RADClient(object):
       else:
          raise Exception, "Must specify either filename or jTree to add a tree to an experiment"
 
-      postXml = """\
-<?xml version="1.0" encoding="UTF-8"?>
-<wps:Execute version="1.0.0" service="WPS" 
-             xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" 
-             xmlns="http://www.opengis.net/wps/1.0.0" 
-             xmlns:wfs="http://www.opengis.net/wfs" 
-             xmlns:wps="http://www.opengis.net/wps/1.0.0" 
-             xmlns:ows="http://www.opengis.net/ows/1.1" 
-             xmlns:xlink="http://www.w3.org/1999/xlink" 
-             xmlns:lmRad="http://lifemapper.org"
-             xsi:schemaLocation="http://www.opengis.net/wps/1.0.0 http://schemas.opengis.net/wps/1.0.0/wpsAll.xsd">
-  <ows:Identifier>addtree</ows:Identifier>
-  <wps:DataInputs>
-      <wps:Input>
-         <ows:Identifier>jsonTree</ows:Identifier>
-         <wps:Data>
-            <wps:LiteralData>
-               %s
-            </wps:LiteralData>
-         </wps:Data>
-      </wps:Input>
-  </wps:DataInputs>
-  <wps:ResponseForm>
-    <wps:RawDataOutput mimeType="application/gml-3.1.1">
-      <ows:Identifier>result</ows:Identifier>
-    </wps:RawDataOutput>
-  </wps:ResponseForm>
-</wps:Execute>
-""" % (jTree)
+      return self._postTree(expId, addTreeBody(jTree))
+   
+   # .........................................
+   def addOTLTreeForExperiment(self, expId, ottId, species=None):
+      """
+      @summary: Gets an Open Tree of Life subtree, prunes it to the species of
+                   an experiment and adds it to the experiment
+      @param expId: The id of the experiment to add the tree to
+      @param ottId: The Open Tree id of the clade containing the species
+      @param species: (optional) The species names in PAM column order, None
+                         for unused columns.  If None, the names are taken 
+                         from the experiment's layerset with 
+                         getExperimentSpecies
+      @rtype: TreeAttachment
+      @note: Tree nodes are matched to species by name, ignoring case, 
+                underscores and the '_ott<id>' suffix of Open Tree labels.
+                Internal nodes are matched too, since a species with 
+                subspecies is not a tip of the Open Tree.  The highest node
+                matching a species is kept as a tip and written with its PAM
+                column as 'mx'.  A species whose node is below that of another
+                matched species is reported as unmatched
+      @note: The tree is pruned and serialized from its arrays, and the
+                request body is written to a temporary file and streamed, so
+                neither the tree nor the body is built as Python objects
+      @note: Requires NumPy
+      """
+      import numpy as np
+      from LmClient.newick import iterJTree, NO_NODE
+      
+      if species is None:
+         species = self.getExperimentSpecies(expId)
+      columns = {}
+      for col, name in enumerate(species):
+         if name is not None:
+            columns.setdefault(normalizeTaxonName(name), col)
       
+      tree = OTLClient(self.cl).getOTLTree(ottId)
+      labelColumns = np.array([columns.get(otlLabelName(label), NO_NODE) \
+                                 for label in tree.labels] + [NO_NODE], 
+                              dtype=np.int64)
+      # labelId is NO_NODE (-1) for unlabeled nodes, which picks the extra 
+      #    NO_NODE column above
+      nodeColumns = labelColumns[tree.labelId]
+      # Ancestors come first in preorder, so this keeps the highest node
+      matchedColumns, nodes = np.unique(nodeColumns, return_index=True)
+      keep = matchedColumns != NO_NODE
+      matchedColumns, nodes = matchedColumns[keep], nodes[keep]
+      
+      # Drop matches inside the clade of another match
+      isMatched = np.zeros(len(tree), dtype=bool)
+      isMatched[nodes] = True
+      inMatchedClade = np.zeros(len(nodes), dtype=bool)
+      ancestors = tree.parent[nodes]
+      while True:
+         active = ancestors != NO_NODE
+         if not active.any():
+            break
+         inMatchedClade[active] |= isMatched[ancestors[active]]
+         ancestors[active] = tree.parent[ancestors[active]]
+      matchedColumns = matchedColumns[~inMatchedClade]
+      nodes = nodes[~inMatchedClade]
+      if len(nodes) == 0:
+         raise Exception("None of the species of experiment %s are in the tree" \
+                                                                      % expId)
+      pruned = tree.prune(nodes)
+      
+      matrixIndices = np.where(pruned.isTip(), labelColumns[pruned.labelId], 
+                               NO_NODE)
+      matched = set(matchedColumns.tolist())
+      unmatched = [name for col, name in enumerate(species) \
+                     if name is not None and \
+                        columns[normalizeTaxonName(name)] not in matched]
+      
+      with tempfile.TemporaryFile() as bodyF:
+         writeAddTreeBody(bodyF, iterJTree(pruned, 
+                                           matrixIndices=matrixIndices))
+         bodyF.seek(0)
+         success = self._postTree(expId, bodyF)
+      return TreeAttachment(success, len(nodes), unmatched)
+   
+   # .........................................
+   def getExperimentSpecies(self, expId):
+      """
+      @summary: Returns the names of the presence absence layers of an 
+                   experiment, by PAM column
+      @param expId: The id of the experiment
+      @return: A list of names indexed by PAM column.  Columns without a 
+                  layer are None
+      @note: The columns are the 'matrixIndex' values of the layers in the
+                experiment's layerset.  If the layers do not all have one, the
+                layerset order, which is the order the PAM is built in, is 
+                used
+      """
+      lyrs = self.getPALayers(expId)
+      if len(lyrs) == 0:
+         raise Exception("Could not get the layerset of experiment %s, species must be specified" \
+                                                                      % expId)
+      names = [getattr(lyr, 'title', None) or lyr.name for lyr in lyrs]
+      try:
+         mtxIndices = [int(lyr.matrixIndex) for lyr in lyrs]
+      except Exception:
+         mtxIndices = None
+      if mtxIndices is None or min(mtxIndices) < 0 or \
+            len(set(mtxIndices)) != len(mtxIndices):
+         return names
+      species = [None] * (max(mtxIndices) + 1)
+      for mtxIdx, name in zip(mtxIndices, names):
+         species[mtxIdx] = name
+      return species
+   
+   # .........................................
+   def _postTree(self, expId, body):
+      """
+      @summary: Posts an add tree request body
+      @param body: The request body, as a string or an open file
+      @return: True if the tree was added
+      """
       url = "%s/services/rad/experiments/%s/addtree" % (self.cl.server, expId)
       obj = self.cl.makeRequest(url, 
                                 method="POST", 
                                 parameters=[("request", "Execute")], 
-                                body=postXml, 
+                                body=body, 
                                 headers={"Content-Type" : "application/xml"},
                                 objectify=True)
       if obj.Status.ProcessSucceeded is not None:
@@ -1173,7 +1067,7 @@ class RADClient(object):
                   epsgCode=4326, title=None, bbox=None, startDate=None, 
                   endDate=None, mapUnits="dd", resolution=None, valUnits=None, 
                   dataFormat="GTiff", valAttribute=None, description=None, 
-                  keywords=[]):
+                  keywords=[], preflight=False):
       """
       @summary: Uploads a raster layer to Lifemapper to be used in experiments
       @param name: The name of this layer
@@ -1203,7 +1097,22 @@ class RADClient(object):
       @param valAttribute: (optional) The attribute associated with value
       @param description: (optional) A description of this raster layer
       @param keywords: (optional) A list of keywords associated with this raster
-      """
+      @param preflight: (optional) If True and filename is provided, read the
+                           header of the file to check epsgCode, mapUnits, 
+                           dataFormat, resolution, and bbox before uploading 
+                           and to fill in resolution and bbox if they are not
+                           provided
+      @raise RasterPreflightError: Raised if preflight is True and the 
+                                      parameters don't match the file
+      """
+      if preflight and filename is not None:
+         hdr = preflightRaster(filename, dataFormat=dataFormat, 
+                               epsgCode=epsgCode, mapUnits=mapUnits,
+                               resolution=resolution, bbox=bbox)
+         resolution = hdr.resolution
+         if bbox is None and hdr.bbox is not None:
+            bbox = formatBBox(hdr.bbox)
+         
       p = [
            ("name" , name),
            ("title", title),
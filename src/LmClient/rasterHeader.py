@@ -0,0 +1,426 @@
+"""
+@summary: Module containing functions for reading the metadata of local raster
+             files from their headers so that layer uploads can be checked
+             before they are sent
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+
+@note: Only the GeoTIFF tags and the AAIGrid header lines are read.  Pixel
+          data is never touched, so checking a file takes about the same time
+          no matter how large it is.
+"""
+from collections import namedtuple
+import mmap
+import os
+import re
+import struct
+
+from LmClient.constants import RASTER_FORMAT_EXTENSIONS
+
+# .............................................................................
+## Metadata read from the header of a raster file.  'bbox' is a tuple of
+#     (minX, minY, maxX, maxY).  Values that can't be determined are None
+RasterHeader = namedtuple('RasterHeader', ['dataFormat', 'numCols', 'numRows',
+                                           'resolution', 'bbox', 'epsgCode',
+                                           'mapUnits', 'noDataValue'])
+
+# Relative tolerance used when comparing floating point header values
+TOLERANCE = 1e-6
+
+# TIFF tags
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_MODEL_PIXEL_SCALE = 33550
+TAG_MODEL_TIEPOINT = 33922
+TAG_GEO_KEY_DIRECTORY = 34735
+TAG_GDAL_NODATA = 42113
+
+# GeoTIFF keys
+GEO_KEY_MODEL_TYPE = 1024
+GEO_KEY_RASTER_TYPE = 1025
+GEO_KEY_GEOGRAPHIC_TYPE = 2048
+GEO_KEY_PROJECTED_CS_TYPE = 3072
+GEO_KEY_PROJ_LINEAR_UNITS = 3076
+MODEL_TYPE_GEOGRAPHIC = 2
+RASTER_PIXEL_IS_POINT = 2
+USER_DEFINED = 32767
+
+# EPSG unit codes to Lifemapper map units
+LINEAR_UNITS = {
+                9001 : "meters",
+                9002 : "feet"
+               }
+
+# TIFF field type to struct format
+TIFF_TYPES = {
+              1 : 'B', 2 : 's', 3 : 'H', 4 : 'I', 6 : 'b', 7 : 'B', 8 : 'h',
+              9 : 'i', 11 : 'f', 12 : 'd', 16 : 'Q', 17 : 'q', 18 : 'Q'
+             }
+
+# .............................................................................
+class RasterPreflightError(Exception):
+   """
+   @summary: This exception indicates that the metadata supplied for a raster
+                upload does not agree with the raster file
+   """
+   # ...............................
+   def __init__(self, fileName, problems):
+      self.fileName = fileName
+      self.problems = problems
+      Exception.__init__(self)
+      self.msg = "Raster %s failed preflight: %s" % (fileName,
+                                                     '; '.join(problems))
+
+   # ...............................
+   def __repr__(self):
+      return "%s %s" % (self.__class__, unicode(self))
+
+   # ...............................
+   def __str__(self):
+      return unicode(self)
+
+   # ...............................
+   def __unicode__(self):
+      return self.msg
+
+# .............................................................................
+def readRasterHeader(fileName):
+   """
+   @summary: Reads the header of a GeoTIFF or AAIGrid file
+   @param fileName: The local raster file to read
+   @rtype: RasterHeader
+   @raise Exception: Raised if the format of the file is not recognized
+   """
+   ext = os.path.splitext(fileName)[1].lower()
+   dataFormat = RASTER_FORMAT_EXTENSIONS.get(ext)
+   if dataFormat == "GTiff":
+      return readGeoTiffHeader(fileName)
+   elif dataFormat == "AAIGrid":
+      return readAAIGridHeader(fileName)
+   else:
+      raise Exception, "Do not know how to read raster header: %s" % fileName
+
+# .............................................................................
+def readAAIGridHeader(fileName):
+   """
+   @summary: Reads the header lines of an ESRI ASCII grid file
+   @param fileName: The local AAIGrid file to read
+   @note: The EPSG code is read from a .prj file next to the grid if there is
+             one
+   @rtype: RasterHeader
+   """
+   vals = {}
+   with open(fileName) as inF:
+      for line in inF:
+         parts = line.split()
+         if len(parts) != 2 or not re.match('^[a-z_]+$', parts[0].lower()):
+            # First data row
+            break
+         vals[parts[0].lower()] = float(parts[1])
+
+   try:
+      numCols = int(vals['ncols'])
+      numRows = int(vals['nrows'])
+   except KeyError:
+      raise Exception, "%s does not have an AAIGrid header" % fileName
+
+   if vals.has_key('cellsize'):
+      xRes = yRes = vals['cellsize']
+   else:
+      xRes = vals.get('dx')
+      yRes = vals.get('dy')
+
+   if vals.has_key('xllcorner'):
+      minX = vals['xllcorner']
+   else:
+      minX = vals['xllcenter'] - xRes / 2.0
+   if vals.has_key('yllcorner'):
+      minY = vals['yllcorner']
+   else:
+      minY = vals['yllcenter'] - yRes / 2.0
+   bbox = (minX, minY, minX + numCols * xRes, minY + numRows * yRes)
+
+   epsgCode = None
+   mapUnits = None
+   prjFn = "%s.prj" % os.path.splitext(fileName)[0]
+   if os.path.exists(prjFn):
+      epsgCode, mapUnits = _readPrjFile(prjFn)
+
+   return RasterHeader("AAIGrid", numCols, numRows, _resolution(xRes, yRes),
+                       bbox, epsgCode, mapUnits, vals.get('nodata_value'))
+
+# .............................................................................
+def readGeoTiffHeader(fileName):
+   """
+   @summary: Reads the tags of the first image in a GeoTIFF (or BigTIFF) file
+   @param fileName: The local GeoTIFF file to read
+   @note: The file is memory-mapped so that only the pages holding the tags
+             are read from disk
+   @rtype: RasterHeader
+   """
+   with open(fileName, 'rb') as inF:
+      if os.fstat(inF.fileno()).st_size < 8:
+         raise Exception, "%s is not a TIFF file" % fileName
+      mm = mmap.mmap(inF.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+         tags = _readTiffTags(mm, fileName)
+      finally:
+         mm.close()
+
+   numCols = tags[TAG_IMAGE_WIDTH][0]
+   numRows = tags[TAG_IMAGE_LENGTH][0]
+
+   geoKeys = {}
+   if tags.has_key(TAG_GEO_KEY_DIRECTORY):
+      keyDir = tags[TAG_GEO_KEY_DIRECTORY]
+      for i in range(4, 4 + 4 * keyDir[3], 4):
+         keyId, location, _, value = keyDir[i:i+4]
+         if location == 0: # Only need keys stored directly in the directory
+            geoKeys[keyId] = value
+
+   resolution = None
+   bbox = None
+   if tags.has_key(TAG_MODEL_PIXEL_SCALE) and tags.has_key(TAG_MODEL_TIEPOINT):
+      xRes, yRes = tags[TAG_MODEL_PIXEL_SCALE][:2]
+      i, j, _, x, y, _ = tags[TAG_MODEL_TIEPOINT][:6]
+      minX = x - i * xRes
+      maxY = y + j * yRes
+      if geoKeys.get(GEO_KEY_RASTER_TYPE) == RASTER_PIXEL_IS_POINT:
+         minX -= xRes / 2.0
+         maxY += yRes / 2.0
+      bbox = (minX, maxY - numRows * yRes, minX + numCols * xRes, maxY)
+      resolution = _resolution(xRes, yRes)
+
+   epsgCode = None
+   mapUnits = None
+   if geoKeys.get(GEO_KEY_MODEL_TYPE) == MODEL_TYPE_GEOGRAPHIC:
+      epsgCode = geoKeys.get(GEO_KEY_GEOGRAPHIC_TYPE)
+      mapUnits = "dd"
+   else:
+      epsgCode = geoKeys.get(GEO_KEY_PROJECTED_CS_TYPE)
+      mapUnits = LINEAR_UNITS.get(geoKeys.get(GEO_KEY_PROJ_LINEAR_UNITS))
+   if epsgCode == USER_DEFINED:
+      epsgCode = None
+
+   noDataValue = None
+   if tags.has_key(TAG_GDAL_NODATA):
+      try:
+         noDataValue = float(tags[TAG_GDAL_NODATA].strip('\x00 '))
+      except ValueError:
+         pass
+
+   return RasterHeader("GTiff", numCols, numRows, resolution, bbox, epsgCode,
+                       mapUnits, noDataValue)
+
+# .............................................................................
+def preflightRaster(fileName, dataFormat=None, epsgCode=None, mapUnits=None,
+                    resolution=None, bbox=None):
+   """
+   @summary: Checks the metadata supplied for a raster upload against the
+                header of the file and fills in what is missing
+   @param fileName: The local raster file to check
+   @param dataFormat: (optional) The data format that will be sent
+   @param epsgCode: (optional) The EPSG code that will be sent
+   @param mapUnits: (optional) The map units that will be sent
+   @param resolution: (optional) The resolution that will be sent
+   @param bbox: (optional) The bounding box that will be sent.  Either a
+                   sequence of (minX, minY, maxX, maxY) or a comma delimited
+                   string of those values
+   @return: A RasterHeader where values supplied by the caller are used for
+               anything that could not be read from the file
+   @raise RasterPreflightError: Raised if a supplied value does not agree with
+                                   the file header
+   """
+   hdr = readRasterHeader(fileName)
+   problems = []
+
+   if hdr.numCols <= 0 or hdr.numRows <= 0:
+      problems.append("raster has no cells (%s x %s)" % (hdr.numCols,
+                                                         hdr.numRows))
+   if hdr.resolution is not None and hdr.resolution <= 0:
+      problems.append("invalid cell size %s" % hdr.resolution)
+   if dataFormat is not None and dataFormat != hdr.dataFormat:
+      problems.append("data format is %s, not %s" % (hdr.dataFormat,
+                                                     dataFormat))
+   if epsgCode is not None and hdr.epsgCode is not None \
+         and int(epsgCode) != hdr.epsgCode:
+      problems.append("EPSG code is %s, not %s" % (hdr.epsgCode, epsgCode))
+   if mapUnits is not None and hdr.mapUnits is not None \
+         and mapUnits.lower() != hdr.mapUnits:
+      problems.append("map units are %s, not %s" % (hdr.mapUnits, mapUnits))
+   if resolution is not None and hdr.resolution is not None \
+         and not _close(float(resolution), hdr.resolution):
+      problems.append("resolution is %s, not %s" % (hdr.resolution,
+                                                    resolution))
+   if bbox is not None and hdr.bbox is not None:
+      if isinstance(bbox, basestring):
+         bbox = bbox.strip('()[] ').split(',')
+      bbox = tuple([float(v) for v in bbox])
+      # Allow the bounds to be off by up to half of a cell
+      tol = hdr.resolution / 2.0 if hdr.resolution else TOLERANCE
+      if len(bbox) != 4 or max([abs(a - b) \
+                                 for a, b in zip(bbox, hdr.bbox)]) > tol:
+         problems.append("bounding box is %s, not %s" % (str(hdr.bbox),
+                                                         str(bbox)))
+   if len(problems) > 0:
+      raise RasterPreflightError(fileName, problems)
+
+   return RasterHeader(hdr.dataFormat, hdr.numCols, hdr.numRows,
+                _first(hdr.resolution, resolution), _first(hdr.bbox, bbox),
+                _first(hdr.epsgCode, epsgCode), _first(hdr.mapUnits, mapUnits),
+                hdr.noDataValue)
+
+# .............................................................................
+def preflightRasters(fileNames, **kwargs):
+   """
+   @summary: Runs preflightRaster against a batch of files
+   @param fileNames: A list of local raster files
+   @param kwargs: (optional) Keyword arguments passed to preflightRaster for
+                     every file
+   @return: A tuple of (dictionary of file name to RasterHeader, dictionary of
+               file name to the exception for files that failed)
+   """
+   headers = {}
+   failures = {}
+   for fn in fileNames:
+      try:
+         headers[fn] = preflightRaster(fn, **kwargs)
+      except Exception, e:
+         failures[fn] = e
+   return headers, failures
+
+# .............................................................................
+def formatBBox(bbox):
+   """
+   @summary: Formats a bounding box tuple as a parameter value for the web
+                services
+   @param bbox: A tuple of (minX, minY, maxX, maxY)
+   """
+   return ','.join([repr(float(v)) for v in bbox])
+
+# =============================================================================
+# =                             Helper Functions                              =
+# =============================================================================
+# .............................................................................
+def _readTiffTags(mm, fileName):
+   """
+   @summary: Reads the tags of the first image file directory of a TIFF
+   @param mm: A memory map of the TIFF file
+   @param fileName: The name of the file, used for error messages
+   @return: A dictionary of tag number to value.  Numeric values are tuples
+               and ASCII values are strings
+   """
+   if mm[:2] == 'II':
+      bo = '<'
+   elif mm[:2] == 'MM':
+      bo = '>'
+   else:
+      raise Exception, "%s is not a TIFF file" % fileName
+
+   magic = struct.unpack_from(bo + 'H', mm, 2)[0]
+   if magic == 42: # Classic TIFF
+      ifdOffset = struct.unpack_from(bo + 'I', mm, 4)[0]
+      countFmt, entryFmt, entrySize, inlineSize = 'H', 'HHI', 12, 4
+   elif magic == 43: # BigTIFF
+      ifdOffset = struct.unpack_from(bo + 'Q', mm, 8)[0]
+      countFmt, entryFmt, entrySize, inlineSize = 'Q', 'HHQ', 20, 8
+   else:
+      raise Exception, "%s is not a TIFF file" % fileName
+
+   wanted = [TAG_IMAGE_WIDTH, TAG_IMAGE_LENGTH, TAG_MODEL_PIXEL_SCALE,
+             TAG_MODEL_TIEPOINT, TAG_GEO_KEY_DIRECTORY, TAG_GDAL_NODATA]
+
+   numEntries = struct.unpack_from(bo + countFmt, mm, ifdOffset)[0]
+   pos = ifdOffset + struct.calcsize(countFmt)
+   tags = {}
+   for _ in range(numEntries):
+      tag, fType, count = struct.unpack_from(bo + entryFmt, mm, pos)
+      if tag in wanted and TIFF_TYPES.has_key(fType):
+         fmt = TIFF_TYPES[fType]
+         size = struct.calcsize(bo + fmt) * count
+         # The value, or its offset, fills the end of the entry
+         valPos = pos + entrySize - inlineSize
+         if size > inlineSize:
+            valPos = struct.unpack_from(bo + entryFmt[-1], mm, valPos)[0]
+         if fType == 2:
+            tags[tag] = mm[valPos:valPos + count]
+         else:
+            tags[tag] = struct.unpack_from('%s%d%s' % (bo, count, fmt),
+                                           mm, valPos)
+      pos += entrySize
+
+   for tag in [TAG_IMAGE_WIDTH, TAG_IMAGE_LENGTH]:
+      if not tags.has_key(tag):
+         raise Exception, "%s is missing TIFF tag %s" % (fileName, tag)
+   return tags
+
+# .............................................................................
+def _readPrjFile(prjFn):
+   """
+   @summary: Gets the EPSG code and map units from a WKT .prj file
+   @param prjFn: The .prj file to read
+   @note: The EPSG code is only found if the WKT includes authority codes
+   """
+   wkt = open(prjFn).read()
+   epsgCode = None
+   # The outermost authority is the last one in the string
+   codes = re.findall(r'AUTHORITY\["EPSG",\s*"?(\d+)"?\]', wkt)
+   if len(codes) > 0:
+      epsgCode = int(codes[-1])
+   if wkt.strip().upper().startswith('GEOGCS'):
+      mapUnits = "dd"
+   elif re.search(r'UNIT\["(metre|meter)', wkt, re.IGNORECASE):
+      mapUnits = "meters"
+   else:
+      mapUnits = None
+   return epsgCode, mapUnits
+
+# .............................................................................
+def _resolution(xRes, yRes):
+   """
+   @summary: Returns a single resolution value for a raster
+   @note: Lifemapper layers have square cells, so non-square rasters report
+             the x resolution
+   """
+   if xRes is None:
+      return yRes
+   return float(xRes)
+
+# .............................................................................
+def _close(a, b):
+   """
+   @summary: Compares two floating point values with a relative tolerance
+   """
+   return abs(a - b) <= TOLERANCE * max(abs(a), abs(b), 1.0)
+
+# .............................................................................
+def _first(*vals):
+   """
+   @summary: Returns the first value that is not None
+   """
+   for v in vals:
+      if v is not None:
+         return v
+   return None
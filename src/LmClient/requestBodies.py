@@ -0,0 +1,404 @@
+"""
+@summary: Module containing builders for the XML request bodies sent to the
+             Lifemapper SDM and RAD web services
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+
+@note: The templates are assembled once, when the module is loaded, so
+          building a body is a single string formatting operation.  All string
+          values are XML escaped.  Numbers never need escaping, so they are 
+          formatted as they are
+"""
+
+# .............................................................................
+def escape(val):
+   """
+   @summary: Escapes a value for use as XML element content
+   @param val: The value to escape.  Values that are not strings are
+                  converted with str
+   """
+   if not isinstance(val, basestring):
+      return str(val)
+   if '&' in val:
+      val = val.replace('&', '&amp;')
+   if '<' in val:
+      val = val.replace('<', '&lt;')
+   if '>' in val:
+      val = val.replace('>', '&gt;')
+   return val
+
+# .............................................................................
+def _optionalElement(template, val):
+   """
+   @summary: Fills an optional element template if the value is not None
+   @param template: A template with a single '%s' for the element value
+   @param val: The value of the element, or None to omit it
+   """
+   if val is None:
+      return ""
+   return template % escape(val)
+
+# =============================================================================
+# =                                   SDM                                     =
+# =============================================================================
+# Filled with a tuple of (algorithm code, parameters, occurrence set id, model
+#    scenario, model mask, email, name, description, projection scenarios, 
+#    projection mask).  Positional formatting is faster than a dictionary
+SDM_EXPERIMENT_TEMPLATE = """\
+      <lm:request xmlns:lm="http://lifemapper.org"
+                  xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+                    xsi:schemaLocation="http://lifemapper.org
+                                               /schemas/serviceRequest.xsd">
+            <lm:experiment>
+               <lm:algorithm>
+                  <lm:algorithmCode>%s</lm:algorithmCode>
+%s
+               </lm:algorithm>
+               <lm:occurrenceSetId>%s</lm:occurrenceSetId>
+               <lm:modelScenario>%s</lm:modelScenario>
+%s
+%s
+%s
+%s
+%s
+%s
+            </lm:experiment>
+         </lm:request>"""
+
+SDM_ALGO_PARAMS_TEMPLATE = """\
+                  <lm:parameters>
+                     %s
+                  </lm:parameters>"""
+SDM_ALGO_PARAM_TEMPLATE = "<lm:%s>%s</lm:%s>"
+SDM_ALGO_PARAM_SEPARATOR = "\n                     "
+SDM_MODEL_MASK_TEMPLATE = "            <lm:modelMask>%s</lm:modelMask>"
+SDM_PROJECTION_MASK_TEMPLATE = \
+                     "            <lm:projectionMask>%s</lm:projectionMask>"
+SDM_EMAIL_TEMPLATE = "            <lm:email>%s</lm:email>"
+SDM_NAME_TEMPLATE = "            <lm:name>%s</lm:name>"
+SDM_DESCRIPTION_TEMPLATE = "            <lm:description>%s</lm:description>"
+SDM_PROJECTION_TEMPLATE = \
+                "            <lm:projectionScenario>%s</lm:projectionScenario>"
+
+# The maximum number of parameter sections kept by _algoParamsSection
+MAX_ALGO_PARAMS_SECTIONS = 256
+
+# The filled in SDM_ALGO_PARAMS_TEMPLATE of each parameter set
+_ALGO_PARAMS_SECTIONS = {}
+
+# .............................................................................
+def sdmExperimentBody(algorithmCode, algorithmParameters, occSetId, mdlScn,
+                      prjScns=[], mdlMask=None, prjMask=None, email=None,
+                      name=None, description=None):
+   """
+   @summary: Builds the body for posting an SDM experiment
+   @param algorithmCode: The code of the algorithm to use
+   @param algorithmParameters: A list of (name, value) tuples for the
+                                  algorithm parameters
+   @param occSetId: The id of the occurrence set to model
+   @param mdlScn: The id of the model scenario
+   @param prjScns: (optional) A list of projection scenario ids
+   @param mdlMask: (optional) A layer id to use as the model mask
+   @param prjMask: (optional) A layer id to use as the projection mask
+   @param email: (optional) An email address to notify on completion
+   @param name: (optional) A name for the experiment
+   @param description: (optional) A description of the experiment
+   @note: See SDMClient.postExperiment
+   @note: This is called for every experiment of a batch, so the work is 
+             inlined and the parameters section, which is usually the same 
+             for the whole batch, is kept.  See bench_requestBodies.py
+   """
+   return SDM_EXPERIMENT_TEMPLATE % (
+      escape(algorithmCode),
+      _algoParamsSection(algorithmParameters) if algorithmParameters else "",
+      escape(occSetId) if isinstance(occSetId, basestring) else occSetId,
+      escape(mdlScn) if isinstance(mdlScn, basestring) else mdlScn,
+      "" if mdlMask is None else SDM_MODEL_MASK_TEMPLATE % escape(mdlMask),
+      "" if email is None else SDM_EMAIL_TEMPLATE % escape(email),
+      "" if name is None else SDM_NAME_TEMPLATE % escape(name),
+      "" if description is None else \
+                              SDM_DESCRIPTION_TEMPLATE % escape(description),
+      '\n'.join([SDM_PROJECTION_TEMPLATE % \
+                  (escape(scnId) if isinstance(scnId, basestring) else scnId) \
+                                                         for scnId in prjScns]),
+      "" if prjMask is None else SDM_PROJECTION_MASK_TEMPLATE % escape(prjMask))
+
+# =============================================================================
+# =                                   RAD                                     =
+# =============================================================================
+RAD_EXPERIMENT_TEMPLATE = """\
+      <lmRad:request xmlns:lmRad="http://lifemapper.org"
+                        xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+                        xsi:schemaLocation="http://lifemapper.org
+                                               /schemas/radServiceRequest.xsd">
+            <lmRad:experiment>
+               <lmRad:name>%(name)s</lmRad:name>
+               <lmRad:epsgCode>%(epsgCode)s</lmRad:epsgCode>
+%(description)s
+%(email)s
+            </lmRad:experiment>
+         </lmRad:request>"""
+RAD_DESCRIPTION_TEMPLATE = \
+                  "               <lmRad:description>%s</lmRad:description>"
+RAD_EMAIL_TEMPLATE = "               <lmRad:email>%s</lmRad:email>"
+
+# .............................................................................
+def radExperimentBody(name, epsgCode, email=None, description=None):
+   """
+   @summary: Builds the body for posting a RAD experiment
+   @note: See RADClient.postExperiment
+   """
+   return RAD_EXPERIMENT_TEMPLATE % {
+      'name' : escape(name),
+      'epsgCode' : escape(epsgCode),
+      'description' : _optionalElement(RAD_DESCRIPTION_TEMPLATE, description),
+      'email' : _optionalElement(RAD_EMAIL_TEMPLATE, email)
+   }
+
+# WPS Execute requests
+# ---------------------
+WPS_TEMPLATE = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<wps:Execute version="1.0.0" service="WPS"
+             xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+             xmlns="http://www.opengis.net/wps/1.0.0"
+             xmlns:wfs="http://www.opengis.net/wfs"
+             xmlns:wps="http://www.opengis.net/wps/1.0.0"
+             xmlns:ows="http://www.opengis.net/ows/1.1"
+             xmlns:xlink="http://www.w3.org/1999/xlink"
+             xmlns:lmRad="http://lifemapper.org"
+             xsi:schemaLocation="http://www.opengis.net/wps/1.0.0 http://schemas.opengis.net/wps/1.0.0/wpsAll.xsd">
+  <ows:Identifier>%s</ows:Identifier>
+  <wps:DataInputs>
+%s
+  </wps:DataInputs>
+  <wps:ResponseForm>
+    <wps:RawDataOutput mimeType="application/gml-3.1.1">
+      <ows:Identifier>result</ows:Identifier>
+    </wps:RawDataOutput>
+  </wps:ResponseForm>
+</wps:Execute>
+"""
+
+WPS_COMPLEX_INPUT_TEMPLATE = """\
+      <wps:Input>
+         <ows:Identifier>%s</ows:Identifier>
+         <wps:Data>
+            <wps:ComplexData>
+%s
+            </wps:ComplexData>
+         </wps:Data>
+      </wps:Input>"""
+
+WPS_LITERAL_INPUT_TEMPLATE = """\
+      <wps:Input>
+         <ows:Identifier>%s</ows:Identifier>
+         <wps:Data>
+            <wps:LiteralData>%s</wps:LiteralData>
+         </wps:Data>
+      </wps:Input>"""
+
+RAD_PARAMETER_TEMPLATE = "                  <lmRad:%s>%%s</lmRad:%s>\n"
+
+# Complete WPS templates, assembled once at load time.  Any literal '%' in the
+#    envelope would need escaping, there are none
+ADD_BUCKET_TEMPLATE = WPS_TEMPLATE % ('addbucket',
+   WPS_COMPLEX_INPUT_TEMPLATE % ('bucket', """\
+               <lmRad:shapegrid>
+                  <lmRad:name>%(shpName)s</lmRad:name>
+                  <lmRad:cellShape>%(cellShape)s</lmRad:cellShape>
+                  <lmRad:cellSize>%(cellSize)s</lmRad:cellSize>
+                  <lmRad:mapUnits>%(mapUnits)s</lmRad:mapUnits>
+                  <lmRad:epsgCode>%(epsgCode)s</lmRad:epsgCode>
+                  <lmRad:bounds>%(bbox)s</lmRad:bounds>
+%(cutout)s
+               </lmRad:shapegrid>"""))
+ADD_BUCKET_CUTOUT_TEMPLATE = "                 <lmRad:cutout>%s</lmRad:cutout>"
+
+ADD_BUCKET_BY_ID_TEMPLATE = WPS_TEMPLATE % ('addbucket',
+   WPS_COMPLEX_INPUT_TEMPLATE % ('bucket',
+               "               <lmRad:shapegridId>%(shpId)s</lmRad:shapegridId>"))
+
+INTERSECT_BODY = WPS_TEMPLATE % ('intersect', '')
+
+RANDOMIZE_TEMPLATE = WPS_TEMPLATE % ('randomize', '\n'.join([
+   WPS_LITERAL_INPUT_TEMPLATE % ('randomizeMethod', '%(method)s'),
+   WPS_LITERAL_INPUT_TEMPLATE % ('numSwaps', '%(numSwaps)s')]))
+
+LAYER_PARAMETERS_TEMPLATE = """\
+               <lmRad:layerId>%(lyrId)s</lmRad:layerId>
+               <lmRad:parameters>
+%(parameters)s
+               </lmRad:parameters>"""
+
+ADD_ANC_LAYER_TEMPLATE = WPS_TEMPLATE % ('addanclayer',
+   WPS_COMPLEX_INPUT_TEMPLATE % ('ancLayer', LAYER_PARAMETERS_TEMPLATE))
+ANC_LAYER_PARAMETERS = [(p, RAD_PARAMETER_TEMPLATE % (p, p)) for p in [
+                                 'attrValue', 'calculateMethod', 'minPercent']]
+
+ADD_PA_LAYER_TEMPLATE = WPS_TEMPLATE % ('addpalayer',
+   WPS_COMPLEX_INPUT_TEMPLATE % ('paLayer', LAYER_PARAMETERS_TEMPLATE))
+PA_LAYER_PARAMETERS = [(p, RAD_PARAMETER_TEMPLATE % (p, p)) for p in [
+                           'attrPresence', 'minPresence', 'maxPresence',
+                           'percentPresence', 'attrAbsence', 'minAbsence',
+                           'maxAbsence', 'percentAbsence']]
+
+ADD_TREE_TEMPLATE = WPS_TEMPLATE % ('addtree',
+   WPS_LITERAL_INPUT_TEMPLATE % ('jsonTree', """
+               %(jTree)s
+            """))
+
+# .............................................................................
+def addBucketBody(shpName, cellShape, cellSize, mapUnits, epsgCode, bbox,
+                  cutout=None):
+   """
+   @summary: Builds the body for adding a bucket to a RAD experiment
+   @note: See RADClient.addBucket
+   """
+   return ADD_BUCKET_TEMPLATE % {
+      'shpName' : escape(shpName),
+      'cellShape' : escape(cellShape),
+      'cellSize' : escape(cellSize),
+      'mapUnits' : escape(mapUnits),
+      'epsgCode' : escape(epsgCode),
+      'bbox' : escape(bbox),
+      'cutout' : _optionalElement(ADD_BUCKET_CUTOUT_TEMPLATE, cutout)
+   }
+
+# .............................................................................
+def addBucketByShapegridIdBody(shpId):
+   """
+   @summary: Builds the body for adding a bucket from an existing shapegrid
+   @note: See RADClient.addBucketByShapegridId
+   """
+   return ADD_BUCKET_BY_ID_TEMPLATE % {'shpId' : escape(shpId)}
+
+# .............................................................................
+def intersectBody():
+   """
+   @summary: Returns the body for requesting a RAD intersect
+   @note: See RADClient.intersectBucket
+   """
+   return INTERSECT_BODY
+
+# .............................................................................
+def randomizeBody(method, numSwaps):
+   """
+   @summary: Builds the body for randomizing a RAD bucket
+   @note: See RADClient.randomizeBucket
+   """
+   return RANDOMIZE_TEMPLATE % {'method' : escape(method),
+                                'numSwaps' : escape(numSwaps)}
+
+# .............................................................................
+def addAncLayerBody(lyrId, **params):
+   """
+   @summary: Builds the body for adding an ancillary layer to a RAD experiment
+   @param lyrId: The id of the layer to add
+   @param params: The ancillary layer parameters.  Parameters that are None
+                     are omitted
+   @note: See RADClient.addAncLayer
+   """
+   return ADD_ANC_LAYER_TEMPLATE % {
+      'lyrId' : escape(lyrId),
+      'parameters' : _layerParameters(ANC_LAYER_PARAMETERS, params)
+   }
+
+# .............................................................................
+def addPALayerBody(lyrId, **params):
+   """
+   @summary: Builds the body for adding a presence / absence layer to a RAD
+                experiment
+   @param lyrId: The id of the layer to add
+   @param params: The presence / absence parameters.  Parameters that are None
+                     are omitted
+   @note: See RADClient.addPALayer
+   """
+   return ADD_PA_LAYER_TEMPLATE % {
+      'lyrId' : escape(lyrId),
+      'parameters' : _layerParameters(PA_LAYER_PARAMETERS, params)
+   }
+
+# .............................................................................
+def addTreeBody(jTree):
+   """
+   @summary: Builds the body for adding a JSON tree to a RAD experiment
+   @param jTree: The JSON tree as a string
+   @note: See RADClient.addTreeForExperiment
+   """
+   return ADD_TREE_TEMPLATE % {'jTree' : escape(jTree)}
+
+# .............................................................................
+def writeAddTreeBody(outF, jTreeChunks):
+   """
+   @summary: Writes the body for adding a JSON tree to a RAD experiment to a
+                file, a piece at a time
+   @param outF: A file-like object to write to
+   @param jTreeChunks: An iterable of strings that make up the JSON tree
+   @note: See RADClient.addOTLTreeForExperiment
+   """
+   prefix, suffix = (ADD_TREE_TEMPLATE % {'jTree' : '\x00'}).split('\x00')
+   outF.write(prefix)
+   for chunk in jTreeChunks:
+      outF.write(escape(chunk))
+   outF.write(suffix)
+
+# .............................................................................
+def _algoParamsSection(algorithmParameters):
+   """
+   @summary: Returns the parameters section of an SDM experiment body.  
+                Sections are kept by their parameters, since a batch of 
+                experiments usually shares a few parameter sets
+   @param algorithmParameters: A list of (name, value) tuples
+   """
+   try:
+      # Include the value types, since 1, 1.0 and True are equal keys
+      key = tuple([(pName, pVal.__class__, pVal) \
+                                    for pName, pVal in algorithmParameters])
+      section = _ALGO_PARAMS_SECTIONS.get(key)
+   except TypeError:
+      # A value that can't be hashed, such as a list
+      key = section = None
+   if section is None:
+      section = SDM_ALGO_PARAMS_TEMPLATE % SDM_ALGO_PARAM_SEPARATOR.join(
+         [SDM_ALGO_PARAM_TEMPLATE % (pName, 
+            escape(pVal) if isinstance(pVal, basestring) else pVal, pName) \
+                                    for pName, pVal in algorithmParameters])
+      if key is not None:
+         if len(_ALGO_PARAMS_SECTIONS) >= MAX_ALGO_PARAMS_SECTIONS:
+            _ALGO_PARAMS_SECTIONS.clear()
+         _ALGO_PARAMS_SECTIONS[key] = section
+   return section
+
+# .............................................................................
+def _layerParameters(paramTemplates, params):
+   """
+   @summary: Fills the parameter elements for an ancillary or presence /
+                absence layer, in the order the service expects
+   @param paramTemplates: A list of (name, template) tuples
+   @param params: Dictionary of parameter name to value
+   """
+   return ''.join([tmpl % escape(params[name]) for name, tmpl in paramTemplates \
+                                             if params.get(name) is not None])
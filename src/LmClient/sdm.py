@@ -39,10 +39,28 @@
             Example for June 7, 2009 9:23:15 AM - 2009-06-07T09:23:15Z
 """
 from collections import namedtuple
+import fnmatch
+import glob
 import json
+import os
 import re
+import shutil
+import tempfile
+import threading
+import zipfile
 
-from LmClient.constants import CONTENT_TYPES
+from LmClient.batch import (DEFAULT_NUM_THREADS, iterConcurrently, 
+                            iterListItems, RateLimiter, runConcurrently)
+from LmClient.constants import CONTENT_TYPES, RASTER_FORMAT_EXTENSIONS
+from LmClient.downloads import openRemoteFile
+from LmClient.hint import (getHintParameters, getHintUrl, HintCache,
+                           iterArchiveHits, MIN_HINT_LENGTH, 
+                           normalizeTaxonName, parseHints, taxonNameMatches)
+from LmClient.ogc import DEFAULT_TILE_PIXELS, getCoverage
+from LmClient.occurrences import (DEFAULT_MAX_BUFFERED_ROWS, 
+                                  splitOccurrenceCsv)
+from LmClient.rasterHeader import preflightRaster, preflightRasters
+from LmClient.requestBodies import sdmExperimentBody
 from LmCommon.common.unicode import fromUnicode, toUnicode
 
 # .............................................................................
@@ -246,6 +264,52 @@ class Algorithm(object):
       raise Exception, "Parameter '%s' not found for this algorithm" \
          % parameterName
    
+# .............................................................................
+## A single experiment to submit with SDMClient.postExperiments.  The fields
+#  match the arguments of SDMClient.postExperiment
+ExperimentSpec = namedtuple('ExperimentSpec', ['algorithm', 'mdlScn', 
+                                               'occSetId', 'prjScns', 
+                                               'mdlMask', 'prjMask', 'email', 
+                                               'name', 'description'])
+ExperimentSpec.__new__.__defaults__ = ((), None, None, None, None, None)
+
+# .............................................................................
+## The outcome of posting one ExperimentSpec with SDMClient.postExperiments.
+#  'spec' is the spec as given.  'expId' is None and 'error' is the exception
+#  raised if the post failed
+ExperimentPost = namedtuple('ExperimentPost', ['spec', 'expId', 'error'])
+
+# .............................................................................
+## The outcome of downloading the shapefile of one SearchHit with
+#  SDMClient.getShapefilesFromOccurrencesHints.  'skipped' is True if the file
+#  already existed.  'error' is None on success
+ShapefileDownload = namedtuple('ShapefileDownload', ['searchHit', 'filename',
+                                                     'skipped', 'error'])
+
+# .............................................................................
+def experimentGrid(occSetIds, algorithms, scenarios, mdlMask=None, 
+                   prjMask=None, email=None):
+   """
+   @summary: Generates an experiment spec for every combination of occurrence
+                set, algorithm and scenarios
+   @param occSetIds: An iterable of occurrence set ids
+   @param algorithms: A list of Algorithm objects or algorithm codes
+   @param scenarios: A list of (model scenario id, list of projection scenario 
+                        ids) tuples
+   @param mdlMask: (optional) A layer id to use as the model mask
+   @param prjMask: (optional) A layer id to use as the projection mask
+   @param email: (optional) An email address to notify when each experiment 
+                    completes
+   @return: A generator of ExperimentSpec named tuples
+   @note: occSetIds is consumed lazily, so it can be a generator
+   """
+   scenarios = [(mdlScn, tuple(prjScns)) for mdlScn, prjScns in scenarios]
+   for occSetId in occSetIds:
+      for algorithm in algorithms:
+         for mdlScn, prjScns in scenarios:
+            yield ExperimentSpec(algorithm, mdlScn, occSetId, prjScns=prjScns,
+                                 mdlMask=mdlMask, prjMask=prjMask, email=email)
+
 # .............................................................................
 class SDMClient(object):
    """
@@ -258,6 +322,8 @@ class SDMClient(object):
       @param cl: Lifemapper client for connection to web services
       """
       self.cl = cl
+      ## Caches the results of the species hint service.  See hint
+      self.hintCache = HintCache()
       ## A list of algorithm objects.  Get the algorithm code from each with the 'code' attribute
       self.algos = self._getAlgorithms() 
 
@@ -376,13 +442,57 @@ class SDMClient(object):
       @param expId: The id of the experiment to be returned. [integer]
       @param filename: The file location to write the package to
       @return: True if the write was successful
+      @note: The package is streamed to disk.  If a previous download was 
+                interrupted, it is resumed
       """
       url = "%s/services/sdm/experiments/%s/package" % (self.cl.server, expId)
-      cnt = self.cl.makeRequest(url, method="GET")
-      f = open(filename, 'wb')
-      f.write(cnt)
-      f.close()
+      self.cl.downloadToFile(url, filename)
       return True
+
+   # .........................................
+   def listExperimentPackageMembers(self, expId):
+      """
+      @summary: Lists the files in the output package of an SDM experiment
+      @param expId: The id of the experiment. [integer]
+      @return: A list of the file names in the package
+      @note: If the server supports HTTP Range requests, only the end of the
+                package, where the list of files is stored, is downloaded
+      """
+      pkgFile = openRemoteFile(self.cl, 
+            "%s/services/sdm/experiments/%s/package" % (self.cl.server, expId))
+      try:
+         return zipfile.ZipFile(pkgFile).namelist()
+      finally:
+         pkgFile.close()
+
+   # .........................................
+   def extractExperimentPackage(self, expId, outDir, members=None):
+      """
+      @summary: Extracts selected files from the output package of an SDM 
+                   experiment, without writing the package to disk
+      @param expId: The id of the experiment. [integer]
+      @param outDir: The directory to extract the files to
+      @param members: (optional) A list of file names or patterns, such as 
+                         '*.tif', of the files to extract.  If None, all 
+                         files are extracted
+      @return: A list of the paths of the extracted files
+      @note: If the server supports HTTP Range requests, only the list of 
+                files and the selected files are downloaded.  Otherwise the 
+                package is streamed to a temporary file that is removed when
+                finished
+      """
+      pkgFile = openRemoteFile(self.cl, 
+            "%s/services/sdm/experiments/%s/package" % (self.cl.server, expId))
+      try:
+         zf = zipfile.ZipFile(pkgFile)
+         extracted = []
+         for name in zf.namelist():
+            if members is None or \
+                  any([fnmatch.fnmatch(name, pattern) for pattern in members]):
+               extracted.append(zf.extract(name, outDir))
+         return extracted
+      finally:
+         pkgFile.close()
        
    # .........................................
    def listExperiments(self, afterTime=None, beforeTime=None, displayName=None, 
@@ -436,7 +546,8 @@ class SDMClient(object):
    # .........................................
    def postExperiment(self, algorithm, mdlScn, occSetId, prjScns=[], 
                             mdlMask=None, prjMask=None, 
-                            email=None, name=None, description=None):
+                            email=None, name=None, description=None,
+                            validate=True):
       """
       @summary: Post a new Lifemapper experiment
       @param algorithm: An Lifemapper SDM algorithm object or algorithm code.  
@@ -458,6 +569,9 @@ class SDMClient(object):
                        this address when the experiment has completed
       @param name: (optional) A name for this experiment
       @param description: (optional) A description for this experiment
+      @param validate: (optional) If False, the algorithm parameters are not
+                          validated.  Use this if they have already been 
+                          checked with validateAlgorithmParameters
       @return: Experiment
       """
       try:
@@ -468,48 +582,14 @@ class SDMClient(object):
          algorithmParameters = []
       
       # Validate algorithm parameters
-      self.validateAlgorithmParameters(algorithmParameters, prjScns)
+      if validate:
+         self.validateAlgorithmParameters(algorithmParameters, prjScns)
 
-      algoParams = """\
-                  <lm:parameters>
-                     {params}
-                  </lm:parameters>
-""".format(params='\n                     '.join(
-                     ["<lm:{name}>{value}</lm:{name}>".format(
-                                        name=param.name, value=param.value) \
-                                     for param in algorithmParameters])) \
-                                        if len(algorithmParameters) > 0 else ""
-      mMask = "            <lm:modelMask>%s</lm:modelMask>" % mdlMask if mdlMask is not None else ""
-      pMask = "            <lm:projectionMask>%s</lm:projectionMask>" % prjMask if prjMask is not None else ""
-      emailSection = "            <lm:email>%s</lm:email>" % email if email is not None else ""
-      nameSection = "            <lm:name>%s</lm:name>" % name if name is not None else ""
-      descSection = "            <lm:description>%s</lm:description>" % description if description is not None else ""
-      prjSection = '\n'.join(([
-          "            <lm:projectionScenario>{scnId}</lm:projectionScenario>".format(scnId=scnId) for scnId in prjScns]))
-      postXml = """\
-      <lm:request xmlns:lm="http://lifemapper.org"
-                  xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
-                    xsi:schemaLocation="http://lifemapper.org 
-                                               /schemas/serviceRequest.xsd">
-            <lm:experiment>
-               <lm:algorithm>
-                  <lm:algorithmCode>{algorithmCode}</lm:algorithmCode>
-{algoParams}
-               </lm:algorithm>
-               <lm:occurrenceSetId>{occSetId}</lm:occurrenceSetId>
-               <lm:modelScenario>{mdlScn}</lm:modelScenario>
-{mMask}
-{email}
-{name}
-{description}
-{projections}
-{pMask}
-            </lm:experiment>
-         </lm:request>""".format(algorithmCode=algoCode, 
-                                 algoParams=algoParams, occSetId=occSetId, 
-                                 mdlScn=mdlScn, mMask=mMask, email=emailSection, 
-                                 projections=prjSection, pMask=pMask,
-                                 name=nameSection, description=descSection)
+      postXml = sdmExperimentBody(algoCode, 
+                        [(param.name, param.value) for param in algorithmParameters],
+                        occSetId, mdlScn, prjScns=prjScns, mdlMask=mdlMask, 
+                        prjMask=prjMask, email=email, name=name, 
+                        description=description)
       url = "%s/services/sdm/experiments/" % self.cl.server
       obj = self.cl.makeRequest(url, 
                                 method="POST", 
@@ -518,6 +598,64 @@ class SDMClient(object):
                                 objectify=True).experiment
       return obj
    
+   # .........................................
+   def postExperiments(self, specs, numThreads=DEFAULT_NUM_THREADS, 
+                             maxPerSecond=None):
+      """
+      @summary: Posts many experiments at once
+      @param specs: An iterable of ExperimentSpec named tuples, such as the 
+                       generator returned by experimentGrid
+      @param numThreads: (optional) The maximum number of experiments to post 
+                            at the same time
+      @param maxPerSecond: (optional) The maximum number of experiments to post
+                              per second.  If None, posts are not limited
+      @return: A list of ExperimentPost named tuples, in the order of specs
+      @note: The parameters of each algorithm are validated once, rather than
+                once per experiment.  Specs with invalid parameters are 
+                returned with the validation error and are not posted
+      @note: A failure does not stop the other experiments from being posted
+      """
+      # Validation depends on the algorithm, its parameter values and on 
+      #    whether there are projections, so cache the result for each.  Equal
+      #    algorithm objects share a key
+      validated = {}
+      validateLock = threading.Lock()
+      
+      # ...............................
+      def _postExperiment(spec):
+         try:
+            algorithmParameters = spec.algorithm.parameters
+            algoCode = spec.algorithm.code
+         except:
+            algorithmParameters = []
+            algoCode = spec.algorithm
+         key = (algoCode, 
+                tuple([(param.name, repr(param.value)) \
+                                          for param in algorithmParameters]), 
+                len(spec.prjScns) > 0)
+         with validateLock:
+            if not validated.has_key(key):
+               try:
+                  self.validateAlgorithmParameters(algorithmParameters, 
+                                                   spec.prjScns)
+                  validated[key] = None
+               except Exception, e:
+                  validated[key] = e
+         if validated[key] is not None:
+            raise validated[key]
+         return self.postExperiment(spec.algorithm, spec.mdlScn, 
+                                    spec.occSetId, prjScns=spec.prjScns, 
+                                    mdlMask=spec.mdlMask, 
+                                    prjMask=spec.prjMask, email=spec.email, 
+                                    name=spec.name, 
+                                    description=spec.description,
+                                    validate=False).id
+      
+      return [ExperimentPost(res.item, res.result, res.error) \
+                 for res in runConcurrently(_postExperiment, specs, 
+                                      numThreads=numThreads, 
+                                      rateLimiter=RateLimiter(maxPerSecond))]
+   
    # --------------------------------------------------------------------------
    # ==========
    # = Layers =
@@ -605,17 +743,16 @@ class SDMClient(object):
                           None, the string is returned
       @note: This function will be removed in a later version in favor of 
                 specifying the format when making the get request
+      @note: If a filename is given, the tiff is streamed to disk and an 
+                interrupted download is resumed
       @raise Exception: Raised if write fails
       """
       url = "%s/services/sdm/layers/%s/tiff" % (self.cl.server, lyrId)
-      cnt = self.cl.makeRequest(url, method="GET")
       if filename is not None:
-         f = open(filename, 'wb')
-         f.write(cnt)
-         f.close()
+         self.cl.downloadToFile(url, filename)
          return None
       else:
-         return cnt
+         return self.cl.makeRequest(url, method="GET")
 
    # .........................................
    def listLayers(self, afterTime=None, beforeTime=None, epsgCode=None,
@@ -664,7 +801,7 @@ class SDMClient(object):
                        fileName=None, layerUrl=None, layerContent=None, 
                        title=None, valUnits=None, startDate=None, endDate=None, 
                        resolution=None, keywords=[], description=None, 
-                       isCategorical=False):
+                       isCategorical=False, preflight=False):
       """
       @summary: Posts an environmental layer
       @param name: The name of the layer
@@ -694,9 +831,21 @@ class SDMClient(object):
       @param description: (optional) A longer description of what this layer is
       @param isCategorical: (optional) Indicates if the layer contains 
                                categorical data
+      @param preflight: (optional) If True and fileName is provided, read the
+                           header of the file to check epsgCode, units, 
+                           dataFormat, and resolution before uploading and to
+                           fill in resolution if it is not provided
       @raise Exception: Raised if none of layerUrl, layerContent, or filename 
                            are provided
-      """
+      @raise RasterPreflightError: Raised if preflight is True and the 
+                                      parameters don't match the file
+      """
+      if preflight and fileName is not None:
+         hdr = preflightRaster(fileName, dataFormat=dataFormat, 
+                               epsgCode=epsgCode, mapUnits=units, 
+                               resolution=resolution)
+         resolution = hdr.resolution
+         
       params = [
                 ("name", name),
                 ("title", title),
@@ -715,7 +864,8 @@ class SDMClient(object):
          params.append(("keyword", kw))
          
       if fileName is not None:
-         body = open(fileName, 'rb').read()
+         # Stream the file to the server instead of reading it into memory
+         body = open(fileName, 'rb')
          headers={"Content-Type" : CONTENT_TYPES[dataFormat]}
       elif layerContent is not None:
          body = layerContent
@@ -728,12 +878,16 @@ class SDMClient(object):
          raise Exception, "Must either specify a file to upload or a url to a file when posting a layer"
          
       url = "%s/services/sdm/layers" % self.cl.server
-      obj = self.cl.makeRequest(url, 
-                                method="POST", 
-                                parameters=params, 
-                                body=body, 
-                                headers=headers, 
-                                objectify=True).layer
+      try:
+         obj = self.cl.makeRequest(url, 
+                                   method="POST", 
+                                   parameters=params, 
+                                   body=body, 
+                                   headers=headers, 
+                                   objectify=True).layer
+      finally:
+         if fileName is not None:
+            body.close()
       return obj
       
    # --------------------------------------------------------------------------
@@ -835,12 +989,15 @@ class SDMClient(object):
                 specifying the format when making the get request
       """
       url = "%s/services/sdm/occurrences/%s/shapefile" % (self.cl.server, occId)
-      cnt = self.cl.makeRequest(url, method="GET")
       if filename is not None:
-         self.cl.autoUnzipShapefile(cnt, filename, overwrite=overwrite)
+         ret = self.cl.openRequest(url, method="GET")
+         try:
+            self.cl.autoUnzipShapefile(ret, filename, overwrite=overwrite)
+         finally:
+            ret.close()
          return None
       else:
-         return cnt
+         return self.cl.makeRequest(url, method="GET")
    
    # .........................................
    def listOccurrenceSets(self, afterTime=None, beforeTime=None, 
@@ -908,24 +1065,79 @@ class SDMClient(object):
       else:
          raise Exception, "Unknown file type"
       
+      # Files are streamed to the server instead of being read into memory
       if fileType.lower() == "shapefile":
          if fileName.endswith('.zip'):
-            postBody = open(fileName, 'rb').read()
+            postBody = open(fileName, 'rb')
          else:
             postBody = self.cl.getAutozipShapefileStream(fileName)
       else:
-         f = open(fileName)
-         postBody = ''.join(f.readlines())
-         f.close()
+         postBody = open(fileName, 'rb')
       
       url = "%s/services/sdm/occurrences" % self.cl.server
-      obj = self.cl.makeRequest(url, 
-                                method="POST", 
-                                parameters=parameters, 
-                                body=postBody, 
-                                headers={"Content-Type": contentType}, 
-                                objectify=True).occurrence
+      try:
+         obj = self.cl.makeRequest(url, 
+                                   method="POST", 
+                                   parameters=parameters, 
+                                   body=postBody, 
+                                   headers={"Content-Type": contentType}, 
+                                   objectify=True).occurrence
+      finally:
+         if hasattr(postBody, 'close'):
+            postBody.close()
       return obj
+   
+   # .........................................
+   def postOccurrenceSetsFromCsv(self, csvFileName, groupField="canonicalName",
+                                       epsgCode=4326, spoolDir=None,
+                                       maxBufferedRows=DEFAULT_MAX_BUFFERED_ROWS,
+                                       numThreads=DEFAULT_NUM_THREADS):
+      """
+      @summary: Splits a CSV file containing occurrence points for many taxa 
+                   and posts an occurrence set for each taxon
+      @param csvFileName: The CSV file to split.  The first row must be a 
+                             header (see sampleData/exampleCSV.csv)
+      @param groupField: (optional) The header of the column holding the name
+                            of each point's taxon.  Each distinct value becomes
+                            the display name of an occurrence set
+      @param epsgCode: (optional) The EPSG code of the occurrence data
+      @param spoolDir: (optional) A directory to write the per-taxon files to.
+                          If None, a temporary directory is used and removed 
+                          when finished.  If provided, the files are left in 
+                          place
+      @param maxBufferedRows: (optional) The maximum number of rows held in 
+                                 memory while splitting the file
+      @param numThreads: (optional) The maximum number of occurrence sets to 
+                            post at the same time
+      @return: A tuple of (dictionary of name to occurrence set id, dictionary
+                  of name to the exception raised for names that failed)
+      """
+      tempDir = None
+      if spoolDir is None:
+         tempDir = spoolDir = tempfile.mkdtemp(prefix="lmOcc")
+      
+      try:
+         fileNames = splitOccurrenceCsv(csvFileName, spoolDir, 
+                                        groupField=groupField, 
+                                        maxBufferedRows=maxBufferedRows)
+         
+         # ...............................
+         def _postOccurrenceSet(nameFile):
+            return self.postOccurrenceSet(nameFile[0], "csv", nameFile[1], 
+                                          epsgCode=epsgCode).id
+         
+         occSetIds = {}
+         failures = {}
+         for res in runConcurrently(_postOccurrenceSet, fileNames.iteritems(),
+                                    numThreads=numThreads):
+            if res.error is None:
+               occSetIds[res.item[0]] = res.result
+            else:
+               failures[res.item[0]] = res.error
+      finally:
+         if tempDir is not None:
+            shutil.rmtree(tempDir, ignore_errors=True)
+      return occSetIds, failures
       
    
    # --------------------------------------------------------------------------
@@ -1029,19 +1241,46 @@ class SDMClient(object):
       @param prjId: The id of the projection to be returned. [integer]
       @param filename: (optional) The location to save the resulting file, if 
                           None, return the content of the response
+      @note: If a filename is given, the tiff is streamed to disk and an 
+                interrupted download is resumed
       @raise Exception: Raised if write fails
       @note: This function will be removed in a later version in favor of 
                 specifying the format when making the get request
       """
       url = "%s/services/sdm/projections/%s/tiff" % (self.cl.server, prjId)
-      cnt = self.cl.makeRequest(url, method="GET")
       if filename is not None:
-         f = open(filename, 'wb')
-         f.write(cnt)
-         f.close()
+         self.cl.downloadToFile(url, filename)
          return None
       else:
-         return cnt
+         return self.cl.makeRequest(url, method="GET")
+
+   # .........................................
+   def getProjectionSubset(self, prjId, bbox, filename=None, resolution=None,
+                                 epsgCode=None, tilePixels=DEFAULT_TILE_PIXELS,
+                                 numThreads=DEFAULT_NUM_THREADS):
+      """
+      @summary: Gets a window of a projection through its OGC (WCS) interface
+                   instead of downloading the whole raster
+      @param prjId: The id of the projection. [integer]
+      @param bbox: The (minX, minY, maxX, maxY) window to get
+      @param filename: (optional) The location to save the GeoTIFF.  If None,
+                          the window is returned as a NumPy array
+      @param resolution: (optional) The cell size to get.  Defaults to the 
+                            resolution of the projection
+      @param epsgCode: (optional) The EPSG code of the bbox.  Defaults to that
+                          of the projection
+      @param tilePixels: (optional) Windows wider or taller than this many 
+                            cells are requested as tiles, concurrently, and 
+                            mosaicked
+      @param numThreads: (optional) The maximum number of tiles to request at
+                            the same time
+      @return: filename, or a NumPy array if filename is None
+      @note: Mosaicking tiles and returning arrays require NumPy and GDAL
+      """
+      prj = self.getProjection(prjId)
+      return getCoverage(self.cl, prj, bbox, filename=filename, 
+                         resolution=resolution, epsgCode=epsgCode,
+                         tilePixels=tilePixels, numThreads=numThreads)
 
    # .........................................
    def getProjectionUrl(self, prjId, frmt=""):
@@ -1268,6 +1507,122 @@ class SDMClient(object):
                                 objectify=True).scenario
       return obj
    
+   # .........................................
+   def postScenarioFromDirectory(self, directory, code, epsgCode, units,
+                                       layerPrefix=None, envLayerTypes=None,
+                                       title=None, author=None, 
+                                       description=None, startDate=None, 
+                                       endDate=None, resolution=None, 
+                                       keywords=[], reuseLayers=True,
+                                       preflight=True,
+                                       numThreads=DEFAULT_NUM_THREADS):
+      """
+      @summary: Uploads each of the raster files in a directory as a layer and
+                   then posts a climate scenario made of those layers
+      @param directory: The local directory containing the raster files.  Files
+                           with the extensions in 
+                           constants.RASTER_FORMAT_EXTENSIONS are uploaded
+      @param code: The code to associate with the scenario
+      @param epsgCode: The EPSG code representing the coordinate system 
+                          projection of the scenario and its layers
+      @param units: The units for the cell sizes of the scenario and its layers
+      @param layerPrefix: (optional) Prefix for the name of each layer.  Each
+                             layer is named with this prefix followed by the 
+                             base name of its file.  Defaults to the scenario
+                             code followed by an underscore
+      @param envLayerTypes: (optional) A dictionary of file base name to 
+                               environmental layer type code.  The base name of
+                               the file is used as the type code for files that
+                               are not in the dictionary
+      @param title: (optional) A title for this scenario
+      @param author: (optional) The author of this scenario
+      @param description: (optional) A longer description of the scenario
+      @param startDate: (optional) The start date for this scenario and its 
+                           layers.  See time formats in module documentation
+      @param endDate: (optional) The end date for this scenario and its layers.
+                         See time formats in module documentation
+      @param resolution: (optional) The resolution of the cells
+      @param keywords: (optional) A list of keywords to associate with the 
+                          scenario and its layers
+      @param reuseLayers: (optional) If True, layers that have already been 
+                             uploaded with the same name and EPSG code are 
+                             used instead of being uploaded again
+      @param preflight: (optional) If True, check the header of every file 
+                           against the EPSG code, units, and resolution before
+                           anything is uploaded.  Each layer's resolution is
+                           read from its file if resolution is not provided, 
+                           and the scenario is given that resolution if every
+                           layer has the same one
+      @param numThreads: (optional) The maximum number of layers to upload at 
+                            the same time
+      @return: The newly posted scenario
+      @raise Exception: Raised if there are no raster files in the directory, 
+                           if any of the files fail preflight, or if any of the
+                           layer uploads fail.  The scenario is not posted in 
+                           those cases
+      """
+      if layerPrefix is None:
+         layerPrefix = "%s_" % code
+      if envLayerTypes is None:
+         envLayerTypes = {}
+      
+      layerFiles = []
+      for fn in sorted(glob.glob(os.path.join(directory, '*'))):
+         base, ext = os.path.splitext(os.path.basename(fn))
+         if ext.lower() in RASTER_FORMAT_EXTENSIONS:
+            layerFiles.append(("%s%s" % (layerPrefix, base), base, fn, 
+                               RASTER_FORMAT_EXTENSIONS[ext.lower()]))
+      if len(layerFiles) == 0:
+         raise Exception, "No raster files found in %s" % directory
+      
+      layerResolutions = {}
+      if preflight:
+         hdrs, failures = preflightRasters([lf[2] for lf in layerFiles], 
+                                           epsgCode=epsgCode, mapUnits=units,
+                                           resolution=resolution)
+         if len(failures) > 0:
+            raise Exception, "Failed preflight: %s" % '; '.join(
+                                    [toUnicode(e) for e in failures.values()])
+         for fn, hdr in hdrs.iteritems():
+            layerResolutions[fn] = hdr.resolution
+         # Give the scenario the resolution read from its layers if they all 
+         #    share one
+         inferred = set([r for r in layerResolutions.values() if r is not None])
+         if resolution is None and len(inferred) == 1:
+            resolution = inferred.pop()
+      
+      existing = {}
+      if reuseLayers:
+         for item in iterListItems(self.listLayers, epsgCode=epsgCode):
+            existing[_getListItemName(item)] = item.id
+      
+      # ...............................
+      def _postLayer(layerFile):
+         name, base, fn, dataFormat = layerFile
+         if existing.has_key(name):
+            return existing[name]
+         lyr = self.postLayer(name, epsgCode, envLayerTypes.get(base, base), 
+                              units, dataFormat, fileName=fn, 
+                              startDate=startDate, endDate=endDate, 
+                              resolution=layerResolutions.get(fn, resolution),
+                              keywords=keywords)
+         return lyr.id
+      
+      layerIds = []
+      failures = []
+      for res in runConcurrently(_postLayer, layerFiles, numThreads=numThreads):
+         if res.error is None:
+            layerIds.append(res.result)
+         else:
+            failures.append("%s (%s)" % (res.item[2], toUnicode(res.error)))
+      if len(failures) > 0:
+         raise Exception, "Failed to upload layers: %s" % ', '.join(failures)
+      
+      return self.postScenario(layerIds, code, epsgCode, units, title=title,
+                               author=author, description=description,
+                               startDate=startDate, endDate=endDate,
+                               resolution=resolution, keywords=keywords)
+   
    # --------------------------------------------------------------------------
    # ==============
    # = Type Codes =
@@ -1378,7 +1733,7 @@ class SDMClient(object):
    # --------------------------------------------------------------------------
 
    # .........................................
-   def hint(self, query, maxReturned=None, serviceRoot=None):
+   def hint(self, query, maxReturned=None, serviceRoot=None, useCache=True):
       """
       @summary: Queries for occurrence sets that match the partial query string
       @param query: The partial string to match (genus species).  Must be at 
@@ -1387,49 +1742,87 @@ class SDMClient(object):
       @param serviceRoot: (optional) The web server root for the hint service.  
                              Defaults to the instance that the object is 
                              connected to if None is provided.
+      @param useCache: (optional) If True, results are taken from and added 
+                          to the client's hint cache, so queries that extend 
+                          an earlier query are answered without a request
       @note: This will return a list of SearchHit objects.  These are named
                 tuples that have the attributes: name, id, numPoints, 
                 downloadUrl and binomial.  These attributes are pulled from the 
                 response from the Lucene query and may change over time.
+      @note: The cache is the 'hintCache' attribute of the client.  Results are
+                kept for hintCache.ttl seconds
       """
       if serviceRoot is None:
          serviceRoot = self.cl.server
          
-      SearchHit = namedtuple('SearchHit', ['name', 'id', 'numPoints', 
-                                           'downloadUrl', 'binomial', 
-                                           'numModels'])
-      if len(query) < 3:
+      if len(query) < MIN_HINT_LENGTH:
          raise Exception, "Please provide at least 3 characters to hint service"
       
-      params = [
-                ("maxReturned", maxReturned),
-                ("format", "json")
-               ]
-      url = "%s/hint/species/%s" % (serviceRoot, query)
-      
-      res = self.cl.makeRequest(url, method="get", parameters=params)
-      
-      jObj = json.loads(res)
-      
-      try:
-         # Old json format
-         jsonItems = jObj.get('columns')[0]
-      except:
-         # New json format
-         jsonItems = jObj.get('hits')
+      if useCache:
+         items = self.hintCache.get(serviceRoot, query, maxReturned)
+         if items is not None:
+            return items
+
+      res = self.cl.makeRequest(getHintUrl(serviceRoot, query), method="get", 
+                                parameters=getHintParameters(maxReturned))
       
-      items = []
-      for item in jsonItems:
-         items.append(SearchHit(name=item.get('name'),
-                                id=int(item.get('occurrenceSet')),
-                                numPoints=int(item.get('numPoints')),
-                                downloadUrl=item.get('downloadUrl'),
-                                binomial=item.get('binomial'),
-                                numModels=int(item.get('numModels'))))
+      items = parseHints(res)
+      if useCache:
+         self.hintCache.put(serviceRoot, query, items, maxReturned)
       if maxReturned is not None and maxReturned < len(items):
          items = items[:maxReturned]
       return items
    
+   # .........................................
+   def resolveNames(self, names, match='binomial', numThreads=DEFAULT_NUM_THREADS,
+                          maxPerSecond=None, serviceRoot=None):
+      """
+      @summary: Finds the occurrence sets for many taxon names using the hint
+                   service
+      @param names: An iterable of taxon names
+      @param match: (optional) How hits are matched to names, 'exact', 
+                       'binomial' or 'prefix'.  See hint.taxonNameMatches
+      @param numThreads: (optional) The maximum number of requests at once
+      @param maxPerSecond: (optional) The maximum number of requests per 
+                              second.  Names answered by the hint cache do not
+                              count.  If None, requests are not limited
+      @param serviceRoot: (optional) The web server root for the hint service
+      @return: A tuple of (dictionary of name to a list of matching SearchHit 
+                  named tuples, list of names without a match, dictionary of 
+                  name to the exception raised for names whose request failed)
+      @note: Names are normalized and duplicates are requested once.  The
+                results are keyed by the names as given
+      """
+      if serviceRoot is None:
+         serviceRoot = self.cl.server
+      byNormalized = {}
+      for name in names:
+         byNormalized.setdefault(normalizeTaxonName(name), []).append(name)
+      rateLimiter = RateLimiter(maxPerSecond)
+      
+      # ...............................
+      def _resolve(normName):
+         if len(normName) < MIN_HINT_LENGTH:
+            return []
+         if self.hintCache.get(serviceRoot, normName) is None:
+            rateLimiter.wait()
+         return [hit for hit in self.hint(normName, serviceRoot=serviceRoot) \
+                               if taxonNameMatches(hit, normName, match=match)]
+      
+      resolved = {}
+      unresolved = []
+      failures = {}
+      for res in iterConcurrently(_resolve, byNormalized.keys(), 
+                                  numThreads=numThreads):
+         for name in byNormalized[res.item]:
+            if res.error is not None:
+               failures[name] = res.error
+            elif len(res.result) > 0:
+               resolved[name] = res.result
+            else:
+               unresolved.append(name)
+      return resolved, unresolved, failures
+   
    # .........................................
    def searchArchive(self, query, maxReturned=None, serviceRoot=None):
       """
@@ -1449,6 +1842,37 @@ class SDMClient(object):
       resp = self.cl.makeRequest(url, method="get", objectify=True)
       return resp.hits
 
+   # .........................................
+   def iterSearchArchive(self, query, maxReturned=None, serviceRoot=None,
+                               index=None):
+      """
+      @summary: Queries the Lifemapper Solr index for archive data and yields
+                   the hits as they are parsed from the response
+      @param query: The partial string to match (genus species).
+      @param maxReturned: (optional) The maximum number of hits to yield.  The
+                             request is closed once this many are read
+      @param serviceRoot: (optional) The web server root for the archive hint 
+                             service.  Defaults to the instance that the object 
+                             is connected to if None is provided.
+      @param index: (optional) An ArchiveIndex that each hit is added to
+      @note: Unlike searchArchive, the response is never held in memory at
+                once, so this is suited to broad queries
+      @rtype: A generator of archive hits
+      """
+      if serviceRoot is None:
+         serviceRoot = self.cl.server
+      url = "%s/hint/archive/%s" % (serviceRoot, query)
+      ret = self.cl.openRequest(url, method="get")
+      try:
+         for i, hit in enumerate(iterArchiveHits(ret)):
+            if maxReturned is not None and i >= maxReturned:
+               break
+            if index is not None:
+               index.add(hit)
+            yield hit
+      finally:
+         ret.close()
+
    # .........................................
    def getShapefileFromOccurrencesHint(self, searchHit, filename, 
                                            instanceName=None, overwrite=False):
@@ -1465,9 +1889,60 @@ class SDMClient(object):
       @note: This code should be hardened.  It is mainly for the Spring 2015 
                 iDigBio hackathon
       """
-      url = searchHit.downloadUrl
-      cnt = self.cl.makeRequest(url, method="GET")
-      self.cl.autoUnzipShapefile(cnt, filename, overwrite=overwrite)
+      ret = self.cl.openRequest(searchHit.downloadUrl, method="GET")
+      try:
+         self.cl.autoUnzipShapefile(ret, filename, overwrite=overwrite)
+      finally:
+         ret.close()
+
+   # .........................................
+   def getShapefilesFromOccurrencesHints(self, searchHits, outDir, frmt='shp',
+                                              overwrite=False, 
+                                              numThreads=DEFAULT_NUM_THREADS):
+      """
+      @summary: Downloads the shapefiles of many hint service results 
+                   concurrently
+      @param searchHits: An iterable of SearchHit named tuples
+      @param outDir: The directory to write to.  It is created if it does not
+                        exist.  Files are named occurrence_<id>.shp (or .zip)
+      @param frmt: (optional) 'shp' to extract each shapefile, or 'zip' to
+                      keep the zipped shapefiles
+      @param overwrite: (optional) If False, hits whose file already exists
+                           are skipped
+      @param numThreads: (optional) The maximum number of downloads at once
+      @return: A list of ShapefileDownload named tuples, in the order of
+                  searchHits
+      @note: Each archive is streamed, to its .zip file or to a temporary file
+                that it is extracted from, so no archive is held in memory
+      """
+      if frmt not in ('shp', 'zip'):
+         raise Exception, "Unknown shapefile format: %s" % frmt
+      if not os.path.exists(outDir):
+         os.makedirs(outDir)
+      
+      # ...............................
+      def _download(searchHit):
+         base = os.path.join(outDir, "occurrence_%s" % searchHit.id)
+         fn = "%s.%s" % (base, frmt)
+         if os.path.exists(fn) and not overwrite:
+            return fn, True
+         if frmt == 'zip':
+            self.cl.downloadToFile(searchHit.downloadUrl, fn, resume=True)
+         else:
+            # Extract from the response so a kept .zip of the same hit is 
+            #    left alone
+            self.getShapefileFromOccurrencesHint(searchHit, fn, overwrite=True)
+         return fn, False
+      
+      results = []
+      for res in runConcurrently(_download, searchHits, numThreads=numThreads):
+         if res.error is None:
+            results.append(ShapefileDownload(res.item, res.result[0], 
+                                             res.result[1], None))
+         else:
+            results.append(ShapefileDownload(res.item, None, False, 
+                                             res.error))
+      return results
 
    # .........................................
    def getOgcEndpoint(self, obj):
@@ -1512,4 +1987,22 @@ class SDMClient(object):
             if castFunc(param.allowProjectionsIfValue) != castFunc(param.value)\
                   and len(prjScns) > 0:
                raise ProjectionsNotAllowed(param)
-      
+
+# =============================================================================
+# =                             Helper Functions                              =
+# =============================================================================
+# .............................................................................
+def _getListItemName(item):
+   """
+   @summary: Returns the name of an item returned from a list service
+   @param item: An item returned by one of the list functions
+   @note: List items report their name as 'title', full objects as 'name'
+   """
+   for att in ['title', 'name']:
+      try:
+         val = getattr(item, att)
+         if val is not None:
+            return val
+      except:
+         pass
+   return None
@@ -0,0 +1,344 @@
+"""
+@summary: Module containing a class for keeping a local copy of Lifemapper
+             archive metadata up to date
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+
+@note: The local store is a directory with one sub-directory per resource
+          type.  Each object is stored as the XML document returned by the
+          web services, named by its id.  Watermarks are kept in a JSON file
+          named sync.json at the top of the directory
+@note: If a MetadataIndex is given to ArchiveSync, it is updated with every
+          object that is stored or removed
+@note: Example, sync SDM projections and experiments:
+          syncer = ArchiveSync(store, cl.sdm)
+          for resourceType in ['sdmExperiments', 'sdmProjections']:
+             print syncer.sync(resourceType)
+"""
+from collections import namedtuple
+import json
+import os
+import time
+
+from LmClient.batch import (DEFAULT_NUM_THREADS, formatTime, iterConcurrently,
+                            iterListItems)
+from LmClient.downloads import writeFileAtomic
+
+# Seconds subtracted from each watermark to allow for differences between the
+#    local clock and the server clock
+DEFAULT_CLOCK_SKEW = 300
+
+# The number of fetched objects added to a MetadataIndex in each transaction
+INDEX_BATCH_SIZE = 500
+
+# .............................................................................
+## The resource types that can be synchronized.  Each maps to a tuple of
+#  (client, list function name, count function name, service path) where
+#  client is 'sdm' or 'rad'
+SYNC_RESOURCES = {
+   'sdmExperiments' : ('sdm', 'listExperiments', 'countExperiments',
+                       'services/sdm/experiments'),
+   'sdmLayers' : ('sdm', 'listLayers', 'countLayers', 'services/sdm/layers'),
+   'sdmOccurrenceSets' : ('sdm', 'listOccurrenceSets', 'countOccurrenceSets',
+                          'services/sdm/occurrences'),
+   'sdmProjections' : ('sdm', 'listProjections', 'countProjections',
+                       'services/sdm/projections'),
+   'sdmScenarios' : ('sdm', 'listScenarios', 'countScenarios',
+                     'services/sdm/scenarios'),
+   'sdmTypeCodes' : ('sdm', 'listTypeCodes', 'countTypeCodes',
+                     'services/sdm/typecodes'),
+   'radExperiments' : ('rad', 'listExperiments', 'countExperiments',
+                       'services/rad/experiments'),
+   'radLayers' : ('rad', 'listLayers', 'countLayers', 'services/rad/layers'),
+   'radShapegrids' : ('rad', 'listShapegrids', 'countShapegrids',
+                      'services/rad/shapegrids')
+}
+
+# .............................................................................
+## The result of synchronizing one resource type
+SyncSummary = namedtuple('SyncSummary', ['resourceType', 'numUpdated',
+                                         'numDeleted', 'failures',
+                                         'watermark'])
+
+# .............................................................................
+class DirectoryStore(object):
+   """
+   @summary: Stores the XML document for each synchronized object in a
+                directory tree
+   """
+   # .........................................
+   def __init__(self, baseDir):
+      """
+      @summary: Constructor
+      @param baseDir: The directory to store objects in.  It is created if it
+                         does not exist
+      """
+      self.baseDir = baseDir
+      self.stateFile = os.path.join(baseDir, 'sync.json')
+      if not os.path.exists(baseDir):
+         os.makedirs(baseDir)
+
+   # .........................................
+   def _resourceDir(self, resourceType):
+      """
+      @summary: Returns the directory for a resource type, creating it if
+                   needed
+      """
+      resDir = os.path.join(self.baseDir, resourceType)
+      if not os.path.exists(resDir):
+         os.makedirs(resDir)
+      return resDir
+
+   # .........................................
+   def getState(self):
+      """
+      @summary: Returns the stored synchronization state dictionary
+      """
+      if os.path.exists(self.stateFile):
+         with open(self.stateFile) as inF:
+            return json.load(inF)
+      return {}
+
+   # .........................................
+   def setState(self, state):
+      """
+      @summary: Stores the synchronization state dictionary
+      @param state: A JSON serializable dictionary
+      """
+      writeFileAtomic(self.stateFile, json.dumps(state, indent=3))
+
+   # .........................................
+   def listIds(self, resourceType):
+      """
+      @summary: Returns a set of the stored ids for a resource type
+      """
+      return set([int(fn[:-4]) for fn in os.listdir(
+                                           self._resourceDir(resourceType)) \
+                                                      if fn.endswith('.xml')])
+
+   # .........................................
+   def read(self, resourceType, objId):
+      """
+      @summary: Returns the stored XML document for an object, or None if it
+                   is not stored
+      """
+      fn = os.path.join(self._resourceDir(resourceType), "%s.xml" % objId)
+      if os.path.exists(fn):
+         with open(fn, 'rb') as inF:
+            return inF.read()
+      return None
+
+   # .........................................
+   def write(self, resourceType, objId, content):
+      """
+      @summary: Stores the XML document for an object
+      """
+      writeFileAtomic(os.path.join(self._resourceDir(resourceType),
+                                     "%s.xml" % objId), content)
+
+   # .........................................
+   def delete(self, resourceType, objId):
+      """
+      @summary: Removes an object from the store
+      """
+      fn = os.path.join(self._resourceDir(resourceType), "%s.xml" % objId)
+      if os.path.exists(fn):
+         os.remove(fn)
+
+# .............................................................................
+class ArchiveSync(object):
+   """
+   @summary: Keeps a local store of Lifemapper objects up to date by only
+                requesting the objects modified since the last run
+   @note: Deleted objects are found by reconciliation.  After a sync, every
+             object on the server should be in the store, so if the store
+             holds more objects than the server counts, the full list of ids
+             is requested and the missing ones are removed.  This costs one
+             count request per run unless something was deleted
+   """
+   # .........................................
+   def __init__(self, store, sdmClient=None, radClient=None, index=None,
+                      clockSkew=DEFAULT_CLOCK_SKEW, perPage=100,
+                      numThreads=DEFAULT_NUM_THREADS):
+      """
+      @summary: Constructor
+      @param store: A DirectoryStore, or any object with the same methods, to
+                       keep the objects in
+      @param sdmClient: (optional) An SDMClient object, required for the 'sdm'
+                           resource types
+      @param radClient: (optional) A RADClient object, required for the 'rad'
+                           resource types
+      @param index: (optional) A MetadataIndex to update with the objects that
+                       are stored and removed.  It is only used from the 
+                       calling thread
+      @param clockSkew: (optional) The number of seconds that the local clock
+                           may differ from the server clock
+      @param perPage: (optional) The page size used for the list services
+      @param numThreads: (optional) The maximum number of objects to request
+                            at the same time
+      """
+      self.store = store
+      self.clients = {'sdm' : sdmClient, 'rad' : radClient}
+      self.index = index
+      self.clockSkew = clockSkew
+      self.perPage = perPage
+      self.numThreads = numThreads
+
+   # .........................................
+   def getWatermark(self, resourceType):
+      """
+      @summary: Returns the time, in seconds since the epoch, of the last
+                   sync of a resource type, or None
+      """
+      return self.store.getState().get(resourceType, {}).get('watermark')
+
+   # .........................................
+   def getRetryIds(self, resourceType):
+      """
+      @summary: Returns a list of the ids of objects that failed in the last
+                   sync of a resource type and will be requested again
+      """
+      return self.store.getState().get(resourceType, {}).get('retryIds', [])
+
+   # .........................................
+   def sync(self, resourceType, reconcile=True, fullReconcile=False):
+      """
+      @summary: Requests the objects of a resource type modified since the
+                   last sync and adds them to the store
+      @param resourceType: One of the keys of SYNC_RESOURCES
+      @param reconcile: (optional) If True, check for and remove objects that
+                           have been deleted from the server
+      @param fullReconcile: (optional) If True, always compare the full list
+                               of ids instead of first comparing counts
+      @rtype: SyncSummary
+      @note: The watermark is always advanced.  The ids of objects that could
+                not be stored are kept in the state and requested again on the
+                next sync, along with the objects modified since.  An id that
+                fails because the object no longer exists is dropped
+      """
+      client, listFunc, countFunc = self._getFunctions(resourceType)
+      roundStart = time.time()
+
+      watermark = self.getWatermark(resourceType)
+      afterTime = None
+      if watermark is not None:
+         afterTime = formatTime(watermark - self.clockSkew)
+
+      ids = [item.id for item in iterListItems(listFunc, perPage=self.perPage,
+                                                afterTime=afterTime)]
+      listedIds = set([int(objId) for objId in ids])
+      ids.extend([objId for objId in self.getRetryIds(resourceType) \
+                                                if objId not in listedIds])
+      urlBase = "%s/%s" % (client.cl.server, SYNC_RESOURCES[resourceType][3])
+
+      # ...............................
+      def _fetch(objId):
+         content = client.cl.makeRequest("%s/%s" % (urlBase, objId))
+         self.store.write(resourceType, objId, content)
+         return content
+
+      useIndex = self.index is not None and self.index.supports(resourceType)
+      numUpdated = 0
+      failures = {}
+      toIndex = []
+      for res in iterConcurrently(_fetch, ids, numThreads=self.numThreads):
+         if res.error is None:
+            numUpdated += 1
+            if useIndex:
+               toIndex.append(res.result)
+               if len(toIndex) >= INDEX_BATCH_SIZE:
+                  self.index.addXml(resourceType, toIndex)
+                  toIndex = []
+         else:
+            failures[res.item] = res.error
+      if len(toIndex) > 0:
+         self.index.addXml(resourceType, toIndex)
+
+      numDeleted = 0
+      if reconcile:
+         numDeleted = self.reconcile(resourceType, full=fullReconcile)
+
+      watermark = roundStart
+      retryIds = sorted([int(objId) for objId, e in failures.iteritems() \
+                                             if getattr(e, 'code', None) != 404])
+      state = self.store.getState()
+      state[resourceType] = {'watermark' : watermark, 'retryIds' : retryIds}
+      self.store.setState(state)
+      return SyncSummary(resourceType, numUpdated, numDeleted, failures,
+                         watermark)
+
+   # .........................................
+   def syncAll(self, resourceTypes=None, **kwargs):
+      """
+      @summary: Synchronizes several resource types
+      @param resourceTypes: (optional) A list of resource types.  If None, all
+                               types with an available client are synchronized
+      @param kwargs: (optional) Keyword arguments passed to sync
+      @return: A list of SyncSummary named tuples
+      """
+      if resourceTypes is None:
+         resourceTypes = sorted([rt for rt, cfg in SYNC_RESOURCES.iteritems() \
+                                          if self.clients[cfg[0]] is not None])
+      return [self.sync(rt, **kwargs) for rt in resourceTypes]
+
+   # .........................................
+   def reconcile(self, resourceType, full=False):
+      """
+      @summary: Removes stored objects that no longer exist on the server
+      @param resourceType: One of the keys of SYNC_RESOURCES
+      @param full: (optional) If True, compare the full list of ids even if
+                      the counts match
+      @return: The number of objects removed from the store
+      """
+      client, listFunc, countFunc = self._getFunctions(resourceType)
+      localIds = self.store.listIds(resourceType)
+      if not full and countFunc() >= len(localIds):
+         return 0
+
+      remoteIds = set([int(item.id) for item in iterListItems(listFunc,
+                                                      perPage=self.perPage)])
+      deletedIds = localIds - remoteIds
+      useIndex = self.index is not None and self.index.supports(resourceType)
+      for objId in deletedIds:
+         self.store.delete(resourceType, objId)
+         if useIndex:
+            self.index.remove(resourceType, objId)
+      return len(deletedIds)
+
+   # .........................................
+   def _getFunctions(self, resourceType):
+      """
+      @summary: Returns the client, list function and count function for a
+                   resource type
+      """
+      try:
+         clientName, listName, countName, _ = SYNC_RESOURCES[resourceType]
+      except KeyError:
+         raise Exception, "Unknown resource type: %s" % resourceType
+      client = self.clients[clientName]
+      if client is None:
+         raise Exception, "A %s client is required to sync %s" % (clientName,
+                                                                 resourceType)
+      return client, getattr(client, listName), getattr(client, countName)
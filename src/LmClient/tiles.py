@@ -0,0 +1,477 @@
+"""
+@summary: Module containing a disk cache and a concurrent fetcher for XYZ map
+             tiles served by the OGC (WMS) endpoint of Lifemapper objects
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+
+@note: Tiles are stored by the SHA-1 of their content, so identical tiles,
+          such as the many empty tiles over the oceans, are stored once.  Each
+          tile request is mapped to its content by a small reference file
+@note: Example, fetch the tiles of a projection for a viewer:
+          cache = TileCache('tileCache', maxBytes=200*1024*1024)
+          fetcher = TileFetcher(cl.sdm.cl, cl.sdm.getOgcEndpoint(prj), cache)
+          png = fetcher.getTile(3, 2, 3)
+"""
+from collections import deque, OrderedDict
+import hashlib
+import os
+import threading
+import urllib
+
+from LmClient.batch import DEFAULT_NUM_THREADS, iterConcurrently
+from LmClient.downloads import removeFile, writeFileAtomic
+from LmClient.ogc import (getMapParameters, numTiles, parseOgcEndpoint,
+                          tileBBox, TILE_SIZE)
+
+# The default maximum size of a tile cache, in bytes
+DEFAULT_CACHE_BYTES = 100 * 1024 * 1024
+
+# The default maximum number of tiles waiting to be prefetched
+DEFAULT_MAX_PREFETCH = 64
+
+# .............................................................................
+class TileCache(object):
+   """
+   @summary: A content-addressed disk cache of map tiles that evicts the least
+                recently used tiles when it grows larger than a maximum size
+   @note: The cache may be shared by the threads of a TileFetcher.  It should
+             not be shared by several processes
+   """
+   # .........................................
+   def __init__(self, cacheDir, maxBytes=DEFAULT_CACHE_BYTES):
+      """
+      @summary: Constructor
+      @param cacheDir: The directory to store tiles in.  It is created if it
+                          does not exist.  Tiles already in it are reused
+      @param maxBytes: (optional) The maximum total size of the stored tiles
+      """
+      self.cacheDir = cacheDir
+      self.maxBytes = maxBytes
+      self.numBytes = 0
+      self._lock = threading.Lock()
+      # Content hash -> size, least recently used first
+      self._blobs = OrderedDict()
+      # Key hash -> content hash, and content hash -> set of key hashes
+      self._refs = {}
+      self._users = {}
+      self._load()
+
+   # .........................................
+   def _path(self, kind, digest):
+      """
+      @summary: Returns the file for a blob or reference.  Files are spread
+                   over sub-directories named by the first two hex digits
+      """
+      return os.path.join(self.cacheDir, kind, digest[:2], digest)
+
+   # .........................................
+   def _load(self):
+      """
+      @summary: Reads the existing contents of the cache directory
+      """
+      blobs = []
+      blobDir = os.path.join(self.cacheDir, 'blobs')
+      for dirPath, _, fns in os.walk(blobDir):
+         for fn in fns:
+            st = os.stat(os.path.join(dirPath, fn))
+            blobs.append((st.st_mtime, fn, st.st_size))
+      for _, digest, size in sorted(blobs):
+         self._blobs[digest] = size
+         self.numBytes += size
+
+      refDir = os.path.join(self.cacheDir, 'refs')
+      for dirPath, _, fns in os.walk(refDir):
+         for fn in fns:
+            with open(os.path.join(dirPath, fn)) as inF:
+               digest = inF.read().strip()
+            if self._blobs.has_key(digest):
+               self._addRef(fn, digest)
+            else:
+               os.remove(os.path.join(dirPath, fn))
+      self._evict()
+
+   # .........................................
+   def get(self, key):
+      """
+      @summary: Returns the cached content for a key, or None
+      @param key: A string identifying the tile, such as its request url
+      """
+      keyHash = hashlib.sha1(key).hexdigest()
+      with self._lock:
+         digest = self._refs.get(keyHash)
+         if digest is None:
+            return None
+         # Mark as most recently used, here and on disk for the next run
+         self._blobs[digest] = self._blobs.pop(digest)
+      try:
+         fn = self._path('blobs', digest)
+         with open(fn, 'rb') as inF:
+            content = inF.read()
+         os.utime(fn, None)
+         return content
+      except (IOError, OSError):
+         # Evicted by another thread since the lookup
+         return None
+
+   # .........................................
+   def has(self, key):
+      """
+      @summary: Returns True if a key is cached, without marking it as used
+      """
+      with self._lock:
+         return self._refs.has_key(hashlib.sha1(key).hexdigest())
+
+   # .........................................
+   def put(self, key, content):
+      """
+      @summary: Stores the content for a key, evicting old tiles if the cache
+                   becomes too large
+      @param key: A string identifying the tile, such as its request url
+      @param content: The tile content
+      @return: The SHA-1 hex digest of the content
+      """
+      keyHash = hashlib.sha1(key).hexdigest()
+      digest = hashlib.sha1(content).hexdigest()
+      # Files are written without holding the lock, so that readers are not
+      #    kept waiting.  Only the index is updated under it
+      with self._lock:
+         wroteBlob = not self._blobs.has_key(digest)
+         wroteRef = self._refs.get(keyHash) != digest
+      if wroteBlob:
+         writeFileAtomic(self._path('blobs', digest), content)
+      if wroteRef:
+         writeFileAtomic(self._path('refs', keyHash), digest)
+      
+      with self._lock:
+         if self._blobs.has_key(digest):
+            self._blobs[digest] = self._blobs.pop(digest)
+            isNew = False
+         else:
+            if not wroteBlob:
+               # Evicted by another thread since the check
+               writeFileAtomic(self._path('blobs', digest), content)
+            self._blobs[digest] = len(content)
+            self.numBytes += len(content)
+            isNew = True
+         if self._refs.get(keyHash) != digest:
+            # The reference file has been replaced, only update the index
+            self._removeRef(keyHash, removeFile=not wroteRef)
+            if not wroteRef:
+               writeFileAtomic(self._path('refs', keyHash), digest)
+            self._addRef(keyHash, digest)
+         if isNew:
+            self._evict()
+      return digest
+
+   # .........................................
+   def clear(self):
+      """
+      @summary: Removes every tile from the cache
+      """
+      with self._lock:
+         maxBytes = self.maxBytes
+         self.maxBytes = 0
+         self._evict()
+         self.maxBytes = maxBytes
+
+   # .........................................
+   def _addRef(self, keyHash, digest):
+      """
+      @summary: Records that a key refers to a blob
+      """
+      self._refs[keyHash] = digest
+      self._users.setdefault(digest, set()).add(keyHash)
+
+   # .........................................
+   def _removeRef(self, keyHash, removeFile=True):
+      """
+      @summary: Removes a key reference, if there is one
+      @param removeFile: (optional) If False, only the index is updated
+      """
+      digest = self._refs.pop(keyHash, None)
+      if digest is not None:
+         self._users[digest].discard(keyHash)
+         if removeFile:
+            removeFile(self._path('refs', keyHash))
+
+   # .........................................
+   def _evict(self):
+      """
+      @summary: Removes the least recently used blobs, and the references to
+                   them, until the cache fits in its maximum size
+      """
+      while self.numBytes > self.maxBytes and len(self._blobs) > 0:
+         digest, size = self._blobs.popitem(last=False)
+         self.numBytes -= size
+         for keyHash in self._users.pop(digest, set()):
+            self._refs.pop(keyHash, None)
+            removeFile(self._path('refs', keyHash))
+         removeFile(self._path('blobs', digest))
+
+# .............................................................................
+class TileFetcher(object):
+   """
+   @summary: Fetches XYZ map tiles from the OGC endpoint of a Lifemapper 
+                object with WMS GetMap requests, through a TileCache
+   @note: After a tile is returned, the tiles around it at the same zoom level
+             are fetched in the background so that panning is served from the
+             cache.  The most recently requested neighbours are fetched first.
+             At most maxPrefetch tiles wait to be prefetched; older ones are
+             dropped, as are all waiting tiles when the zoom level changes
+   @note: Call close, or use the fetcher in a with statement, to stop the 
+             background threads
+   """
+   # .........................................
+   def __init__(self, cl, endpoint, cache, srs='EPSG:3857', frmt='image/png',
+                      tileSize=TILE_SIZE, numThreads=DEFAULT_NUM_THREADS,
+                      prefetchRadius=1, maxPrefetch=DEFAULT_MAX_PREFETCH):
+      """
+      @summary: Constructor
+      @param cl: A Lifemapper _Client object to make requests with
+      @param endpoint: The OGC endpoint of an object, as returned by 
+                          SDMClient.getOgcEndpoint
+      @param cache: The TileCache to store tiles in
+      @param srs: (optional) The tile scheme, 'EPSG:3857' or 'EPSG:4326'.  
+                     See ogc.tileBBox
+      @param frmt: (optional) The image format of the tiles
+      @param tileSize: (optional) The width and height of a tile in pixels
+      @param numThreads: (optional) The maximum number of tiles to request at
+                            the same time, for getTiles and for prefetching
+      @param prefetchRadius: (optional) The number of tiles around a requested
+                                tile to prefetch.  Use 0 to disable prefetching
+      @param maxPrefetch: (optional) The maximum number of tiles waiting to be
+                             prefetched
+      """
+      self.cl = cl
+      self.url, self.layers = parseOgcEndpoint(endpoint)
+      self.cache = cache
+      self.srs = srs
+      self.frmt = frmt
+      self.tileSize = tileSize
+      self.numThreads = numThreads
+      self.prefetchRadius = prefetchRadius
+      self._lock = threading.Lock()
+      self._inFlight = {}
+      self._queued = set()
+      # Waiting prefetch tiles, newest last.  A full deque drops its oldest
+      self._prefetchQueue = deque(maxlen=max(1, maxPrefetch))
+      self._prefetchZoom = None
+      self._queueCond = threading.Condition(self._lock)
+      self._closed = False
+      self._workers = []
+
+   # .........................................
+   def __enter__(self):
+      return self
+
+   # .........................................
+   def __exit__(self, excType, excValue, tb):
+      self.close()
+
+   # .........................................
+   def close(self):
+      """
+      @summary: Drops the waiting prefetch tiles and stops the background 
+                   threads.  Tiles being fetched are finished first
+      """
+      with self._queueCond:
+         self._closed = True
+         self._prefetchQueue.clear()
+         self._queued.clear()
+         self._queueCond.notify_all()
+         workers = self._workers
+         self._workers = []
+      for worker in workers:
+         worker.join()
+
+   # .........................................
+   def getTileUrl(self, z, x, y):
+      """
+      @summary: Returns the WMS GetMap url of a tile.  It is also the key of
+                   the tile in the cache
+      """
+      return "%s?%s" % (self.url, urllib.urlencode(getMapParameters(
+                              self.layers, tileBBox(z, x, y, srs=self.srs),
+                              width=self.tileSize, height=self.tileSize,
+                              srs=self.srs, frmt=self.frmt)))
+
+   # .........................................
+   def getTile(self, z, x, y, prefetch=True):
+      """
+      @summary: Returns the content of a tile, from the cache if possible
+      @param z: The zoom level
+      @param x: The tile column, counted from the west.  It wraps around the
+                   antimeridian
+      @param y: The tile row, counted from the north
+      @param prefetch: (optional) If True, the neighbouring tiles are queued
+                          to be fetched in the background
+      """
+      x, y = self._checkTile(z, x, y)
+      content = self._fetch(z, x, y)
+      if prefetch and self.prefetchRadius > 0:
+         self.prefetch(z, x, y)
+      return content
+
+   # .........................................
+   def getTiles(self, tiles):
+      """
+      @summary: Returns the content of several tiles, fetching those that are
+                   not cached concurrently
+      @param tiles: An iterable of (z, x, y) tuples, such as the tiles visible
+                       in a viewer
+      @return: A tuple of (contents, failures), dictionaries keyed by the
+                  (z, x, y) tuples, of tile content and of the exception for
+                  each tile that could not be fetched
+      """
+      contents = {}
+      failures = {}
+      for res in iterConcurrently(lambda t: self.getTile(*t, prefetch=False),
+                                  list(tiles), numThreads=self.numThreads):
+         if res.error is None:
+            contents[res.item] = res.result
+         else:
+            failures[res.item] = res.error
+      return contents, failures
+
+   # .........................................
+   def prefetch(self, z, x, y):
+      """
+      @summary: Queues the uncached tiles around a tile to be fetched in the
+                   background
+      """
+      numCols, numRows = numTiles(z, srs=self.srs)
+      r = self.prefetchRadius
+      tiles = []
+      for ny in xrange(max(0, y - r), min(numRows, y + r + 1)):
+         for nx in xrange(x - r, x + r + 1):
+            tile = (z, nx % numCols, ny)
+            if tile != (z, x, y) and \
+                  not self.cache.has(self.getTileUrl(*tile)):
+               tiles.append(tile)
+      
+      with self._queueCond:
+         if self._closed:
+            return
+         if z != self._prefetchZoom:
+            # The view has moved to another zoom level
+            self._prefetchQueue.clear()
+            self._queued.clear()
+            self._prefetchZoom = z
+         for tile in tiles:
+            if tile in self._queued:
+               continue
+            if len(self._prefetchQueue) == self._prefetchQueue.maxlen:
+               self._queued.discard(self._prefetchQueue[0])
+            self._prefetchQueue.append(tile)
+            self._queued.add(tile)
+         self._queueCond.notify_all()
+      self._startWorkers()
+
+   # .........................................
+   def _startWorkers(self):
+      """
+      @summary: Starts the background prefetch threads if they are not running
+      """
+      with self._lock:
+         while not self._closed and len(self._workers) < self.numThreads:
+            worker = threading.Thread(target=self._prefetchWorker)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+   # .........................................
+   def _prefetchWorker(self):
+      """
+      @summary: Fetches queued tiles until the fetcher is closed.  Failures
+                   are ignored; the tile is requested again when it is shown
+      """
+      while True:
+         with self._queueCond:
+            while not self._closed and len(self._prefetchQueue) == 0:
+               self._queueCond.wait()
+            if self._closed:
+               return
+            tile = self._prefetchQueue.pop()
+         try:
+            self._fetch(*tile)
+         except Exception:
+            pass
+         finally:
+            with self._lock:
+               self._queued.discard(tile)
+
+   # .........................................
+   def _fetch(self, z, x, y):
+      """
+      @summary: Returns a tile from the cache, or requests it.  If the tile is
+                   already being requested by another thread, that request is
+                   waited for instead of making another
+      """
+      url = self.getTileUrl(z, x, y)
+      content = self.cache.get(url)
+      if content is not None:
+         return content
+
+      with self._lock:
+         pending = self._inFlight.get(url)
+         isOwner = pending is None
+         if isOwner:
+            pending = self._inFlight[url] = [threading.Event(), None, None]
+      if not isOwner:
+         pending[0].wait()
+         if pending[2] is not None:
+            raise pending[2]
+         return pending[1]
+
+      try:
+         ret = self.cl.openRequest(url)
+         try:
+            contentType = ret.info().getheader('Content-Type', '')
+            content = ret.read()
+         finally:
+            ret.close()
+         if not contentType.startswith('image/'):
+            raise Exception("OGC service returned an error: %s" % content[:1000])
+         self.cache.put(url, content)
+         pending[1] = content
+         return content
+      except Exception, e:
+         pending[2] = e
+         raise
+      finally:
+         with self._lock:
+            del self._inFlight[url]
+         pending[0].set()
+
+   # .........................................
+   def _checkTile(self, z, x, y):
+      """
+      @summary: Wraps the column around the antimeridian and checks the row
+      @return: A tuple of (column, row)
+      """
+      numCols, numRows = numTiles(z, srs=self.srs)
+      if y < 0 or y >= numRows:
+         raise Exception("Tile row %s is outside zoom level %s" % (y, z))
+      return x % numCols, y
@@ -0,0 +1,257 @@
+"""
+@summary: Module containing a class for waiting on many Lifemapper SDM
+             experiments to finish
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+
+@note: Example, wait for a batch of experiments:
+          posts = sdmClient.postExperiments(specs)
+          waiter = ExperimentWaiter(sdmClient, [post.expId for post in posts \
+                                                if post.error is None])
+          for completion in waiter.iterCompleted():
+             print completion.expId, completion.status
+"""
+from collections import namedtuple
+import time
+
+from LmClient.batch import (DEFAULT_NUM_THREADS, formatTime, iterListItems,
+                            runConcurrently)
+from LmCommon.common.lmconstants import JobStatus
+
+# Seconds subtracted from each watermark to allow for differences between the
+#    local clock and the server clock
+DEFAULT_CLOCK_SKEW = 60
+
+# .............................................................................
+## A finished experiment.  'experiment' is the full experiment object, or None
+#  if objects are not being fetched
+ExperimentCompletion = namedtuple('ExperimentCompletion', ['expId', 'status',
+                                                           'experiment'])
+
+# .............................................................................
+class ExperimentWaiter(object):
+   """
+   @summary: Waits for a set of SDM experiments to finish
+   @note: Each polling round asks the list service once for the experiments
+             that have changed since the previous round.  These paged calls
+             replace a call per experiment.  Individual experiments are only
+             requested when they have finished and fetchObjects is True, or
+             when their list item has no status
+   @note: The time between rounds grows while nothing changes and resets when
+             something does
+   """
+   # .........................................
+   def __init__(self, sdmClient, expIds, since=None, minInterval=10.0,
+                      maxInterval=300.0, backoff=1.5, fetchObjects=True,
+                      clockSkew=DEFAULT_CLOCK_SKEW, perPage=100,
+                      numThreads=DEFAULT_NUM_THREADS):
+      """
+      @summary: Constructor
+      @param sdmClient: An SDMClient object
+      @param expIds: An iterable of experiment ids to wait for
+      @param since: (optional) A time, in seconds since the epoch, before
+                       which the experiments were posted.  If None, the first
+                       round lists all of the user's experiments
+      @param minInterval: (optional) The minimum number of seconds between
+                             polling rounds
+      @param maxInterval: (optional) The maximum number of seconds between
+                             polling rounds
+      @param backoff: (optional) The factor to increase the interval by after
+                         a round with no changes
+      @param fetchObjects: (optional) If True, get the full experiment object
+                              for each completed experiment
+      @param clockSkew: (optional) The number of seconds that the local clock
+                           may differ from the server clock
+      @param perPage: (optional) The page size used for the list service
+      @param numThreads: (optional) The maximum number of experiments to get
+                            at the same time
+      """
+      self.sdmClient = sdmClient
+      self.pending = set([int(expId) for expId in expIds])
+      self.minInterval = minInterval
+      self.maxInterval = maxInterval
+      self.backoff = backoff
+      self.fetchObjects = fetchObjects
+      self.clockSkew = clockSkew
+      self.perPage = perPage
+      self.numThreads = numThreads
+      self.interval = minInterval
+      self._watermark = since
+      # Ids that could not be checked and must be checked in the next round 
+      #    because their change is now older than the watermark
+      self._retryIds = set()
+
+   # .........................................
+   def add(self, expId):
+      """
+      @summary: Adds an experiment to wait for
+      @param expId: The id of the experiment
+      @note: If the experiment was posted before the current watermark and has
+                already finished, it will not be seen as changed.  Use the
+                'since' constructor argument to cover experiments that were
+                posted earlier
+      """
+      self.pending.add(int(expId))
+
+   # .........................................
+   def pollOnce(self):
+      """
+      @summary: Performs a single polling round
+      @return: A list of ExperimentCompletion named tuples for the experiments
+                  that finished since the last round
+      """
+      roundStart = time.time()
+      afterTime = None
+      if self._watermark is not None:
+         afterTime = formatTime(self._watermark - self.clockSkew)
+
+      # One unfiltered pass finds every change, and the status in each list 
+      #    item says which of them have finished
+      changed = self._listPendingIds(afterTime=afterTime)
+
+      completions = []
+      checkIds = set()
+      for expId, status in changed.iteritems():
+         if status is None or (_isFinished(status) and self.fetchObjects):
+            checkIds.add(expId)
+         elif _isFinished(status):
+            completions.append(ExperimentCompletion(expId, status, None))
+      checkIds = (checkIds | self._retryIds) & self.pending
+      self._retryIds = set()
+
+      for res in runConcurrently(self.sdmClient.getExperiment, checkIds,
+                                 numThreads=self.numThreads):
+         if res.error is not None:
+            self._retryIds.add(res.item)
+            continue
+         status = _getStatus(res.result)
+         if _isFinished(status):
+            completions.append(ExperimentCompletion(res.item, status,
+                                    res.result if self.fetchObjects else None))
+
+      for completion in completions:
+         self.pending.discard(completion.expId)
+
+      self._watermark = roundStart
+      if len(changed) > 0:
+         self.interval = self.minInterval
+      else:
+         self.interval = min(self.maxInterval, self.interval * self.backoff)
+      return completions
+
+   # .........................................
+   def iterCompleted(self, timeout=None):
+      """
+      @summary: Polls until all of the experiments have finished, yielding
+                   each one as it is found
+      @param timeout: (optional) The maximum number of seconds to wait.  If
+                         None, wait until all experiments have finished
+      @return: A generator of ExperimentCompletion named tuples
+      """
+      endTime = None
+      if timeout is not None:
+         endTime = time.time() + timeout
+
+      while len(self.pending) > 0:
+         for completion in self.pollOnce():
+            yield completion
+         if len(self.pending) == 0:
+            break
+         sleepTime = self.interval
+         if endTime is not None:
+            sleepTime = min(sleepTime, endTime - time.time())
+            if sleepTime <= 0:
+               break
+         time.sleep(sleepTime)
+
+   # .........................................
+   def wait(self, onComplete=None, onError=None, timeout=None):
+      """
+      @summary: Polls until all of the experiments have finished, calling the
+                   callbacks for each one
+      @param onComplete: (optional) A function called with an
+                            ExperimentCompletion for each experiment that
+                            completes successfully
+      @param onError: (optional) A function called with an
+                         ExperimentCompletion for each experiment that fails
+      @param timeout: (optional) The maximum number of seconds to wait
+      @return: A set of the experiment ids that have not finished
+      """
+      for completion in self.iterCompleted(timeout=timeout):
+         if completion.status == JobStatus.COMPLETE:
+            if onComplete is not None:
+               onComplete(completion)
+         elif onError is not None:
+            onError(completion)
+      return set(self.pending)
+
+   # .........................................
+   def _listPendingIds(self, afterTime=None):
+      """
+      @summary: Pages through the experiment list service and returns the
+                   listed experiments that are pending
+      @param afterTime: (optional) List only experiments modified after this
+                           time
+      @return: A dictionary of experiment id to the status reported by the 
+                  list item, or None if the list item has no status
+      """
+      ids = {}
+      for item in iterListItems(self.sdmClient.listExperiments,
+                                perPage=self.perPage, afterTime=afterTime):
+         expId = int(item.id)
+         if expId in self.pending:
+            ids[expId] = _getStatus(item)
+      return ids
+
+# =============================================================================
+# =                             Helper Functions                              =
+# =============================================================================
+# .............................................................................
+def _getStatus(exp):
+   """
+   @summary: Gets the status of an experiment object
+   @param exp: An experiment object returned by SDMClient.getExperiment or 
+                  an item returned by SDMClient.listExperiments
+   @note: The status is reported by the experiment's model if the experiment
+             does not have its own status
+   """
+   try:
+      return int(exp.status)
+   except:
+      pass
+   try:
+      return int(exp.model.status)
+   except:
+      return None
+
+# .............................................................................
+def _isFinished(status):
+   """
+   @summary: Returns True if the status means the experiment has finished,
+                either successfully or with an error
+   @param status: An integer job status, or None if unknown
+   """
+   return status is not None and (status == JobStatus.COMPLETE or
+                                  status >= JobStatus.GENERAL_ERROR)
@@ -0,0 +1,127 @@
+"""
+@summary: Benchmark of building SDM experiment request bodies.  Compares
+             LmClient.requestBodies.sdmExperimentBody with the string format
+             based builder that it replaced
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+@note: Run from the src directory with: python bench_requestBodies.py [number]
+"""
+import sys
+import timeit
+from xml.dom.minidom import parseString
+
+from LmClient.requestBodies import sdmExperimentBody
+
+# The number of bodies built by each timing run
+DEFAULT_NUMBER = 50000
+
+# The number of timing runs, the fastest is reported
+REPEAT = 5
+
+# .............................................................................
+class _Param(object):
+   def __init__(self, name, value):
+      self.name = name
+      self.value = value
+
+PARAMS = [_Param('param%d' % i, i * 0.5) for i in range(8)]
+
+# .............................................................................
+def formatBody(algoCode, algorithmParameters, occSetId, mdlScn, prjScns=[], 
+               mdlMask=None, prjMask=None, email=None, name=None, 
+               description=None):
+   """
+   @summary: The body builder that was used by SDMClient.postExperiment.  It
+                does not escape values
+   """
+   algoParams = """\
+                  <lm:parameters>
+                     {params}
+                  </lm:parameters>""".format(params='\n                     '.join(
+                     ["<lm:{name}>{value}</lm:{name}>".format(
+                                        name=param.name, value=param.value) \
+                                     for param in algorithmParameters])) \
+                                        if len(algorithmParameters) > 0 else ""
+   mMask = "            <lm:modelMask>%s</lm:modelMask>" % mdlMask \
+                                                if mdlMask is not None else ""
+   pMask = "            <lm:projectionMask>%s</lm:projectionMask>" % prjMask \
+                                                if prjMask is not None else ""
+   emailSection = "            <lm:email>%s</lm:email>" % email \
+                                                  if email is not None else ""
+   nameSection = "            <lm:name>%s</lm:name>" % name \
+                                                   if name is not None else ""
+   descSection = "            <lm:description>%s</lm:description>" % \
+                                 description if description is not None else ""
+   prjSection = '\n'.join(([
+      "            <lm:projectionScenario>{scnId}</lm:projectionScenario>".format(
+                                        scnId=scnId) for scnId in prjScns]))
+   return """\
+      <lm:request xmlns:lm="http://lifemapper.org"
+                  xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+                    xsi:schemaLocation="http://lifemapper.org
+                                               /schemas/serviceRequest.xsd">
+            <lm:experiment>
+               <lm:algorithm>
+                  <lm:algorithmCode>{algorithmCode}</lm:algorithmCode>
+{algoParams}
+               </lm:algorithm>
+               <lm:occurrenceSetId>{occSetId}</lm:occurrenceSetId>
+               <lm:modelScenario>{mdlScn}</lm:modelScenario>
+{mMask}
+{email}
+{name}
+{description}
+{projections}
+{pMask}
+            </lm:experiment>
+         </lm:request>""".format(algorithmCode=algoCode, 
+                                 algoParams=algoParams, occSetId=occSetId, 
+                                 mdlScn=mdlScn, mMask=mMask, email=emailSection, 
+                                 projections=prjSection, pMask=pMask,
+                                 name=nameSection, description=descSection)
+
+# .............................................................................
+def buildFormatBody():
+   return formatBody('ATT_MAXENT', PARAMS, 1234, 5, prjScns=[6, 7, 8], 
+                     email='user@example.org', name='exp')
+
+# .............................................................................
+def buildBody():
+   # SDMClient.postExperiment passes the parameters as (name, value) tuples
+   return sdmExperimentBody('ATT_MAXENT', 
+                            [(param.name, param.value) for param in PARAMS], 
+                            1234, 5, prjScns=[6, 7, 8], 
+                            email='user@example.org', name='exp')
+
+# .............................................................................
+if __name__ == '__main__':
+   number = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_NUMBER
+   if buildBody() != buildFormatBody():
+      raise Exception("The bodies differ")
+   parseString(buildBody())
+   for label, func in [('format', buildFormatBody), 
+                       ('sdmExperimentBody', buildBody)]:
+      secs = min(timeit.repeat(func, number=number, repeat=REPEAT))
+      print "%-18s %8.0f bodies/s" % (label, number / secs)
@@ -0,0 +1,144 @@
+"""
+@summary: Tests for LmClient.batch
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+@note: Run from the src directory with: python -m unittest discover -p 'test_*.py'
+"""
+import threading
+import time
+import unittest
+
+from LmClient.batch import (formatTime, iterConcurrently, iterListItems, 
+                            RateLimiter, runConcurrently)
+
+# .............................................................................
+class TestRunConcurrently(unittest.TestCase):
+   """
+   @summary: Tests runConcurrently and iterConcurrently
+   """
+   # .........................................
+   def test_resultsInInputOrder(self):
+      results = runConcurrently(lambda x: x * x, range(50), numThreads=8)
+      self.assertEqual([r.index for r in results], range(50))
+      self.assertEqual([r.result for r in results], [x * x for x in range(50)])
+
+   # .........................................
+   def test_errorsAreCaptured(self):
+      # ...............................
+      def _func(x):
+         if x == 3:
+            raise ValueError("bad item")
+         return x
+      
+      results = runConcurrently(_func, range(6), numThreads=3)
+      self.assertTrue(isinstance(results[3].error, ValueError))
+      self.assertEqual(results[3].result, None)
+      self.assertEqual([r.result for r in results if r.index != 3], 
+                       [0, 1, 2, 4, 5])
+
+   # .........................................
+   def test_itemErrorIsRaisedAfterEarlierItems(self):
+      # ...............................
+      def _items():
+         for i in range(5):
+            yield i
+         raise IOError("could not read items")
+      
+      seen = []
+      try:
+         for res in iterConcurrently(lambda x: x, _items(), numThreads=2):
+            seen.append(res.result)
+         self.fail("The error reading items was not raised")
+      except IOError:
+         pass
+      self.assertEqual(sorted(seen), range(5))
+
+   # .........................................
+   def test_closedGeneratorStopsWork(self):
+      consumed = []
+      
+      # ...............................
+      def _items():
+         for i in xrange(100000):
+            consumed.append(i)
+            yield i
+      
+      before = threading.active_count()
+      gen = iterConcurrently(lambda x: time.sleep(0.01), _items(), 
+                             numThreads=2)
+      gen.next()
+      gen.close()
+      endTime = time.time() + 5
+      while threading.active_count() > before and time.time() < endTime:
+         time.sleep(0.01)
+      self.assertEqual(threading.active_count(), before)
+      self.assertTrue(len(consumed) < 20)
+
+# .............................................................................
+class TestRateLimiter(unittest.TestCase):
+   """
+   @summary: Tests RateLimiter
+   """
+   # .........................................
+   def test_spacesCalls(self):
+      limiter = RateLimiter(50)
+      start = time.time()
+      for _ in range(6):
+         limiter.wait()
+      self.assertTrue(time.time() - start >= 0.09)
+
+   # .........................................
+   def test_unlimited(self):
+      limiter = RateLimiter(None)
+      start = time.time()
+      for _ in range(1000):
+         limiter.wait()
+      self.assertTrue(time.time() - start < 0.5)
+
+# .............................................................................
+class TestListHelpers(unittest.TestCase):
+   """
+   @summary: Tests iterListItems and formatTime
+   """
+   # .........................................
+   def test_iterListItemsPages(self):
+      calls = []
+      
+      # ...............................
+      def _list(page=0, perPage=10, expId=None):
+         calls.append((page, perPage, expId))
+         return range(25)[page * perPage:(page + 1) * perPage]
+      
+      self.assertEqual(list(iterListItems(_list, perPage=10, expId=7)), 
+                       range(25))
+      self.assertEqual(calls, [(0, 10, 7), (1, 10, 7), (2, 10, 7)])
+
+   # .........................................
+   def test_formatTime(self):
+      self.assertEqual(formatTime(0), "1970-01-01T00:00:00Z")
+
+# .............................................................................
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,285 @@
+"""
+@summary: Tests for LmClient.downloads and the resumable downloads of
+             LmClient.lmClientLib
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+@note: The downloadToFile tests require LmCommon and are skipped without it
+@note: Run from the src directory with: python -m unittest discover -p 'test_*.py'
+"""
+from StringIO import StringIO
+import os
+import random
+import re
+import shutil
+import tempfile
+import unittest
+import urllib2
+import zipfile
+
+from LmClient.downloads import openRemoteFile, parseContentRange, RangeFile
+
+try:
+   from LmClient.lmClientLib import _Client
+except ImportError:
+   _Client = None
+
+# .............................................................................
+class _Headers(object):
+   def __init__(self, headers):
+      self.headers = headers
+
+   def getheader(self, name, default=None):
+      return self.headers.get(name, default)
+
+# .............................................................................
+class _Response(StringIO):
+   """
+   @summary: Stands in for a urllib2 response
+   """
+   def __init__(self, content, code=200, headers={}):
+      StringIO.__init__(self, content)
+      self.code = code
+      self.headers = _Headers(headers)
+
+   def getcode(self):
+      return self.code
+
+   def info(self):
+      return self.headers
+
+# .............................................................................
+class _FakeServer(object):
+   """
+   @summary: Serves one file from memory.  Supports Range and If-Range, and 
+                records the headers of every request
+   """
+   def __init__(self, content, etag='"v1"', supportsRanges=True):
+      self.content = content
+      self.etag = etag
+      self.supportsRanges = supportsRanges
+      self.requests = []
+      self.truncateAt = None
+
+   def openRequest(self, url, method="GET", parameters=[], body=None, 
+                   headers={}):
+      self.requests.append(dict(headers))
+      size = len(self.content)
+      rangeHeader = headers.get('Range')
+      if rangeHeader is not None and self.supportsRanges and \
+            headers.get('If-Range', self.etag) == self.etag:
+         start, end = re.match(r'bytes=(\d+)-(\d*)', rangeHeader).groups()
+         start = int(start)
+         end = min(int(end), size - 1) if end else size - 1
+         if start >= size:
+            raise urllib2.HTTPError(url, 416, 'Range Not Satisfiable', 
+                        _Headers({'Content-Range' : 'bytes */%d' % size}), 
+                        StringIO(''))
+         return _Response(self.content[start:end + 1], code=206, 
+                    headers={'Content-Range' : 'bytes %d-%d/%d' % (
+                                                         start, end, size)})
+      content = self.content
+      if self.truncateAt is not None:
+         content = content[:self.truncateAt]
+         self.truncateAt = None
+      return _Response(content, headers={'Content-Length' : str(size), 
+                                         'ETag' : self.etag})
+
+# .............................................................................
+def _makeZip(numMembers, memberSize):
+   """
+   @summary: Returns the content of a zip file of random, uncompressed members
+   """
+   rand = random.Random(1)
+   outF = StringIO()
+   with zipfile.ZipFile(outF, 'w', zipfile.ZIP_STORED) as zf:
+      for i in range(numMembers):
+         zf.writestr('member%d.bin' % i, 
+                     ''.join([chr(rand.randint(0, 255)) \
+                                              for _ in xrange(memberSize)]))
+   return outF.getvalue()
+
+# .............................................................................
+class TestRangeFile(unittest.TestCase):
+   """
+   @summary: Tests RangeFile and openRemoteFile
+   """
+   # .........................................
+   def setUp(self):
+      self.content = ''.join([chr(i % 251) for i in xrange(10000)])
+      self.server = _FakeServer(self.content)
+
+   # .........................................
+   def test_randomReads(self):
+      rf = RangeFile(self.server, 'http://x/f', len(self.content), 
+                     blockSize=64, maxBlocks=4)
+      rand = random.Random(2)
+      for _ in range(500):
+         pos = rand.randint(0, len(self.content) + 10)
+         n = rand.randint(0, 300)
+         rf.seek(pos)
+         self.assertEqual(rf.read(n), self.content[pos:pos + n])
+         self.assertEqual(rf.tell(), min(pos + n, len(self.content)) \
+                                          if pos < len(self.content) else pos)
+      rf.seek(-5, 2)
+      self.assertEqual(rf.read(), self.content[-5:])
+
+   # .........................................
+   def test_recentBlocksAreKept(self):
+      rf = RangeFile(self.server, 'http://x/f', len(self.content), 
+                     blockSize=100, maxBlocks=2)
+      for pos in [0, 150, 10, 120, 199]:
+         rf.seek(pos)
+         rf.read(1)
+      self.assertEqual(rf.numRequests, 2)
+      # A third block drops the least recently used one, block 0
+      rf.seek(250)
+      rf.read(1)
+      rf.seek(120)
+      rf.read(1)
+      self.assertEqual(rf.numRequests, 3)
+      rf.seek(0)
+      rf.read(1)
+      self.assertEqual(rf.numRequests, 4)
+
+   # .........................................
+   def test_adjacentMissingBlocksShareARequest(self):
+      rf = RangeFile(self.server, 'http://x/f', len(self.content), 
+                     blockSize=100, maxBlocks=8)
+      rf.seek(250)
+      rf.read(1)
+      rf.seek(0)
+      self.assertEqual(rf.read(600), self.content[:600])
+      # Blocks 0-1 and 3-5 are missing, block 2 is cached
+      self.assertEqual([r['Range'] for r in self.server.requests],
+                       ['bytes=200-299', 'bytes=0-199', 'bytes=300-599'])
+
+   # .........................................
+   def test_zipMembersAreReadWithFewRequests(self):
+      content = _makeZip(40, 3000)
+      server = _FakeServer(content)
+      rf = openRemoteFile(server, 'http://x/f.zip', blockSize=8192, 
+                          maxBlocks=8)
+      self.assertTrue(isinstance(rf, RangeFile))
+      zf = zipfile.ZipFile(rf)
+      names = zf.namelist()
+      for name in [names[0], names[-1], names[0], names[-1]]:
+         zf.read(name)
+      # One probe, then the end of the file and the two members
+      self.assertTrue(len(server.requests) <= 4, server.requests)
+      numRequests = len(server.requests)
+      zf.read(names[0])
+      self.assertEqual(len(server.requests), numRequests)
+      self.assertTrue(len(server.requests) * 8192 < len(content))
+
+   # .........................................
+   def test_serverWithoutRanges(self):
+      server = _FakeServer(self.content, supportsRanges=False)
+      f = openRemoteFile(server, 'http://x/f')
+      self.assertFalse(isinstance(f, RangeFile))
+      f.seek(9000)
+      self.assertEqual(f.read(), self.content[9000:])
+
+   # .........................................
+   def test_parseContentRange(self):
+      self.assertEqual(parseContentRange('bytes 100-199/1000'), (100, 1000))
+      self.assertEqual(parseContentRange('bytes 100-199/*'), (100, None))
+      self.assertEqual(parseContentRange('bytes */1000'), (None, 1000))
+
+# .............................................................................
+def _makeClient(server):
+   """
+   @summary: Returns a _Client whose requests go to a _FakeServer.  The 
+                constructor is skipped, since it contacts the server
+   """
+   cl = object.__new__(_Client)
+   cl.openRequest = server.openRequest
+   return cl
+
+# .............................................................................
+@unittest.skipIf(_Client is None, "LmCommon is not installed")
+class TestDownloadToFile(unittest.TestCase):
+   """
+   @summary: Tests resuming downloads with _Client.downloadToFile
+   """
+   # .........................................
+   def setUp(self):
+      self.tmpDir = tempfile.mkdtemp()
+      self.fn = os.path.join(self.tmpDir, 'out.bin')
+      self.content = ''.join([chr(i % 253) for i in xrange(5000)])
+      self.server = _FakeServer(self.content)
+      self.cl = _makeClient(self.server)
+
+   # .........................................
+   def tearDown(self):
+      shutil.rmtree(self.tmpDir)
+
+   # .........................................
+   def _read(self, fn):
+      with open(fn, 'rb') as inF:
+         return inF.read()
+
+   # .........................................
+   def test_interruptedDownloadIsResumed(self):
+      self.server.truncateAt = 2000
+      self.assertRaises(Exception, self.cl.downloadToFile, 'http://x/f', 
+                        self.fn)
+      self.assertFalse(os.path.exists(self.fn))
+      self.assertEqual(os.path.getsize(self.fn + '.part'), 2000)
+      
+      self.assertEqual(self.cl.downloadToFile('http://x/f', self.fn), 3000)
+      self.assertEqual(self.server.requests[-1], 
+                       {'Range' : 'bytes=2000-', 'If-Range' : '"v1"'})
+      self.assertEqual(self._read(self.fn), self.content)
+      self.assertFalse(os.path.exists(self.fn + '.part'))
+      self.assertFalse(os.path.exists(self.fn + '.part.validator'))
+
+   # .........................................
+   def test_changedFileIsDownloadedAgain(self):
+      self.server.truncateAt = 2000
+      self.assertRaises(Exception, self.cl.downloadToFile, 'http://x/f', 
+                        self.fn)
+      self.server.content = 'x' * 4000
+      self.server.etag = '"v2"'
+      self.cl.downloadToFile('http://x/f', self.fn)
+      self.assertEqual(self._read(self.fn), 'x' * 4000)
+
+   # .........................................
+   def test_completePartialFileIsFinished(self):
+      with open(self.fn + '.part', 'wb') as outF:
+         outF.write(self.content)
+      self.assertEqual(self.cl.downloadToFile('http://x/f', self.fn), 0)
+      self.assertEqual(self._read(self.fn), self.content)
+      self.assertFalse(os.path.exists(self.fn + '.part'))
+
+   # .........................................
+   def test_skipExisting(self):
+      with open(self.fn, 'wb') as outF:
+         outF.write(self.content)
+      self.assertEqual(self.cl.downloadToFile('http://x/f', self.fn, 
+                                              skipExisting=True), None)
+
+# .............................................................................
+if __name__ == '__main__':
+   unittest.main()
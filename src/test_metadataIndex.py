@@ -0,0 +1,98 @@
+"""
+@summary: Tests for LmClient.metadataIndex
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+@note: Requires LmCommon, the tests are skipped without it
+@note: Run from the src directory with: python -m unittest discover -p 'test_*.py'
+"""
+from datetime import datetime
+import unittest
+
+try:
+   from LmClient.metadataIndex import MetadataIndex
+except ImportError:
+   MetadataIndex = None
+
+# .............................................................................
+class _Obj(object):
+   def __init__(self, objId, modTime, status=300):
+      self.id = objId
+      self.modTime = modTime
+      self.status = status
+
+# .............................................................................
+@unittest.skipIf(MetadataIndex is None, "LmCommon is not installed")
+class TestQueryTimes(unittest.TestCase):
+   """
+   @summary: Tests that query times are compared in the type of the stored
+                modification times
+   """
+   # .........................................
+   def setUp(self):
+      self.idx = MetadataIndex()
+
+   # .........................................
+   def tearDown(self):
+      self.idx.close()
+
+   # .........................................
+   def _ids(self, **kwargs):
+      return sorted([row['id'] for row in self.idx.query('sdmExperiments', 
+                                                          **kwargs)])
+
+   # .........................................
+   def test_modifiedJulianDays(self):
+      # 2016-05-31, 2016-06-01 12:00 and 2016-06-03
+      self.idx.addMany('sdmExperiments', [_Obj(1, '57539.0'), 
+                                          _Obj(2, 57540.5), _Obj(3, 57542)])
+      self.assertEqual(self._ids(afterTime='2016-06-01T00:00:00Z'), [2, 3])
+      self.assertEqual(self._ids(afterTime='2016-06-01'), [2, 3])
+      self.assertEqual(self._ids(afterTime=datetime(2016, 6, 1, 13)), [3])
+      self.assertEqual(self._ids(afterTime=57540), [2, 3])
+      self.assertEqual(self._ids(afterTime='2016-06-01', 
+                                 beforeTime='2016-06-02 00:00:00'), [2])
+      self.assertEqual(self.idx.count('sdmExperiments', 
+                                      beforeTime='2016-06-01'), 1)
+
+   # .........................................
+   def test_isoStrings(self):
+      self.idx.addMany('sdmExperiments', [_Obj(1, '2016-05-31T10:00:00Z'),
+                                          _Obj(2, '2016-06-02T10:00:00Z')])
+      self.assertEqual(self._ids(afterTime='2016-06-01T00:00:00Z'), [2])
+      self.assertEqual(self._ids(afterTime=datetime(2016, 6, 1)), [2])
+
+   # .........................................
+   def test_unknownFormat(self):
+      self.idx.add('sdmExperiments', _Obj(1, 57539.0))
+      self.assertRaises(Exception, self.idx.query, 'sdmExperiments', 
+                        afterTime='June 1st')
+
+   # .........................................
+   def test_emptyIndex(self):
+      self.assertEqual(self._ids(afterTime='2016-06-01'), [])
+
+# .............................................................................
+if __name__ == '__main__':
+   unittest.main()
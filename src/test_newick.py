@@ -0,0 +1,161 @@
+"""
+@summary: Tests for LmClient.newick
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+@note: Requires NumPy, the tests are skipped without it
+@note: Run from the src directory with: python -m unittest discover -p 'test_*.py'
+"""
+from StringIO import StringIO
+import json
+import unittest
+
+try:
+   import numpy as np
+   from LmClient.newick import NO_NODE, parseNewick, writeJTree
+except ImportError:
+   np = None
+
+TREE = "((A:1,B:2)AB:3,(C:1,(D:1,E:1)DE:2)CDE:1,'F g':4)R;"
+
+# .............................................................................
+@unittest.skipIf(np is None, "NumPy is not installed")
+class TestParseNewick(unittest.TestCase):
+   """
+   @summary: Tests parseNewick and CompactTree
+   """
+   # .........................................
+   def test_parse(self):
+      tree = parseNewick(StringIO(TREE))
+      self.assertEqual(len(tree), 10)
+      self.assertEqual(tree.getLabel(0), 'R')
+      self.assertEqual(tree.parent[0], NO_NODE)
+      self.assertEqual([tree.getLabel(n) for n in tree.tipIndices()],
+                       ['A', 'B', 'C', 'D', 'E', 'F g'])
+      node = tree.findLabels(['B'])[0]
+      self.assertEqual(tree.branchLength[node], 2.0)
+      self.assertEqual(tree.getLabel(tree.parent[node]), 'AB')
+
+   # .........................................
+   def test_smallChunks(self):
+      # Tokens split across chunks must be parsed the same way
+      whole = parseNewick(StringIO(TREE))
+      for chunkSize in (1, 2, 3, 7):
+         tree = parseNewick(StringIO(TREE), chunkSize=chunkSize)
+         self.assertEqual(tree.parent.tolist(), whole.parent.tolist())
+         self.assertEqual([tree.getLabel(n) for n in range(len(tree))],
+                          [whole.getLabel(n) for n in range(len(whole))])
+
+   # .........................................
+   def test_tipCounts(self):
+      tree = parseNewick(StringIO(TREE))
+      counts = tree.tipCounts()
+      self.assertEqual(counts[0], 6)
+      self.assertEqual(counts[tree.findLabels(['CDE'])[0]], 3)
+
+   # .........................................
+   def test_findLabelsUsesFirstDuplicate(self):
+      tree = parseNewick(StringIO("((X,Y)X,Z)R;"))
+      self.assertEqual(tree.findLabels(['X', 'Z', 'missing']).tolist(), 
+                       [1, 4, NO_NODE])
+
+   # .........................................
+   def test_findLabelsOfSubtree(self):
+      tree = parseNewick(StringIO(TREE))
+      sub = tree.prune(tree.findLabels(['D', 'E']))
+      self.assertEqual(sub.findLabels(['D', 'A']).tolist(), [1, NO_NODE])
+
+# .............................................................................
+@unittest.skipIf(np is None, "NumPy is not installed")
+class TestPrune(unittest.TestCase):
+   """
+   @summary: Tests CompactTree.prune
+   """
+   # .........................................
+   def setUp(self):
+      self.tree = parseNewick(StringIO(TREE))
+
+   # .........................................
+   def _labels(self, tree):
+      return [tree.getLabel(n) for n in range(len(tree))]
+
+   # .........................................
+   def test_collapseAddsLengths(self):
+      tree = self.tree.prune(self.tree.findLabels(['A', 'D', 'E']))
+      self.assertEqual(self._labels(tree), ['R', 'A', 'DE', 'D', 'E'])
+      self.assertEqual(tree.branchLength[1], 4.0)
+      self.assertEqual(tree.branchLength[2], 3.0)
+      self.assertEqual(tree.parent.tolist(), [NO_NODE, 0, 0, 2, 2])
+
+   # .........................................
+   def test_noCollapse(self):
+      tree = self.tree.prune(self.tree.findLabels(['A', 'D']), 
+                             collapse=False)
+      self.assertEqual(self._labels(tree), ['R', 'AB', 'A', 'CDE', 'DE', 'D'])
+
+   # .........................................
+   def test_nestedRequestsKeepAncestor(self):
+      tree = self.tree.prune(self.tree.findLabels(['AB', 'A', 'C']))
+      self.assertEqual(self._labels(tree), ['R', 'AB', 'A', 'C'])
+      self.assertEqual(tree.parent.tolist(), [NO_NODE, 0, 1, 0])
+      self.assertEqual(tree.branchLength[3], 2.0)
+
+   # .........................................
+   def test_singleTip(self):
+      tree = self.tree.prune(self.tree.findLabels(['D']))
+      self.assertEqual(self._labels(tree), ['D'])
+      self.assertEqual(tree.parent.tolist(), [NO_NODE])
+
+   # .........................................
+   def test_noTips(self):
+      self.assertRaises(Exception, self.tree.prune, [])
+
+# .............................................................................
+@unittest.skipIf(np is None, "NumPy is not installed")
+class TestJTree(unittest.TestCase):
+   """
+   @summary: Tests writeJTree
+   """
+   # .........................................
+   def test_writeJTree(self):
+      tree = parseNewick(StringIO("((A:1,B)AB:2,C)R;"))
+      mx = np.full(len(tree), NO_NODE, dtype=np.int32)
+      mx[tree.findLabels(['A', 'C'])] = [0, 1]
+      outF = StringIO()
+      writeJTree(tree, outF, matrixIndices=mx)
+      doc = json.loads(outF.getvalue())
+      self.assertEqual(doc['name'], 'R')
+      ab, c = doc['children']
+      self.assertEqual((ab['name'], ab['length'], ab['pathId']), 
+                       ('AB', 2.0, 1))
+      self.assertEqual(ab['children'][0], 
+                       {'pathId': 2, 'name': 'A', 'length': 1.0, 'mx': 0, 
+                        'children': []})
+      self.assertEqual(ab['children'][1], 
+                       {'pathId': 3, 'name': 'B', 'children': []})
+      self.assertEqual(c['mx'], 1)
+
+# .............................................................................
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,165 @@
+"""
+@summary: Tests for LmClient.openTree
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+@note: Requires LmCommon, the tests are skipped without it
+@note: Run from the src directory with: python -m unittest discover -p 'test_*.py'
+"""
+from StringIO import StringIO
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+   from LmClient.openTree import (_NewickResponseReader, OTLClient, 
+                                  OTLNameCache)
+except ImportError:
+   OTLClient = None
+
+# .............................................................................
+class _FakeCl(object):
+   """
+   @summary: Stands in for a _Client, answering the name matching service
+   """
+   def __init__(self, failing=()):
+      self.bodies = []
+      self.failing = set(failing)
+      self._lock = threading.Lock()
+
+   def makeRequest(self, url, method="GET", body=None, headers={}):
+      names = json.loads(body)['names']
+      with self._lock:
+         self.bodies.append(names)
+      if self.failing.intersection(names):
+         raise Exception("Service unavailable")
+      results = []
+      for i, name in enumerate(names):
+         if name.startswith('Unknown'):
+            continue
+         results.append({'name' : name, 
+                         'matches' : [{'search_string' : name.lower(),
+                                       'taxon' : {'ott_id' : 100 + i,
+                                                  'unique_name' : name,
+                                                  'rank' : 'species',
+                                                  'is_suppressed' : False}}]})
+      return json.dumps({'results' : results})
+
+# .............................................................................
+@unittest.skipIf(OTLClient is None, "LmCommon is not installed")
+class TestResolveNames(unittest.TestCase):
+   """
+   @summary: Tests OTLClient.resolveNames and OTLNameCache
+   """
+   # .........................................
+   def setUp(self):
+      self.tmpDir = tempfile.mkdtemp()
+
+   # .........................................
+   def tearDown(self):
+      shutil.rmtree(self.tmpDir)
+
+   # .........................................
+   def test_namesAreBatched(self):
+      cl = _FakeCl()
+      names = ['Genus species%d' % i for i in range(25)] + ['Unknown one']
+      resolved, unresolved, failures = OTLClient(cl).resolveNames(
+                       names + ['genus_species0'], namesPerRequest=10, 
+                       maxPerSecond=None)
+      self.assertEqual(sorted(len(b) for b in cl.bodies), [6, 10, 10])
+      self.assertEqual(len(resolved), 26)
+      self.assertEqual(resolved['genus_species0'], 
+                       resolved['Genus species0'])
+      self.assertEqual(unresolved, ['Unknown one'])
+      self.assertEqual(failures, {})
+
+   # .........................................
+   def test_failedBatch(self):
+      cl = _FakeCl(failing=['Genus b'])
+      resolved, unresolved, failures = OTLClient(cl).resolveNames(
+                       ['Genus a', 'Genus b', 'Genus c'], namesPerRequest=2,
+                       numThreads=1, maxPerSecond=None)
+      self.assertEqual(sorted(failures.keys()), ['Genus a', 'Genus b'])
+      self.assertEqual(resolved.keys(), ['Genus c'])
+
+   # .........................................
+   def test_cacheKeysAfterReload(self):
+      cacheFile = os.path.join(self.tmpDir, 'names.json')
+      name = u'Abies n\xe9e'.encode('utf-8')
+      cache = OTLNameCache(cacheFile)
+      OTLClient(_FakeCl()).resolveNames([name, 'Unknown x'], cache=cache, 
+                                        maxPerSecond=None)
+      
+      cache = OTLNameCache(cacheFile)
+      self.assertEqual(len(cache), 2)
+      self.assertEqual(cache.get(name)[0].ottId, 100)
+      self.assertEqual(cache.get(name), cache.get(name.decode('utf-8')))
+      cl = _FakeCl()
+      resolved, unresolved, _ = OTLClient(cl).resolveNames([name, 'Unknown x'],
+                                                         cache=cache)
+      self.assertEqual(cl.bodies, [])
+      self.assertEqual(resolved.keys(), [name])
+      self.assertEqual(unresolved, ['Unknown x'])
+
+# .............................................................................
+@unittest.skipIf(OTLClient is None, "LmCommon is not installed")
+class TestNewickResponseReader(unittest.TestCase):
+   """
+   @summary: Tests reading the Newick string of a tree service response
+   """
+   # .........................................
+   def _readAll(self, content, chunkSize, n):
+      reader = _NewickResponseReader(StringIO(content), chunkSize=chunkSize)
+      pieces = []
+      while True:
+         piece = reader.read(n)
+         if not piece:
+            return ''.join(pieces)
+         pieces.append(piece)
+
+   # .........................................
+   def test_jsonResponse(self):
+      newick = u"((A_ott1:1,'B \"b\"':2)\\C\xe9,D);"
+      content = json.dumps({'tree_id' : 'x', 'newick' : newick, 
+                            'other' : 'y'})
+      for chunkSize in (1, 2, 3, 5, 64):
+         self.assertEqual(self._readAll(content, chunkSize, 4), 
+                          newick.encode('utf-8'))
+
+   # .........................................
+   def test_plainResponse(self):
+      newick = "  ((A,B),C);"
+      self.assertEqual(self._readAll(newick, 3, 2), newick)
+
+   # .........................................
+   def test_missingNewick(self):
+      self.assertRaises(Exception, _NewickResponseReader, 
+                        StringIO('{"message": "not found"}'), chunkSize=4)
+
+# .............................................................................
+if __name__ == '__main__':
+   unittest.main()
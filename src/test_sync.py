@@ -0,0 +1,149 @@
+"""
+@summary: Tests for LmClient.sync
+@author: CJ Grady
+@version: 3.3.4
+@status: release
+
+@license: Copyright (C) 2016, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+"""
+import shutil
+import tempfile
+import time
+import unittest
+import urllib2
+
+from LmClient.sync import ArchiveSync, DirectoryStore
+
+# .............................................................................
+class _Item(object):
+   def __init__(self, objId):
+      self.id = objId
+
+# .............................................................................
+class _FakeCl(object):
+   """
+   @summary: Stands in for a _Client, serving XML documents from a dictionary
+   """
+   def __init__(self, sdm):
+      self.sdm = sdm
+      self.server = 'http://example.org'
+      self.requested = []
+      self.failing = {}
+
+   def makeRequest(self, url):
+      objId = int(url.rsplit('/', 1)[1])
+      self.requested.append(objId)
+      if self.failing.has_key(objId):
+         raise self.failing[objId]
+      return "<experiment><id>%s</id></experiment>" % objId
+
+# .............................................................................
+class _FakeSdm(object):
+   """
+   @summary: Stands in for an SDMClient.  Objects are (id, modified time)
+   """
+   def __init__(self, objs):
+      self.objs = dict(objs)
+      self.cl = _FakeCl(self)
+      self.afterTimes = []
+
+   def listExperiments(self, page=0, perPage=100, afterTime=None):
+      self.afterTimes.append(afterTime)
+      ids = sorted([objId for objId, modTime in self.objs.iteritems() \
+                     if afterTime is None or \
+                        time.strftime("%Y-%m-%dT%H:%M:%SZ", 
+                                      time.gmtime(modTime)) > afterTime])
+      return [_Item(objId) for objId in ids[page * perPage:(page + 1) * perPage]]
+
+   def countExperiments(self):
+      return len(self.objs)
+
+# .............................................................................
+class TestArchiveSync(unittest.TestCase):
+   """
+   @summary: Tests ArchiveSync with a DirectoryStore
+   """
+   # .........................................
+   def setUp(self):
+      self.baseDir = tempfile.mkdtemp()
+      self.store = DirectoryStore(self.baseDir)
+      self.sdm = _FakeSdm([(i, 1000) for i in range(1, 11)])
+      self.syncer = ArchiveSync(self.store, sdmClient=self.sdm, clockSkew=0,
+                                perPage=3, numThreads=2)
+
+   # .........................................
+   def tearDown(self):
+      shutil.rmtree(self.baseDir)
+
+   # .........................................
+   def test_firstSyncStoresEverything(self):
+      summary = self.syncer.sync('sdmExperiments')
+      self.assertEqual(summary.numUpdated, 10)
+      self.assertEqual(self.store.listIds('sdmExperiments'), set(range(1, 11)))
+      self.assertEqual(self.sdm.afterTimes[0], None)
+      self.assertEqual(self.syncer.getWatermark('sdmExperiments'), 
+                       summary.watermark)
+
+   # .........................................
+   def test_failuresAdvanceWatermarkAndAreRetried(self):
+      self.sdm.cl.failing[4] = Exception("Server error")
+      summary = self.syncer.sync('sdmExperiments')
+      self.assertEqual(summary.failures.keys(), [4])
+      self.assertNotEqual(self.syncer.getWatermark('sdmExperiments'), None)
+      self.assertEqual(self.syncer.getRetryIds('sdmExperiments'), [4])
+
+      # Nothing modified since, so only the failed object is requested
+      del self.sdm.cl.failing[4]
+      self.sdm.cl.requested = []
+      summary = self.syncer.sync('sdmExperiments')
+      self.assertEqual(self.sdm.cl.requested, [4])
+      self.assertEqual(summary.failures, {})
+      self.assertEqual(self.syncer.getRetryIds('sdmExperiments'), [])
+      self.assertTrue(4 in self.store.listIds('sdmExperiments'))
+
+   # .........................................
+   def test_missingObjectsAreNotRetried(self):
+      self.sdm.cl.failing[5] = urllib2.HTTPError('url', 404, 'Not Found', 
+                                                 {}, None)
+      self.syncer.sync('sdmExperiments')
+      self.assertEqual(self.syncer.getRetryIds('sdmExperiments'), [])
+
+   # .........................................
+   def test_onlyModifiedObjectsAreRequested(self):
+      self.syncer.sync('sdmExperiments')
+      self.sdm.objs[3] = time.time() + 60
+      self.sdm.cl.requested = []
+      summary = self.syncer.sync('sdmExperiments')
+      self.assertEqual(self.sdm.cl.requested, [3])
+      self.assertEqual(summary.numUpdated, 1)
+
+   # .........................................
+   def test_reconcileRemovesDeletedObjects(self):
+      self.syncer.sync('sdmExperiments')
+      del self.sdm.objs[7]
+      summary = self.syncer.sync('sdmExperiments')
+      self.assertEqual(summary.numDeleted, 1)
+      self.assertFalse(7 in self.store.listIds('sdmExperiments'))
+
+# .............................................................................
+if __name__ == '__main__':
+   unittest.main()